@@ -2,6 +2,8 @@
 
 The class :class:`TempData` is used as a base class to provide functionality on how to save and handle data generated by the classes :class:`CircuitSpec`, :class:`HamilSpec` and :class:`ParamCollection` for memory management purposes.
 
+The class :class:`SweepStore` is used to store the results of parameter sweeps in a columnar format on disk, that can be read back without loading the whole sweep.
+
 The class :class:`ProjectData` is used to create structured output for later use. This is a mechanism for saving work in a consistent way.
 
 This module also defines a series of plotting utilities for data representation, based on `matplotlib`.
@@ -14,6 +16,7 @@ This module also defines a series of plotting utilities for data representation,
 
 import datetime as dt
 import pickle
+import json
 import platform
 import os
 import sys
@@ -22,6 +25,8 @@ import numpy as np
 import shutil
 import uuid
 import tempfile
+import queue
+import threading
 from . import util
 #import util
 
@@ -34,6 +39,7 @@ class TempData:
     __temp_out_root_suffix = ".pycqed" + os.sep # if platform.system() in ["Linux","Java"] else "PyCQED" + os.sep # FIXME: Put temp data somewhere other than home directory in case of Windows?
     __session_default_prefix = "session-"
     __part_default_prefix = "part-"
+    __store_default_prefix = "sweep-"
     
     def __init__(self):
         
@@ -50,6 +56,9 @@ class TempData:
         self.part_prefix = self.__part_default_prefix
         self.__session_exists = False
         self.part_count = 0
+        self.store_count = 0
+        self.disk_quota = None
+        self.writer = None
     
     def newSession(self, obj_id):
         """ A new session should be created in association with the lifetime of a PyCQED class. During the lifetime of that class, any temporary data will be written in that session so that it can be later retrieved. This prevents the temporary data from being overwritten if a new instance of the same PyCQED class is created. Using the objects memory address to uniquely identify it means the same directory will be used for that object.
@@ -81,7 +90,7 @@ class TempData:
         pass
     
     def writePart(self, data):
-        """ Write a temporary data file and return its name so that it can be saved for later use. The data is pickled and written to a binary file.
+        """ Write a temporary data file and return its name so that it can be saved for later use. The data is pickled and written to a binary file by a background thread, see :class:`AsyncWriter`, so it should not be modified afterwards. The file can be read with :func:`readPart`, otherwise :func:`flushWrites` should be called before it is read.
         
         :param data: An arbitrary python object that must be serialisable.
         :type data: object
@@ -90,19 +99,52 @@ class TempData:
         :rtype: str
         """
         
-        # FIXME: Dispatch threads to write these files to not impact performance?
-        # Would only be needed in cases where each data point is evaluated very fast, in which case
-        # typically temp files would not be needed, unless there really are so many points.
-        
         # Generate filename
         fname = self.session_path + self.part_prefix + str(self.part_count) + ".bin"
         
         # Write it
-        util.pickleWrite(data, fname)
+        self.getWriter().submit(util.pickleWrite, data, fname)
         self.part_count += 1
         
         return fname
+    
+    def getWriter(self):
+        """ Gets the background writer of the session, creating it if required.
+        
+        :return: The writer.
+        :rtype: :class:`AsyncWriter`
+        """
+        if self.writer is None:
+            self.writer = AsyncWriter()
+        return self.writer
+    
+    def flushWrites(self):
+        """ Waits until all queued writes of the session have completed.
         
+        :raises Exception: If a queued write failed.
+        
+        :return: None
+        """
+        if self.writer is not None:
+            self.writer.flush()
+        
+    def newSweepStore(self, chunk_size=256, reserve=0):
+        """ Creates a new sweep result store in the temporary data directory, see :class:`SweepStore`. If a disk quota is set, the least recently used temporary data is first deleted to make space for the store.
+        
+        :param chunk_size: The number of results to buffer before they are written.
+        :type chunk_size: int, optional
+        
+        :param reserve: The expected size of the store in bytes.
+        :type reserve: int, optional
+        
+        :return: The new store.
+        :rtype: :class:`SweepStore`
+        """
+        self.enforceDiskQuota(reserve)
+        path = self.session_path + self.__store_default_prefix + str(self.store_count) + os.sep
+        self.store_count += 1
+        return SweepStore(path, chunk_size=chunk_size, writer=self.getWriter())
+    
     def readPart(self, filename):
         """ Read a temporary data file with pickled data contained within.
         
@@ -113,8 +155,56 @@ class TempData:
         :rtype: object
         """
         
+        # Mark the file as recently used
+        self.flushWrites()
+        os.utime(filename)
         return util.pickleRead(filename)
     
+    def setDiskQuota(self, quota):
+        """ Sets the number of bytes the temporary data of the session may occupy. The quota is enforced when new sweep result stores are created, by deleting the least recently used data.
+        
+        :param quota: The quota in bytes, or `None` for no quota.
+        :type quota: int
+        
+        :return: None
+        """
+        self.disk_quota = quota
+    
+    def enforceDiskQuota(self, reserve=0):
+        """ Deletes the least recently used temporary data files and sweep result stores of the session until they, and the reserved space, fit within the disk quota. The last use is taken to be the last modification time, which is updated when data is read.
+        
+        :param reserve: The number of bytes to reserve for new data.
+        :type reserve: int, optional
+        
+        :return: None
+        """
+        if self.disk_quota is None or not self.__session_exists:
+            return
+        self.flushWrites()
+        
+        # Size and last use of each part file and store directory
+        entries = []
+        for name in os.listdir(self.session_path):
+            path = self.session_path + name
+            if os.path.isdir(path):
+                files = [os.path.join(path, f) for f in os.listdir(path)]
+                size = sum([os.path.getsize(f) for f in files])
+                used = max([os.path.getmtime(f) for f in files], default=os.path.getmtime(path))
+            else:
+                size = os.path.getsize(path)
+                used = os.path.getmtime(path)
+            entries.append((used, size, path))
+        
+        total = sum([e[1] for e in entries])
+        for used, size, path in sorted(entries):
+            if total + reserve <= self.disk_quota:
+                break
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            total -= size
+    
     def sessionExists(self):
         """ Checks if a session exists.
         
@@ -124,16 +214,418 @@ class TempData:
         
         return self.__session_exists
     
+    def detachSession(self):
+        """ Detaches the current object from its session without deleting the associated temporary data. This should be used on copies of an object, for example those sent to worker processes, such that they do not delete the temporary data of the original object when they are destroyed.
+        """
+        
+        self.__session_exists = False
+        self.session_path = ""
+    
     def clearSessionData(self):
         """ Deletes temporary data associated with the current session. Should be called when an object is deleted ideally, to ensure the HDD is not filled with excessive amounts of data. In any case the OS should automatically delete temporary files at least following a power cycle.
         """
         
+        # Pending writes must complete before their directory is deleted, this is also called on deletion so failures are only reported
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception as e:
+                print("Warning: Writing temporary data failed: %s" % repr(e))
+            self.writer = None
+        
         # Should check this is safe really
         if self.__session_exists:
             shutil.rmtree(self.session_path)
             self.__session_exists = False
         self.part_count = 0
+        self.store_count = 0
         self.session_path = ""
 
+class AsyncWriter:
+    """ Runs write operations in a background thread, such that serialisation and disk I/O overlap with the computation that produces the data. Operations are run in the order they were submitted. The queue is bounded, such that submitting blocks while the writer is too far behind, which limits the memory held by queued data. An exception raised by an operation is raised again by the next call to :func:`submit` or :func:`flush`, after which the remaining queued operations are discarded.
+    
+    :param maxsize: The number of operations that can be queued.
+    :type maxsize: int, optional
+    """
+    
+    def __init__(self, maxsize=64):
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+    
+    def submit(self, func, *args):
+        """ Queues a write operation.
+        
+        :param func: The function to call in the background thread.
+        :type func: callable
+        
+        :param args: The arguments of the function.
+        :type args: object
+        
+        :raises Exception: If a previously queued operation failed.
+        
+        :return: None
+        """
+        self._raise_error()
+        self.queue.put((func, args))
+    
+    def flush(self):
+        """ Waits until all queued operations have completed.
+        
+        :raises Exception: If a queued operation failed.
+        
+        :return: None
+        """
+        self.queue.join()
+        self._raise_error()
+    
+    def close(self):
+        """ Waits until all queued operations have completed and stops the background thread.
+        
+        :raises Exception: If a queued operation failed.
+        
+        :return: None
+        """
+        self.queue.join()
+        self.queue.put(None)
+        self.thread.join()
+        self._raise_error()
+    
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    item[0](*item[1])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+    
+    def _raise_error(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise Exception("Asynchronous write failed: %s" % repr(error)) from error
+
+class SweepStore:
+    """ This class stores the results of the points of a parameter sweep in a directory, with one file per result column and a small JSON index. The results of each point are split into columns: numerical arrays of a fixed shape are appended to a raw binary file and are read back as memory-mapped arrays, such that selecting points does not require reading the other points, and the eigenvalues and eigenvectors of diagonalised evaluables are stored as separate numerical columns. Any other results are pickled into a single file per column, along with their offsets. Results are buffered and written in chunks.
+    
+    If the directory already contains a store, it is opened for reading.
+    
+    :param path: The directory of the store.
+    :type path: str
+    
+    :param chunk_size: The number of results to buffer before they are written.
+    :type chunk_size: int, optional
+    
+    :param writer: A writer used to write the chunks in the background, otherwise they are written immediately.
+    :type writer: :class:`AsyncWriter`, optional
+    """
+    
+    __index_name = "index.json"
+    
+    def __init__(self, path, chunk_size=256, writer=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.writer = writer
+        self.count = 0
+        self.keyed = None
+        self.entries = {}
+        self.columns = {}
+        self.order = None
+        self.sweep = None
+        self.__buffer = []
+        self.__maps = {}
+        
+        if os.path.isfile(self.path + self.__index_name):
+            with open(self.path + self.__index_name, "r") as fd:
+                index = json.load(fd)
+            self.count = index["count"]
+            self.keyed = index["keyed"]
+            self.entries = index["entries"]
+            self.columns = index["columns"]
+            self.order = None if index["order"] is None else np.array(index["order"], dtype=np.int64)
+            self.sweep = index["sweep"]
+        else:
+            os.makedirs(self.path, exist_ok=True)
+    
+    def __len__(self):
+        if self.order is not None:
+            return len(self.order)
+        return self.count + len(self.__buffer)
+    
+    def __getitem__(self, i):
+        return self.readPoints([i])[0]
+    
+    # Copies of the store are used to read it, the buffered results are not shared
+    def __getstate__(self):
+        self.flush()
+        self._wait()
+        state = self.__dict__.copy()
+        state["_SweepStore__maps"] = {}
+        state["writer"] = None
+        return state
+    
+    def setSweepSpec(self, sweep):
+        """ Records the swept parameters and their values in the index.
+        
+        :param sweep: A list of dictionaries with the parameter `name` and its `values`.
+        :type sweep: list
+        
+        :return: None
+        """
+        self.sweep = [{"name": s["name"], "values": np.asarray(s["values"], dtype=np.float64).tolist()} for s in sweep]
+    
+    def setOrder(self, order):
+        """ Sets the order in which the stored results are indexed, for when they were not stored in the order of the sweep grid.
+        
+        :param order: The position in the store of the result of each sweep point.
+        :type order: list, numpy.ndarray
+        
+        :return: None
+        """
+        self.order = np.asarray(order, dtype=np.int64)
+    
+    def appendPoint(self, point):
+        """ Appends the result of a sweep point, which is either the result of a single evaluable or a dictionary of the results of several.
+        
+        :param point: The result.
+        :type point: object, dict
+        
+        :raises Exception: If the result does not have the same structure as the previous ones.
+        
+        :return: The position of the result in the store.
+        :rtype: int
+        """
+        if self.keyed is None:
+            self.keyed = type(point) == dict
+        values = point if self.keyed else {"": point}
+        
+        # The column layout is set by the first result
+        if self.entries == {}:
+            for key, value in values.items():
+                self.entries[key] = self._get_entry_kind(value)
+                self._add_columns(key, value)
+        if set(values.keys()) != set(self.entries.keys()):
+            raise Exception("Sweep result does not contain the same evaluables as previous results.")
+        
+        self.__buffer.append(values)
+        if len(self.__buffer) >= self.chunk_size:
+            self.flush()
+        return len(self) - 1
+    
+    def flush(self):
+        """ Writes the buffered results to the column files and updates the index.
+        
+        :return: None
+        """
+        if len(self.__buffer) == 0:
+            return
+        
+        # The numerical columns are assembled here, the writing and pickling is done by the writer
+        blocks = {}
+        for name, col in self.columns.items():
+            rows = [self._get_column_value(values[col["entry"]], col["part"]) for values in self.__buffer]
+            if col["kind"] == "array":
+                block = np.empty((len(rows), *col["shape"]), dtype=col["dtype"])
+                for k, row in enumerate(rows):
+                    row = np.asarray(row)
+                    if row.shape != block.shape[1:]:
+                        raise Exception("Sweep result column '%s' has shape %s, expected %s." % (name, repr(row.shape), repr(block.shape[1:])))
+                    block[k] = row
+                blocks[name] = block
+            else:
+                blocks[name] = rows
+        self.count += len(self.__buffer)
+        self.__buffer = []
+        self.__maps = {}
+        self._submit(self._write_chunk, blocks, self._get_index())
+    
+    def close(self):
+        """ Writes any buffered results and waits until they are written, after which the store can be read.
+        
+        :raises Exception: If writing the results failed.
+        
+        :return: None
+        """
+        self.flush()
+        self._submit(self._write_index, self._get_index())
+        self._wait()
+    
+    def getColumn(self, name):
+        """ Gets a numerical column as a read-only memory-mapped array of shape (count, ...), in the order the results were stored.
+        
+        :param name: The column name, which is the evaluable name (empty for a single evaluable), followed by `/E` or `/V` for the eigenvalues and eigenvectors of diagonalised evaluables.
+        :type name: str
+        
+        :return: The column.
+        :rtype: numpy.memmap
+        """
+        col = self.columns[name]
+        if col["kind"] != "array":
+            raise Exception("Sweep result column '%s' is not numerical." % name)
+        self._wait()
+        if name not in self.__maps:
+            if self.count == 0:
+                return np.empty((0, *col["shape"]), dtype=col["dtype"])
+            self.__maps[name] = np.memmap(self.path + col["file"], dtype=col["dtype"], mode="r", shape=(self.count, *col["shape"]))
+        return self.__maps[name]
+    
+    def hasContiguousVectors(self, key=None):
+        """ Checks whether the eigenvectors of a diagonalised evaluable were stored as contiguous arrays, in which case they are read as complex arrays of shape (N, levels) instead of `Qobj` kets.
+        
+        :param key: The evaluable if several were stored.
+        :type key: str, optional
+        
+        :return: Whether the eigenvectors are contiguous.
+        :rtype: bool
+        """
+        name = ("" if key is None else key) + "/V"
+        return name in self.columns and self.columns[name]["dims"] is None
+    
+    def readPoints(self, indices, key=None):
+        """ Reads the results of a set of sweep points. Numerical results are returned as a single array, which is a view of the memory-mapped column if the points are contiguous.
+        
+        :param indices: The indices of the points in the sweep grid.
+        :type indices: list, numpy.ndarray, range
+        
+        :param key: The evaluable to read if several were stored, otherwise the results are returned as dictionaries.
+        :type key: str, optional
+        
+        :return: The results.
+        :rtype: numpy.ndarray, list
+        """
+        self.flush()
+        self._wait()
+        if not os.path.isfile(self.path + self.__index_name):
+            raise Exception("Sweep result store '%s' no longer exists, it may have been deleted to enforce the disk quota." % self.path)
+        
+        # Mark the store as recently used
+        os.utime(self.path + self.__index_name)
+        rows = np.asarray(indices, dtype=np.int64)
+        if self.order is not None:
+            rows = self.order[rows]
+        
+        if not self.keyed:
+            return self._read_entry("", rows)
+        if key is not None:
+            return self._read_entry(key, rows)
+        entries = {k: self._read_entry(k, rows) for k in self.entries}
+        return [{k: v[i] for k, v in entries.items()} for i in range(len(rows))]
+    
+    # Reads an entry at the given positions in the store
+    def _read_entry(self, key, rows):
+        if key not in self.entries:
+            raise Exception("Evaluable '%s' not found in sweep results." % key)
+        kind = self.entries[key]
+        if kind == "eigen":
+            E = self._read_column(key + "/E", rows)
+            V = self._read_column(key + "/V", rows)
+            dims = self.columns[key + "/V"]["dims"]
+            if dims is None:
+                return [(tuple(E[i]), V[i]) for i in range(len(rows))]
+            return [(tuple(E[i]), util.toQobjKets(V[i], dims)) for i in range(len(rows))]
+        return self._read_column(key, rows)
+    
+    # Reads a column at the given positions, as a view if they are contiguous
+    def _read_column(self, name, rows):
+        col = self.columns[name]
+        if col["kind"] == "array":
+            data = self.getColumn(name)
+            if len(rows) > 0 and np.all(np.diff(rows) == 1):
+                return data[rows[0]:rows[-1] + 1]
+            return data[rows]
+        offsets = np.fromfile(self.path + col["file"] + ".idx", dtype=np.int64)
+        result = []
+        with open(self.path + col["file"], "rb") as fd:
+            for r in rows:
+                fd.seek(offsets[r])
+                result.append(pickle.load(fd))
+        return result
+    
+    # Eigenvalues and eigenvectors are stored as separate columns, everything else in one column
+    def _get_entry_kind(self, value):
+        if type(value) in [tuple, list] and len(value) == 2 and isinstance(value[1], np.ndarray) and value[1].dtype == object and len(value[1]) > 0 and hasattr(value[1][0], "dims"):
+            return "eigen"
+        
+        # Contiguous eigenvectors are stored as the columns of a complex array
+        if type(value) in [tuple, list] and len(value) == 2 and isinstance(value[1], np.ndarray) and value[1].ndim == 2 and value[1].dtype.kind == "c" and len(value[0]) == value[1].shape[1]:
+            return "eigen"
+        return "value"
+    
+    def _add_columns(self, key, value):
+        if self.entries[key] == "eigen":
+            E = self._get_column_value(value, "E")
+            V = self._get_column_value(value, "V")
+            self._add_column(key + "/E", key, "E", "array", dtype=E.dtype.str, shape=list(E.shape))
+            dims = value[1][0].dims if value[1].dtype == object else None
+            self._add_column(key + "/V", key, "V", "array", dtype=V.dtype.str, shape=list(V.shape), dims=dims)
+            return
+        try:
+            a = np.asarray(value)
+        except ValueError:
+            a = None
+        if a is not None and a.dtype.kind in "biufc":
+            self._add_column(key, key, None, "array", dtype=a.dtype.str, shape=list(a.shape))
+        else:
+            self._add_column(key, key, None, "object")
+    
+    def _add_column(self, name, entry, part, kind, **meta):
+        self.columns[name] = dict(entry=entry, part=part, kind=kind, file="col%i.bin" % len(self.columns), **meta)
+    
+    def _get_column_value(self, value, part):
+        if part == "E":
+            return np.asarray(value[0], dtype=np.float64)
+        if part == "V":
+            if value[1].dtype != object:
+                return value[1]
+            return np.column_stack([ket.full()[:, 0] for ket in value[1]])
+        return value
+    
+    def _write_chunk(self, blocks, index):
+        for name, block in blocks.items():
+            col = self.columns[name]
+            if col["kind"] == "array":
+                with open(self.path + col["file"], "ab") as fd:
+                    block.tofile(fd)
+            else:
+                offsets = np.empty(len(block), dtype=np.int64)
+                with open(self.path + col["file"], "ab") as fd:
+                    for k, row in enumerate(block):
+                        offsets[k] = fd.tell()
+                        pickle.dump(row, fd)
+                with open(self.path + col["file"] + ".idx", "ab") as fd:
+                    offsets.tofile(fd)
+        self._write_index(index)
+    
+    # The index is serialised when it is submitted, such that it matches the data written before it
+    def _get_index(self):
+        return json.dumps({
+            "count": self.count,
+            "keyed": self.keyed,
+            "entries": self.entries,
+            "columns": self.columns,
+            "order": None if self.order is None else self.order.tolist(),
+            "sweep": self.sweep
+        })
+    
+    def _write_index(self, index):
+        with open(self.path + self.__index_name, "w") as fd:
+            fd.write(index)
+    
+    def _submit(self, func, *args):
+        if self.writer is None:
+            func(*args)
+        else:
+            self.writer.submit(func, *args)
+    
+    def _wait(self):
+        if self.writer is not None:
+            self.writer.flush()
+
 class ProjectData:
     pass
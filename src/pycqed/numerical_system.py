@@ -4,6 +4,8 @@ import sympy as sy
 import scipy as sc
 import networkx as nx
 import time
+import concurrent.futures as cf
+from collections import OrderedDict
 
 from . import dataspec as ds
 from . import symbolic_system as cs
@@ -45,6 +47,12 @@ class NumericalSystem(ds.TempData):
         # Load default diagonaliser configuration
         self.setDiagConfig()
         
+        # Load default Hamiltonian assembly configuration
+        self.setHamiltonianConfig()
+        
+        # Load default sweep result storage configuration
+        self.setStorageConfig()
+        
         # Init the sweeper data
         self._init_sweep_data()
         
@@ -55,6 +63,17 @@ class NumericalSystem(ds.TempData):
     def __del__(self):
         self.clearSessionData()
     
+    # Called when pickling, the compiled sweep expressions and matrix-free Hamiltonians cannot be pickled but are not required by copies
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['sweep_func'] = None
+        if isinstance(state.get('Ht'), sc.sparse.linalg.LinearOperator):
+            state['Ht'] = None
+        state['diag_workspace'] = None
+        state['sweep_store'] = None
+        state['writer'] = None
+        return state
+    
     def getNodeList(self):
         return self.SS.nodes
     
@@ -161,7 +180,6 @@ class NumericalSystem(ds.TempData):
         S = None
         Sdag = None
         basis = self.operator_data[node]["basis"]
-        # FIXME: Determine if we need to generate all the operators for this node
         
         if basis == "charge":
             return self._get_charge_basis(node)
@@ -177,7 +195,7 @@ class NumericalSystem(ds.TempData):
     
     ## Expand operator Hilbert spaces and update mapping to associated symbols
     def getExpandedOperatorsMap(self, nodes=None):
-        """ Creates all the operators associated with each node in the currently defined circuit. The operators are expanded into the total Hamiltonian Hilbert space.
+        """ Creates all the operators associated with each node in the currently defined circuit. The operators are expanded into the total Hamiltonian Hilbert space when they are first accessed, such that operators that are not used, for example the phase-slip displacement operators of a circuit without phase-slip elements, are never expanded.
         
         :return: None
         """
@@ -185,66 +203,52 @@ class NumericalSystem(ds.TempData):
         # Get the pos list for indexing the DoFs
         node_list = self.getNodeList()
         
-        # Generate the Hilbert space expanders
-        Ilist = np.empty([len(node_list)], dtype=np.dtype(qt.Qobj))
-        for i, node in enumerate(node_list):
+        # The expanded operators depend on the configuration of all nodes
+        if nodes is None:
+            self.osc_cache.clear()
+            self.osc_impedances = {}
+            self.expansion_cache = {}
+        
+        # Get the dimensions of the Hilbert spaces of the nodes
+        dims = []
+        for node in node_list:
             trunc = self.operator_data[node]["truncation"]
-            basis = self.operator_data[node]["basis"]
-            if basis == "oscillator":
-                Ilist[i] = qt.qeye(trunc)
-            elif basis == "charge":
-                Ilist[i] = qt.qeye(2*trunc + 1)
+            if self.operator_data[node]["basis"] == "oscillator":
+                dims.append(trunc)
+            else:
+                dims.append(2*trunc + 1)
         
         # Create mode operators
-        Olist = np.empty([len(node_list)], dtype=np.dtype(qt.Qobj))
-        op_dict = {}
         for i, node in enumerate(node_list):
             # Ignore nodes that are not in the list, if provided
             if nodes is not None:
                 if node not in nodes:
                     continue
             
-            op_dict = {}
-            trunc = self.operator_data[node]["truncation"]
             basis = self.operator_data[node]["basis"]
-            Q, P, D, Ddag, S, Sdag = self.getOperatorList(node)
             
-            # Indices minus the current index
-            indices = list(range(len(node_list)))
-            indices.remove(i)
-            
-            # Current index is the operator
-            Olist[i] = Q
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["charge"] = qt.tensor(Olist)
-            
-            Olist[i] = P
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["flux"] = qt.tensor(Olist)
-            
-            Olist[i] = D
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["disp"] = qt.tensor(Olist)
-            
-            Olist[i] = Ddag
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["disp_adj"] = qt.tensor(Olist)
-            
-            Olist[i] = S
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["pdisp"] = qt.tensor(Olist)
+            # Reuse the expanded oscillator operators of a previously used impedance
+            if basis == "oscillator":
+                key = (node, self.getParameterValue("Zosc%i" % node))
+                self.osc_impedances[node] = key[1]
+                if key in self.osc_cache:
+                    self.osc_cache.move_to_end(key)
+                    self.circ_operators[node] = self.osc_cache[key]
+                    continue
             
-            Olist[i] = Sdag
-            for j in indices:
-                Olist[j] = Ilist[j]
-            op_dict["pdisp_adj"] = qt.tensor(Olist)
+            self.circ_operators[node] = _ExpandedOperators(self.getOperatorList(node), dims, i, self.expansion_cache)
             
-            self.circ_operators[node] = op_dict.copy()
+            # Cache the operators with least recently used eviction
+            if basis == "oscillator" and self.hamiltonian_config['osc_cache_size'] > 0:
+                self.osc_cache[key] = self.circ_operators[node]
+                while len(self.osc_cache) > self.hamiltonian_config['osc_cache_size']:
+                    self.osc_cache.popitem(last=False)
+        
+        # Any compiled Hamiltonian and operator vectors now refer to stale operators
+        self.H_template = None
+        self.H_kron = None
+        self.Qnp = None
+        self.Pnp = None
     
     ###################################################################################################################
     #       Hamiltonian Building Functions
@@ -290,13 +294,34 @@ class NumericalSystem(ds.TempData):
         self.Pbm = self.SS.getFluxBiasMatrix(mode="branch")
         self.Pbi = self.SS.getFluxBiasVectorInd()
         
+        # Node coordinates and signs that constitute each branch
+        self.branch_nodes = self._get_branch_nodes()
+        
         # Basis representation prefactors
         #self.Zpref = self.getBasisPrefactors()
     
     def prepareOperators(self):
         self.getExpandedOperatorsMap()
-        self.getChargeOpVector()
-        self.getFluxOpVector()
+    
+    @property
+    def Qnp(self):
+        if getattr(self, "_Qnp", None) is None:
+            self.getChargeOpVector()
+        return self._Qnp
+    
+    @Qnp.setter
+    def Qnp(self, value):
+        self._Qnp = value
+    
+    @property
+    def Pnp(self):
+        if getattr(self, "_Pnp", None) is None:
+            self.getFluxOpVector()
+        return self._Pnp
+    
+    @Pnp.setter
+    def Pnp(self, value):
+        self._Pnp = value
     
     ###################################################################################################################
     #       Numerical Hamiltonian Generation
@@ -358,13 +383,21 @@ class NumericalSystem(ds.TempData):
         self.Pbm_pre = self.SS.getFluxBiasMatrix(mode="branch").subs(subs)
         self.Pbi_pre = self.SS.getFluxBiasVectorInd().subs(subs)
         
+        # Compile the remaining expressions and evaluate them over the whole sweep grid
+        self._compile_sweep_expressions()
+        self.sweep_values = self._evaluate_sweep_expressions(self.SS.sweep_grid_c)
+        
         # Find which operators will need to be regenerated for each sweep
         self._get_regen_coordinate_nodes()
+        
+        # Decompose the Hamiltonian into fixed terms if the operators will not change during the sweep
+        self.H_template = None
+        if self.hamiltonian_config['compiled'] and not self.hamiltonian_config['matrix_free'] and self.regen_nodes == []:
+            self._compile_hamiltonian()
+            self._set_static_terms(self._get_varying_terms())
     
     def _get_regen_coordinate_nodes(self):
         
-        # FIXME: Could identify the precise parameter and where they occur in the sweep to only regenerate when necessary rather than every iteration. This would require _postsub to know which iteration we are at.
-        
         # Get the parameters that are being swept
         sweep_syms = set(self.SS.getSweepParametersDict().keys())
         
@@ -378,49 +411,399 @@ class NumericalSystem(ds.TempData):
             if not data["impedance"].free_symbols.isdisjoint(sweep_syms):
                 self.regen_nodes.append(node)
     
-    def _postsub(self, params):
-    
-        # Set the parameter values
-        self.SS.setParameterValues(params)
+    def _compile_sweep_expressions(self):
+        """ Compiles the pre-substituted expressions into a single numerical function of the swept parameters using `sympy.lambdify` with common subexpression elimination. The parametric parameters that depend on the swept parameters are expanded in terms of them, and their values are compiled as well, such that no symbolic substitutions are required in the sweep loop.
+        
+        :return: None
+        """
+        nonsweep = self.SS.getNonSweepParametersDict()
+        self.sweep_names = list(self.SS.sweep_grid_params)
+        sweep_syms = [self.SS.getSymbol(name) for name in self.sweep_names]
+        
+        # Expand the parametric parameters that depend on the swept ones
+        param_exprs = {}
+        self.sweep_parametric = []
+        for sym in self.SS.getSweepParametersDict().keys():
+            if sym in sweep_syms:
+                continue
+            name = self.SS.getParameterFromSymbol(sym)
+            param_exprs[sym] = self.SS.getParametricExpression(name, expand=True).subs(nonsweep)
+            self.sweep_parametric.append(name)
+        
+        # Flatten all expressions into a single list while keeping track of their shapes
+        exprs = {
+            "Cinv": self.Cinv_pre,
+            "Linv": self.Linv_pre,
+            "Linv_b": self.Linv_b_pre,
+            "Jvec": self.Jvec_pre,
+            "Pvec": self.Pvec_pre,
+            "Qb": self.Qb_pre,
+            "Qbt": self.Qbt_pre,
+            "Pbm": self.Pbm_pre,
+            "Pbi": self.Pbi_pre
+        }
+        flat = []
+        self.sweep_layout = {}
+        self.sweep_dependent = {}
+        for k, M in exprs.items():
+            M = M.subs(param_exprs)
+            self.sweep_layout[k] = (M.shape, len(flat), len(flat) + len(M))
+            self.sweep_dependent[k] = np.array([not e.free_symbols.isdisjoint(sweep_syms) for e in M], dtype=bool).reshape(M.shape)
+            flat.extend(list(M))
+        for name in self.sweep_parametric:
+            self.sweep_layout[name] = ((), len(flat), len(flat) + 1)
+            flat.append(param_exprs[self.SS.getSymbol(name)])
+        
+        self.sweep_func = sy.lambdify(sweep_syms, flat, modules="numpy", cse=True)
+    
+    def _evaluate_sweep_expressions(self, grid):
+        """ Evaluates the compiled expressions over a set of sweep points in a single call.
+        
+        :param grid: Dictionary of equal length arrays (or scalars) of values keyed by swept parameter name.
+        :type grid: dict
+        
+        :return: Dictionary of stacked arrays of shape (Npts, ...) keyed by expression name.
+        :rtype: dict
+        """
+        args = [np.atleast_1d(np.asarray(grid[name], dtype=np.float64)) for name in self.sweep_names]
+        npts = len(args[0])
+        flat = self.sweep_func(*args)
+        flat = np.array([np.broadcast_to(np.asarray(v, dtype=np.float64), (npts,)) for v in flat]).T
+        
+        values = {}
+        for k, layout in self.sweep_layout.items():
+            shape, start, stop = layout
+            values[k] = flat[:, start:stop].reshape(npts, *shape)
+        
+        # Exponentiated flux and charge biases
+        Pbm = np.diagonal(values["Pbm"], axis1=1, axis2=2)
+        values["Pexp_p"] = np.exp(2j*np.pi*Pbm)
+        values["Pexp_m"] = np.exp(-2j*np.pi*Pbm)
+        Qbt = values["Qbt"][:, :, 0]
+        values["Qexp_p"] = np.exp(2j*np.pi*Qbt)
+        values["Qexp_m"] = np.exp(-2j*np.pi*Qbt)
+        return values
+    
+    def _postsub(self, params, index=None, operators=None):
+        
+        # Get the numerical values, either precomputed for the sweep grid or computed for this point only
+        if index is not None:
+            values = {k: v[index] for k, v in self.sweep_values.items()}
+        else:
+            values = {k: v[0] for k, v in self._evaluate_sweep_expressions(params).items()}
         
-        # Get the subs
-        subs = self.SS.getSweepParametersDict()
+        # Set the parameter values, including those of the dependent parametric parameters
+        point = {name: float(values[name]) for name in self.sweep_parametric}
+        point.update({name: float(params[name]) for name in self.sweep_names})
+        self.SS._set_sweep_values(point)
         
         # Substitute circuit parameters
-        self.Cinvnp = np.asmatrix(self.Cinv_pre.subs(subs), dtype=np.float64)
-        self.Linvnp = np.asmatrix(self.Linv_pre.subs(subs), dtype=np.float64)
-        self.Jvecnp = np.asarray(self.Jvec_pre.subs(subs), dtype=np.float64)[:, 0]
-        self.Pvecnp = np.asarray(self.Pvec_pre.subs(subs), dtype=np.float64)[:, 0]
-        self.Linvnp_b = np.asmatrix(self.Linv_b_pre.subs(subs), dtype=np.float64)
+        self.Cinvnp = np.asmatrix(values["Cinv"])
+        self.Linvnp = np.asmatrix(values["Linv"])
+        self.Jvecnp = values["Jvec"][:, 0]
+        self.Pvecnp = values["Pvec"][:, 0]
+        self.Linvnp_b = np.asmatrix(values["Linv_b"])
         
         # Substitute external biases
-        self.Qbnp = np.asmatrix(self.Qb_pre.subs(subs), dtype=np.float64) # x 2e
-        self.Qbtnp = np.asmatrix(self.Qbt_pre.subs(subs), dtype=np.float64) # x 2e
-        self.Pbsm = np.asmatrix(self.Pbm_pre.subs(subs), dtype=np.float64)
-        #self.Pbnp = np.asmatrix(self.Pb_pre.subs(subs), dtype=np.float64) # x Phi0
-        self.Pbinp = np.asmatrix(self.Pbi_pre.subs(subs), dtype=np.float64)
+        self.Qbnp = np.asmatrix(values["Qb"]) # x 2e
+        self.Qbtnp = np.asmatrix(values["Qbt"]) # x 2e
+        self.Pbsm = np.asmatrix(values["Pbm"])
+        self.Pbinp = np.asmatrix(values["Pbi"])
+        
+        # Exponentiated flux and charge biases
+        self.Pexp_pnp = values["Pexp_p"]
+        self.Pexp_mnp = values["Pexp_m"]
+        self.Qexp_pnp = values["Qexp_p"]
+        self.Qexp_mnp = values["Qexp_m"]
+        
+        # Regenerate operators only for the nodes whose impedance changed since the last point
+        if self.regen_nodes != []:
+            nodes = [node for node in self.regen_nodes if self.osc_impedances.get(node) != self.getParameterValue("Zosc%i" % node)]
+            if nodes != [] and operators is not None:
+                self._restore_expanded_operators({node: operators[node] for node in nodes})
+            elif nodes != []:
+                self.getExpandedOperatorsMap(nodes)
+    
+    # Reinstates the expanded operators of regenerated nodes kept from an earlier substitution of the current point
+    def _restore_expanded_operators(self, operators):
+        for node, ops in operators.items():
+            self.circ_operators[node] = ops
+            self.osc_impedances[node] = self.getParameterValue("Zosc%i" % node)
+        
+        # Anything derived from the replaced operators is stale
+        self.H_template = None
+        self.H_kron = None
+        self.Qnp = None
+        self.Pnp = None
+    
+    ###################################################################################################################
+    #       Compiled Hamiltonian Template
+    ###################################################################################################################
+    
+    def _get_hamiltonian_terms(self):
+        """ Decomposes the Hamiltonian into terms that are Kronecker products of the local operators of the nodes. The charging and inductive terms are expanded into the quadratic, linear and constant parts in the node operators, and the Josephson and phase-slip terms into the products of displacement operators of each branch. The symbolic system matrices are used to discard terms that are identically zero.
         
-        # Generate exponentiated flux biases
-        Pexp1 = []
-        Pexp2 = []
-        for i in range(self.Pbsm.shape[0]):
-            Pexp1.append(np.exp(2j*np.pi*self.Pbsm[i, i]))
-            Pexp2.append(np.exp(-2j*np.pi*self.Pbsm[i, i]))
-        self.Pexp_pnp = Pexp1
-        self.Pexp_mnp = Pexp2
+        :return: The term descriptors (kind, i, j), and for each term a dictionary of local sparse factors keyed by node position, where nodes without a factor are acted upon by the identity.
+        :rtype: (list, list)
+        """
+        node_list = self.getNodeList()
+        Nn = len(node_list)
+        local = [self.circ_operators[node].operators for node in node_list]
+        Q = [sc.sparse.csr_matrix(op["charge"].data) for op in local]
+        P = [sc.sparse.csr_matrix(op["flux"].data) for op in local]
+        
+        # Term descriptors and the associated factors
+        terms = []
+        factors = []
+        
+        # Quadratic terms
+        for i in range(Nn):
+            for j in range(i, Nn):
+                if self.Cinv[i, j] != 0:
+                    terms.append(("QQ", i, j))
+                    factors.append({i: Q[i]*Q[i]} if i == j else {i: Q[i], j: Q[j]})
+                if self.Linv[i, j] != 0:
+                    terms.append(("PP", i, j))
+                    factors.append({i: P[i]*P[i]} if i == j else {i: P[i], j: P[j]})
+        
+        # Linear terms due to the bias offsets
+        CinvQb = self.Cinv*self.Qb
+        LinvPbi = self.Linv*self.Pbi
+        for i in range(Nn):
+            if CinvQb[i] != 0:
+                terms.append(("Q", i, i))
+                factors.append({i: Q[i]})
+            if LinvPbi[i] != 0:
+                terms.append(("P", i, i))
+                factors.append({i: P[i]})
+        
+        # Constant term
+        terms.append(("I", 0, 0))
+        factors.append({})
+        
+        # Josephson and phase-slip terms
+        for i, edge in enumerate(self.SS.edges):
+            for vec, key, kind in [(self.Jvec, "disp", "J"), (self.Pvec, "pdisp", "S")]:
+                if vec[i] == 0:
+                    continue
+                prod1 = {}
+                prod2 = {}
+                for node, sign in self.branch_nodes[i]:
+                    k = node_list.index(node)
+                    if sign > 0:
+                        prod1[k] = sc.sparse.csr_matrix(local[k][key].data)
+                        prod2[k] = sc.sparse.csr_matrix(local[k][key + "_adj"].data)
+                    else:
+                        prod1[k] = sc.sparse.csr_matrix(local[k][key + "_adj"].data)
+                        prod2[k] = sc.sparse.csr_matrix(local[k][key].data)
+                terms.extend([(kind + "+", i, i), (kind + "-", i, i)])
+                factors.extend([prod1, prod2])
         
-        # Generate exponentiated charge biases
-        Qexp1 = []
-        Qexp2 = []
-        for i in range(self.Qbtnp.shape[0]):
-            Qexp1.append(np.exp(2j*np.pi*self.Qbtnp[i, 0]))
-            Qexp2.append(np.exp(-2j*np.pi*self.Qbtnp[i, 0]))
-        self.Qexp_pnp = Qexp1
-        self.Qexp_mnp = Qexp2
+        return terms, factors
+    
+    def _compile_hamiltonian(self):
+        """ Expands the Hamiltonian terms into fixed sparse matrices of the total Hilbert space, such that the Hamiltonian can be assembled as their weighted sum. The Hamiltonian is stored with the union sparsity pattern of all terms, and a sparse matrix maps the term coefficients to the elements of its data array, such that each assembly is a single sparse product written into the existing data array. Terms whose local factors are all diagonal, such as the charging terms in the charge basis, are instead stored as the rows of a dense array of diagonals and added to the diagonal of the Hamiltonian.
         
-        # Regenerate operators if required
-        if self.regen_nodes != []:
-            self.getExpandedOperatorsMap(self.regen_nodes)
+        :return: None
+        """
+        terms, factors = self._get_hamiltonian_terms()
+        dims = [self.circ_operators[node].operators["charge"].shape[0] for node in self.getNodeList()]
+        N = int(np.prod(dims))
+        
+        # Diagonal terms are the Kronecker products of the local diagonals
+        diag = np.zeros(len(terms), dtype=bool)
+        diags = []
+        for k, term in enumerate(factors):
+            local = {n: util.sparseDiagonal(F) for n, F in term.items()}
+            if any(d is None for d in local.values()):
+                continue
+            diag[k] = True
+            d = np.ones(1, dtype=np.complex128)
+            for n, dim in enumerate(dims):
+                d = np.kron(d, local.get(n, np.ones(dim)))
+            diags.append(d)
+        
+        # Expand each remaining term with identities on the remaining nodes
+        ops = []
+        for term in [f for f, d in zip(factors, diag) if not d]:
+            M = None
+            for k, d in enumerate(dims):
+                F = term.get(k, sc.sparse.identity(d, dtype=np.complex128, format="csr"))
+                M = F if M is None else sc.sparse.kron(M, F, format="csr")
+            M.sum_duplicates()
+            ops.append(M)
+        
+        # Union sparsity pattern of the terms, which always includes the diagonal
+        pattern = sc.sparse.identity(N, format="csr")
+        for op in ops:
+            pattern = pattern + sc.sparse.csr_matrix((np.ones(op.nnz), op.indices, op.indptr), shape=op.shape)
+        pattern.sum_duplicates()
+        keys = np.repeat(np.arange(N, dtype=np.int64), np.diff(pattern.indptr))*N + pattern.indices
+        
+        # Map from the term coefficients to the data array of the union pattern
+        pos = []
+        for op in ops:
+            pos.append(np.searchsorted(keys, np.repeat(np.arange(N, dtype=np.int64), np.diff(op.indptr))*N + op.indices))
+        if len(ops) > 0:
+            cols = np.concatenate([np.full(op.nnz, k) for k, op in enumerate(ops)])
+            W = sc.sparse.csr_matrix((np.concatenate([op.data for op in ops]), (np.concatenate(pos), cols)), shape=(pattern.nnz, len(ops)))
+        else:
+            W = sc.sparse.csr_matrix((pattern.nnz, 0), dtype=np.complex128)
+        
+        self.H_template = {
+            "terms": terms,
+            "W": W,
+            "diag": diag,
+            "D": np.array(diags, dtype=np.complex128).reshape(len(diags), N),
+            "diag_pos": np.searchsorted(keys, np.arange(N, dtype=np.int64)*(N + 1)),
+            "H": qt.Qobj(pattern.astype(np.complex128), dims=[dims, dims], isherm=True),
+            "kinds": np.array([t[0] for t in terms]),
+            "i": np.array([t[1] for t in terms], dtype=int),
+            "j": np.array([t[2] for t in terms], dtype=int),
+            "dims": [dims, dims]
+        }
+        self._set_static_terms()
+    
+    def _get_varying_terms(self):
+        """ Determines which compiled Hamiltonian terms have coefficients that depend on the swept parameters, from the symbolic dependence of the pre-substituted expressions. For example, in a sweep of an external flux only the Josephson terms of the biased branches vary, and in a sweep of a gate charge only the linear charge terms and the constant term vary.
+        
+        :return: Boolean mask of the varying terms.
+        :rtype: numpy.ndarray
+        """
+        T = self.H_template
+        kinds = T["kinds"]
+        i = T["i"]
+        j = T["j"]
+        dep = self.sweep_dependent
+        Cinv = dep["Cinv"]
+        Linv = dep["Linv"]
+        Qb = dep["Qb"].any()
+        Pbi = dep["Pbi"].any()
+        
+        varying = np.zeros(len(kinds), dtype=bool)
+        m = kinds == "QQ"
+        varying[m] = Cinv[i[m], j[m]]
+        m = kinds == "PP"
+        varying[m] = Linv[i[m], j[m]]
+        m = kinds == "Q"
+        varying[m] = Cinv[i[m]].any(axis=1) | Qb
+        m = kinds == "P"
+        varying[m] = Linv[i[m]].any(axis=1) | Pbi
+        m = kinds == "I"
+        varying[m] = Cinv.any() | Linv.any() | Qb | Pbi
+        m = (kinds == "J+") | (kinds == "J-")
+        varying[m] = dep["Jvec"][i[m], 0] | np.diagonal(dep["Pbm"])[i[m]]
+        m = (kinds == "S+") | (kinds == "S-")
+        varying[m] = dep["Pvec"][i[m], 0] | dep["Qbt"][i[m], 0]
+        return varying
+    
+    def _set_static_terms(self, varying=None):
+        """ Splits the compiled Hamiltonian terms into those whose coefficients vary and those that are fixed. The fixed terms are summed once, when the Hamiltonian is next assembled, after which each assembly only adds the varying terms to the stored sum.
+        
+        :param varying: Boolean mask of the varying terms, defaults to all terms.
+        :type varying: numpy.ndarray, optional
+        
+        :return: None
+        """
+        T = self.H_template
+        if varying is None:
+            varying = np.ones(len(T["terms"]), dtype=bool)
+        diag = T["diag"]
+        T["varying"] = varying
+        T["Wv"] = T["W"][:, np.nonzero(varying[~diag])[0]].tocsr()
+        T["Dv"] = T["D"][varying[diag]]
+        T["static"] = None
+    
+    def _compile_hamiltonian_operator(self):
+        """ Stores the Hamiltonian terms as per-node factors for use with the matrix-free Hamiltonian.
+        
+        :return: None
+        """
+        terms, factors = self._get_hamiltonian_terms()
+        self.H_kron = {
+            "terms": terms,
+            "factors": factors,
+            "kinds": np.array([t[0] for t in terms]),
+            "i": np.array([t[1] for t in terms], dtype=int),
+            "j": np.array([t[2] for t in terms], dtype=int),
+            "dims": [self.circ_operators[node].operators["charge"].shape[0] for node in self.getNodeList()]
+        }
+    
+    def _get_hamiltonian_coefficients(self, T=None):
+        """ Evaluates the coefficients of the compiled Hamiltonian terms using the currently substituted numerical parameters.
+        
+        :param T: The compiled terms, defaults to the compiled Hamiltonian template.
+        :type T: dict, optional
+        
+        :return: The coefficient vector, ordered as the compiled term matrices.
+        :rtype: numpy.ndarray
+        """
+        if T is None:
+            T = self.H_template
+        kinds = T["kinds"]
+        i = T["i"]
+        j = T["j"]
+        Ec = self.units.getPrefactor("Ec")
+        El = self.units.getPrefactor("El")
+        Ej = self.units.getPrefactor("Ej")
+        Ep = self.units.getPrefactor("Ep")
+        
+        Cinv = np.asarray(self.Cinvnp)
+        Linv = np.asarray(self.Linvnp)
+        Qb = np.asarray(self.Qbnp)[:, 0]
+        Pbi = np.asarray(self.Pbinp)[:, 0]
+        Jvec = np.asarray(self.Jvecnp)
+        Pvec = np.asarray(self.Pvecnp)
+        
+        # Off-diagonal quadratic terms appear twice in the symmetric quadratic form
+        sym = np.where(i == j, 0.5, 1.0)
+        coefs = np.zeros(len(kinds), dtype=np.complex128)
+        m = kinds == "QQ"
+        coefs[m] = Ec*sym[m]*Cinv[i[m], j[m]]
+        m = kinds == "PP"
+        coefs[m] = El*sym[m]*Linv[i[m], j[m]]
+        m = kinds == "Q"
+        coefs[m] = Ec*np.dot(Cinv, Qb)[i[m]]
+        m = kinds == "P"
+        coefs[m] = El*np.dot(Linv, Pbi)[i[m]]
+        m = kinds == "I"
+        coefs[m] = 0.5*Ec*np.dot(Qb, np.dot(Cinv, Qb)) + 0.5*El*np.dot(Pbi, np.dot(Linv, Pbi))
+        
+        # Josephson and phase-slip terms include the external bias phases
+        m = kinds == "J+"
+        coefs[m] = -0.5*Ej*Jvec[i[m]]*np.array(self.Pexp_pnp)[i[m]]
+        m = kinds == "J-"
+        coefs[m] = -0.5*Ej*Jvec[i[m]]*np.array(self.Pexp_mnp)[i[m]]
+        m = kinds == "S+"
+        coefs[m] = -0.5*Ep*Pvec[i[m]]*np.array(self.Qexp_pnp)[i[m]]
+        m = kinds == "S-"
+        coefs[m] = -0.5*Ep*Pvec[i[m]]*np.array(self.Qexp_mnp)[i[m]]
+        return coefs
+    
+    def _get_compiled_hamiltonian(self):
+        """ Assembles the Hamiltonian as the weighted sum of the compiled term matrices, by overwriting the data array of the stored Hamiltonian. The sum of the fixed terms is computed once and only the varying terms are added to it, see :func:`_set_static_terms`. During parameter sweeps the stored Hamiltonian itself is returned, otherwise a copy is returned such that previously returned Hamiltonians are not modified.
+        
+        :return: The Hamiltonian.
+        :rtype: qutip.qobj.Qobj
+        """
+        T = self.H_template
+        coefs = self._get_hamiltonian_coefficients()
+        H = T["H"]
+        diag = T["diag"]
+        varying = T["varying"]
+        
+        # Sum of the fixed terms
+        if T["static"] is None:
+            fixed = np.where(varying, 0, coefs)
+            T["static"] = T["W"].dot(fixed[~diag])
+            T["static"][T["diag_pos"]] += fixed[diag].dot(T["D"])
+        
+        H.data.data[:] = T["static"]
+        H.data.data[:] += T["Wv"].dot(coefs[varying & ~diag])
+        H.data.data[T["diag_pos"]] += coefs[varying & diag].dot(T["Dv"])
+        if self.H_inplace:
+            return H
+        return H.copy()
     
     ###################################################################################################################
     #       Evaluables
@@ -437,16 +820,21 @@ class NumericalSystem(ds.TempData):
     }
     
     def getHamiltonian(self):
+        # Use the matrix-free representation if requested
+        if self.hamiltonian_config['matrix_free']:
+            self.Ht = self.getHamiltonianOperator()
+            return self.Ht
+        
+        # Use the compiled template if available
+        if self.H_template is not None:
+            self.Ht = self._get_compiled_hamiltonian()
+            return self.Ht
+        
         # Get charging energy
-        self.Hq = self.units.getPrefactor("Ec")*0.5*\
-        util.mdot((self.Qnp + self.Qbnp).T, self.Cinvnp, self.Qnp + self.Qbnp)[0, 0]
+        self.Hq = self.units.getPrefactor("Ec")*self._get_quadratic_energy("charge", self.Cinvnp, self.Qbnp)
         
         # Get flux energy
-        self.Hf = self.units.getPrefactor("El")*0.5*\
-        util.mdot((self.Pnp + self.Pbinp).T, self.Linvnp, self.Pnp + self.Pbinp)[0, 0]
-        
-        # Need the branch DoFs in the possibly transformed representation
-        Pp = self.SS.Rnb*self.SS.Rinv*self.SS.node_vector
+        self.Hf = self.units.getPrefactor("El")*self._get_quadratic_energy("flux", self.Linvnp, self.Pbinp)
         
         # Get the Josephson energy
         self.Hj = 0
@@ -454,34 +842,8 @@ class NumericalSystem(ds.TempData):
             if self.Jvecnp[i] == 0.0:
                 continue
             
-            prod1 = self.Pexp_pnp[i]
-            prod2 = self.Pexp_mnp[i]
-            if len(Pp[i].atoms()) > 2: # Case where there is sum of elements
-                # Left
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] > 0:
-                        prod1 *= self.circ_operators[node]["disp"]
-                    else:
-                        prod1 *= self.circ_operators[node]["disp_adj"]
-                
-                # Right
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] < 0:
-                        prod2 *= self.circ_operators[node]["disp"]
-                    else:
-                        prod2 *= self.circ_operators[node]["disp_adj"]
-            else:
-                node = self.SS.node_map_rev[Pp[i].args[1]]
-                if Pp[i].args[0] > 0:
-                    prod1 *= self.circ_operators[node]["disp"]
-                    prod2 *= self.circ_operators[node]["disp_adj"]
-                else:
-                    prod1 *= self.circ_operators[node]["disp_adj"]
-                    prod2 *= self.circ_operators[node]["disp"]
-        
-            self.Hj += -0.5*self.Jvecnp[i]*(prod1 + prod2)
+            prod1, prod2 = self._get_branch_displacements(i, "disp")
+            self.Hj += -0.5*self.Jvecnp[i]*(self.Pexp_pnp[i]*prod1 + self.Pexp_mnp[i]*prod2)
         self.Hj *= self.units.getPrefactor("Ej")
         
         # Get the Phaseslip energy
@@ -490,40 +852,66 @@ class NumericalSystem(ds.TempData):
             if self.Pvecnp[i] == 0.0:
                 continue
             
-            prod1 = self.Qexp_pnp[i]
-            prod2 = self.Qexp_mnp[i]
-            if len(Pp[i].atoms()) > 2: # Case where there is sum of elements
-                # Left
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] > 0:
-                        prod1 *= self.circ_operators[node]["pdisp"]
-                    else:
-                        prod1 *= self.circ_operators[node]["pdisp_adj"]
-                
-                # Right
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] < 0:
-                        prod2 *= self.circ_operators[node]["pdisp"]
-                    else:
-                        prod2 *= self.circ_operators[node]["pdisp_adj"]
-            else:
-                node = self.SS.node_map_rev[Pp[i].args[1]]
-                if Pp[i].args[0] > 0:
-                    prod1 *= self.circ_operators[node]["pdisp"]
-                    prod2 *= self.circ_operators[node]["pdisp_adj"]
-                else:
-                    prod1 *= self.circ_operators[node]["pdisp_adj"]
-                    prod2 *= self.circ_operators[node]["pdisp"]
-        
-            self.Hp += -0.5*self.Pvecnp[i]*(prod1 + prod2)
+            prod1, prod2 = self._get_branch_displacements(i, "pdisp")
+            self.Hp += -0.5*self.Pvecnp[i]*(self.Qexp_pnp[i]*prod1 + self.Qexp_mnp[i]*prod2)
         self.Hp *= self.units.getPrefactor("Ep")
         
         # Total Hamiltonian
         self.Ht = (self.Hq + self.Hf + self.Hj + self.Hp)
         return self.Ht
     
+    def _get_quadratic_energy(self, key, A, b):
+        r""" Evaluates the quadratic form :math:`\frac{1}{2}(O + b)^T A (O + b)` of the charge or flux operators of the nodes. Pairs of nodes whose local operators are both diagonal, such as the charge operators in the charge basis, are evaluated as a single broadcasted expression over the grid of their eigenvalues and placed on the diagonal directly, such that only the remaining pairs use products of the expanded operators.
+        
+        :param key: The operator type, either `charge` or `flux`.
+        :type key: str
+        
+        :param A: The matrix of the quadratic form.
+        :type A: numpy.matrix
+        
+        :param b: The offset vector.
+        :type b: numpy.matrix
+        
+        :return: The energy operator.
+        :rtype: qutip.qobj.Qobj
+        """
+        node_list = self.getNodeList()
+        local = [self.circ_operators[node].operators[key] for node in node_list]
+        dims = [op.shape[0] for op in local]
+        A = np.asarray(A)
+        b = np.asarray(b)[:, 0]
+        
+        # Shifted eigenvalues of the diagonal operators, shaped to broadcast over the product basis
+        x = {}
+        for i, op in enumerate(local):
+            d = util.sparseDiagonal(op)
+            if d is not None:
+                x[i] = (d + b[i]).reshape([dims[k] if k == i else 1 for k in range(len(dims))])
+        E = np.zeros(dims, dtype=np.complex128)
+        for i in x:
+            E += x[i]*sum([A[i, j]*x[j] for j in x if A[i, j] != 0])
+        H = qt.Qobj(sc.sparse.diags(0.5*E.ravel(), format="csr"), dims=[dims, dims])
+        
+        # Remaining pairs involve at least one non-diagonal operator
+        ops = self.Qnp if key == "charge" else self.Pnp
+        for i in range(len(node_list)):
+            for j in range(len(node_list)):
+                if A[i, j] == 0 or (i in x and j in x):
+                    continue
+                H += 0.5*A[i, j]*(ops[i, 0] + b[i])*(ops[j, 0] + b[j])
+        return H
+    
+    def getHamiltonianOperator(self):
+        """ Gets the Hamiltonian as a matrix-free linear operator. Each term is stored as a Kronecker product of the local operators of the nodes, and is applied to a vector by contracting each factor with the corresponding axis of the reshaped vector, such that the Hamiltonian and the expanded operators are never constructed in the total Hilbert space. The result can be used directly with the sparse diagonalisers.
+        
+        :return: The Hamiltonian, with the qutip dimensions available as the `dims` attribute.
+        :rtype: scipy.sparse.linalg.LinearOperator
+        """
+        if self.H_kron is None:
+            self._compile_hamiltonian_operator()
+        coefs = self._get_hamiltonian_coefficients(self.H_kron)
+        return util.kronLinearOperator(self.H_kron["dims"], self.H_kron["factors"], coefs)
+    
     def getCurrentOperator(self, edge=None):
         # Check edge
         if edge is None:
@@ -553,49 +941,25 @@ class NumericalSystem(ds.TempData):
         elif self.getCircuitGraph().isJosephsonEdge(edge):
             
             # Get the Josephson operators
-            prod1 = self.Pexp_pnp[i]
-            prod2 = self.Pexp_mnp[i]
-            if len(Pp[i].atoms()) > 2: # Case where there is sum of elements
-                # Left
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] > 0:
-                        prod1 *= self.circ_operators[node]["disp"]
-                    else:
-                        prod1 *= self.circ_operators[node]["disp_adj"]
-                
-                # Right
-                for arg in Pp[i].args:
-                    node = self.SS.node_map_rev[arg.args[1]]
-                    if arg.args[0] < 0:
-                        prod2 *= self.circ_operators[node]["disp"]
-                    else:
-                        prod2 *= self.circ_operators[node]["disp_adj"]
-            else:
-                node = self.SS.node_map_rev[Pp[i].args[1]]
-                if Pp[i].args[0] > 0:
-                    prod1 *= self.circ_operators[node]["disp"]
-                    prod2 *= self.circ_operators[node]["disp_adj"]
-                else:
-                    prod1 *= self.circ_operators[node]["disp_adj"]
-                    prod2 *= self.circ_operators[node]["disp"]
+            prod1, prod2 = self._get_branch_displacements(i, "disp")
+            prod1 = self.Pexp_pnp[i]*prod1
+            prod2 = self.Pexp_mnp[i]*prod2
         
             return 0.5j * self.units.getPrefactor("IopJ") * self.Jvecnp[i] * (prod1 - prod2)
         else:
             raise Exception("Edge %s is not current-carrying" % repr(edge))
     
     def getCurrentMatrixElement(self, E, V, edge=None, elements=None):
-        # Get the relevant operator
-        Iop = self.getCurrentOperator(edge=edge)
+        # Get the relevant operators, several edges share the stacked eigenvectors
+        if type(edge) == list:
+            Iop = [self.getCurrentOperator(edge=e) for e in edge]
+        else:
+            Iop = self.getCurrentOperator(edge=edge)
         
         # Check the elements
         if elements is None:
             raise Exception("No elements specified for current matrix elements.")
-        result = np.zeros(len(elements), dtype=np.float64)
-        for i, indices in enumerate(elements):
-            i1, i2 = indices
-            result[i] = Iop.matrix_element(V[i1], V[i2]).real
-        return result
+        return util.matrixElements(Iop, V, elements=elements).real
     
     def getVoltageOperator(self, node=None):
         # Check node
@@ -612,17 +976,16 @@ class NumericalSystem(ds.TempData):
         return self.units.getPrefactor("Vop") * Q[i, 0] * self.Cinvnp[i, i]
     
     def getVoltageMatrixElement(self, E, V, node=None, elements=None):
-        # Get the relevant operator
-        Vop = self.getVoltageOperator(node=node)
+        # Get the relevant operators, several nodes share the stacked eigenvectors
+        if type(node) == list:
+            Vop = [self.getVoltageOperator(node=n) for n in node]
+        else:
+            Vop = self.getVoltageOperator(node=node)
         
         # Check the elements
         if elements is None:
             raise Exception("No elements specified for voltage matrix elements.")
-        result = np.zeros(len(elements), dtype=np.float64)
-        for i, indices in enumerate(elements):
-            i1, i2 = indices
-            result[i] = Vop.matrix_element(V[i1], V[i2]).real
-        return result
+        return util.matrixElements(Vop, V, elements=elements).real
     
     def getChargingEnergies(self, node=None):
         if node is None:
@@ -683,14 +1046,12 @@ class NumericalSystem(ds.TempData):
         E = E - E[0]
         tmax = len(E)
         nmax = nmax + 1 + tmax
-        norm = Op.matrix_element(V[0], V[1])#(V[0].dag()*Op*V[1])[0][0][0]
-        g_list = []
-        for i in range(tmax-1):
-            #g_list.append((V[i].dag()*Op*V[i+1])[0][0][0])
-            g_list.append(Op.matrix_element(V[i], V[i+1]))
+        Opr = util.reducedOperator(Op, V)
+        norm = Opr[0, 1]#(V[0].dag()*Op*V[1])[0][0][0]
+        g_list = np.diag(Opr, 1)
         
         # Apply the circuit derived prefactor
-        g_list = gC * np.abs(np.array(g_list)/norm)
+        g_list = gC * np.abs(g_list/norm)
         
         # Diagonalise RWA strips
         order = np.zeros(tmax, dtype=np.int)
@@ -714,18 +1075,144 @@ class NumericalSystem(ds.TempData):
         
         return np.array(Erwa)
     
+    ###################################################################################################################
+    #       Hamiltonian Configuration
+    ###################################################################################################################
+    
+    def setHamiltonianConfig(self, compiled=True, osc_cache_size=16, osc_band=None, matrix_free=False):
+        """ Configures how the numerical Hamiltonian is assembled during parameter sweeps.
+        
+        :param compiled: Decompose the Hamiltonian into fixed sparse term matrices once before a sweep, such that each sweep point only requires evaluating a coefficient vector and a weighted sum. This is not used when the operators themselves are regenerated during the sweep, for example when sweeping an oscillator impedance.
+        :type compiled: bool, optional
+        
+        :param osc_cache_size: The number of expanded oscillator operator sets kept for previously used impedances when the impedance of an oscillator mode is swept. The least recently used sets are evicted first.
+        :type osc_cache_size: int, optional
+        
+        :param osc_band: If specified, only the matrix elements of the oscillator displacement operators within this distance of the diagonal are kept, which makes them sparse. The elements decay quickly away from the diagonal for small displacements. Operators must be regenerated with :func:`prepareOperators` for this to take effect.
+        :type osc_band: int, optional
+        
+        :param matrix_free: Return the Hamiltonian as a matrix-free linear operator from :func:`getHamiltonian`, see :func:`getHamiltonianOperator`. This requires the sparse diagonaliser without shift-invert mode.
+        :type matrix_free: bool, optional
+        
+        :return: None
+        """
+        self.hamiltonian_config = {
+            'compiled': compiled,
+            'osc_cache_size': osc_cache_size,
+            'osc_band': osc_band,
+            'matrix_free': matrix_free
+        }
+        self.H_template = None
+        self.H_kron = None
+        self.H_inplace = False
+        
+        # Impedance independent oscillator data and the cache of expanded operators keyed by (node, impedance)
+        self.osc_quadratures = {}
+        self.osc_cache = OrderedDict()
+        self.osc_impedances = {}
+        
+        # Structure of the expanded operators, reused for operators with the same sparsity
+        self.expansion_cache = {}
+    
+    def getHamiltonianConfig(self):
+        return self.hamiltonian_config
+    
+    ###################################################################################################################
+    #       Sweep Result Storage Configuration
+    ###################################################################################################################
+    
+    def setStorageConfig(self, memory_budget=256*2**20, disk_quota=None):
+        """ Configures where the results of parameter sweeps are kept.
+        
+        :param memory_budget: The number of bytes the results of a sweep may occupy in RAM, estimated from the diagonaliser configuration, the evaluables and the number of sweep points before the sweep starts. The results of larger sweeps are written to a :class:`pycqed.dataspec.SweepStore` in the temporary data directory instead. Use `0` to always write the results to disk and `None` to always keep them in RAM.
+        :type memory_budget: int, optional
+        
+        :param disk_quota: The number of bytes the temporary data of this instance may occupy. The least recently used sweep results are deleted to make space for those of new sweeps.
+        :type disk_quota: int, optional
+        
+        :return: None
+        """
+        self.storage_config = {
+            'memory_budget': memory_budget,
+            'disk_quota': disk_quota
+        }
+        self.setDiskQuota(disk_quota)
+    
+    def getStorageConfig(self):
+        return self.storage_config
+    
     ###################################################################################################################
     #       Diagonaliser Configuration
     ###################################################################################################################
     
-    def setDiagConfig(self, eigvalues=5, get_vectors=False, sparse=False, sparsesolveropts={"sigma":None, "mode":"normal", "maxiter":None, "tol":1e-3, "which":"SA"}):
+    def setDiagConfig(self, eigvalues=5, get_vectors=False, sparse=False, sparsesolveropts={"sigma":None, "mode":"normal", "maxiter":None, "tol":1e-3, "which":"SA"}, warm_start=None, shift_invert=False, banded=False, reorder=True, real=True, precision="double", refine=True, contiguous=False):
+        """ Configures the diagonaliser used by :func:`diagonalize` and parameter sweeps.
+        
+        :param eigvalues: The number of lowest eigenvalues to compute.
+        :type eigvalues: int, optional
+        
+        :param get_vectors: Whether to also compute the eigenvectors.
+        :type get_vectors: bool, optional
+        
+        :param sparse: Use the sparse diagonaliser instead of the dense one.
+        :type sparse: bool, optional
+        
+        :param sparsesolveropts: The keyword arguments of the sparse solver, see :func:`pycqed.util.diagSparseH`.
+        :type sparsesolveropts: dict, optional
+        
+        :param warm_start: Start the sparse solver from the eigenvectors of the previous point, using `eigsh` or `lobpcg`, see :func:`pycqed.util.diagSparseHWarm`.
+        :type warm_start: str, optional
+        
+        :param shift_invert: Use the sparse solver in shift-invert mode, see :func:`pycqed.util.diagSparseHShiftInvert`.
+        :type shift_invert: bool, optional
+        
+        :param banded: Use the banded diagonaliser, see :func:`pycqed.util.diagBandedH`.
+        :type banded: bool, optional
+        
+        :param reorder: Reduce the bandwidth with a reverse Cuthill-McKee reordering when using the banded diagonaliser.
+        :type reorder: bool, optional
+        
+        :param real: Use real arithmetic in the dense diagonaliser when the Hamiltonian is real symmetric in some diagonal gauge, see :func:`pycqed.util.realGauge`.
+        :type real: bool, optional
+        
+        :param precision: The precision of the dense diagonaliser, `double` or `single`. Only the eigenvalue problem is solved in single precision, the operators and the Hamiltonian are always assembled in double precision since qutip stores them as complex128.
+        :type precision: str, optional
+        
+        :param refine: Refine single precision eigenpairs in double precision, see :func:`pycqed.util.refineEigenpairs`. Otherwise the eigenvalues and any contiguous eigenvectors are returned and stored in single precision, which halves the memory used by the eigenvectors of a sweep. Kets are always double precision.
+        :type refine: bool, optional
+        
+        :param contiguous: Return the eigenvectors of a point as the columns of a single array, see :func:`pycqed.util.formatEigenvectors`.
+        :type contiguous: bool, optional
+        
+        :return: None
+        """
+        if banded and sparse:
+            raise Exception("The banded diagonaliser replaces the dense diagonaliser and cannot be used with the sparse diagonaliser.")
+        if precision not in ["double", "single"]:
+            raise Exception("Unrecognised precision '%s'." % repr(precision))
+        if precision == "single" and (sparse or banded):
+            raise Exception("Single precision is only available with the dense diagonaliser.")
+        if warm_start not in [None, "eigsh", "lobpcg"]:
+            raise Exception("Unrecognised warm-start method '%s'." % repr(warm_start))
+        if (warm_start is not None or shift_invert) and not sparse:
+            raise Exception("Warm-starting and shift-invert mode are only available with the sparse diagonaliser.")
+        if warm_start is not None and shift_invert:
+            raise Exception("Warm-starting and shift-invert mode cannot be used together.")
         self.diagonalizer_config = {
             'kwargs':{
                 'eigvalues':eigvalues, 
                 'get_vectors':get_vectors, 
-                'sparsesolveropts':sparsesolveropts
+                'sparsesolveropts':sparsesolveropts,
+                'contiguous':contiguous
             }, 
-            'sparse':sparse
+            'sparse':sparse,
+            'warm_start':warm_start,
+            'shift_invert':shift_invert,
+            'banded':banded,
+            'reorder':reorder,
+            'real':real,
+            'precision':precision,
+            'refine':refine
         }
         
         # Choose the diagonalizer function and matrix conversion operation
@@ -733,12 +1220,85 @@ class NumericalSystem(ds.TempData):
             self.diagonalizer_config['func'] = util.diagSparseH
         else:
             self.diagonalizer_config['func'] = util.diagDenseH
+        
+        # Reset the continuation data
+        self.resetDiagState()
+    
+    def resetDiagState(self):
+        """ Resets the eigenvectors used to warm-start the sparse diagonaliser, the recorded iteration counts, the cached shift-invert data and the dense diagonaliser workspace.
+        
+        :return: None
+        """
+        self.diag_guess = None
+        self.diag_iterations = []
+        self.diag_cache = {}
+        self.diag_workspace = None
+    
+    def getDiagIterations(self):
+        """ Gets the number of iterations used by the warm-started sparse diagonaliser for each diagonalisation since the last reset, which is done at the start of every parameter sweep.
+        
+        :return: The iteration counts.
+        :rtype: numpy.ndarray
+        """
+        return np.array(self.diag_iterations)
     
     def getDiagConfig(self):
         return self.diagonalizer_config
     
     def diagonalize(self, M):
-        return self.diagonalizer_config['func'](M, **self.diagonalizer_config['kwargs'])
+        kwargs = self.diagonalizer_config['kwargs']
+        if isinstance(M, sc.sparse.linalg.LinearOperator) and (not self.diagonalizer_config['sparse'] or self.diagonalizer_config['shift_invert']):
+            raise Exception("Matrix-free Hamiltonians require the sparse diagonaliser without shift-invert mode.")
+        
+        # Shift-invert mode with the shift chosen automatically unless specified
+        if self.diagonalizer_config['shift_invert']:
+            E, V = util.diagSparseHShiftInvert(M, eigvalues=kwargs['eigvalues'], sparsesolveropts=kwargs['sparsesolveropts'], sigma=kwargs['sparsesolveropts'].get('sigma'), cache=self.diag_cache)
+            if kwargs['get_vectors']:
+                return tuple(E), util.formatEigenvectors(V, M.dims, contiguous=kwargs['contiguous'])
+            return E
+        
+        # Banded diagonalisation with the reordering cached while the sparsity pattern is unchanged
+        if self.diagonalizer_config['banded']:
+            return util.diagBandedH(M, eigvalues=kwargs['eigvalues'], get_vectors=kwargs['get_vectors'], reorder=self.diagonalizer_config['reorder'], cache=self.diag_cache, contiguous=kwargs['contiguous'])
+        
+        # Dense diagonalisation reuses preallocated buffers while the Hamiltonian size is unchanged
+        if not self.diagonalizer_config['sparse']:
+            # Use real arithmetic if the Hamiltonian is real symmetric in some diagonal gauge
+            single = self.diagonalizer_config['precision'] == "single"
+            A, u, dtype = M, None, np.complex64 if single else np.complex128
+            if self.diagonalizer_config['real']:
+                gauge = util.realGauge(M, cache=self.diag_cache)
+                if gauge is not None:
+                    (A, u), dtype = gauge, np.float32 if single else np.float64
+            
+            # Single precision results are refined in double precision using the eigenvectors
+            refine = single and self.diagonalizer_config['refine']
+            if self.diag_workspace is None:
+                self.diag_workspace = {}
+            ws = self.diag_workspace.get(np.dtype(dtype).name)
+            if ws is None or ws.N != M.shape[0]:
+                ws = util.DenseEigenWorkspace(M.shape[0], eigvalues=kwargs['eigvalues'], get_vectors=(kwargs['get_vectors'] or refine), dtype=dtype)
+                self.diag_workspace[np.dtype(dtype).name] = ws
+            ret = ws.diagonalize(A)
+            if refine:
+                ret = util.refineEigenpairs(A, ret[1])
+            if not kwargs['get_vectors']:
+                return ret[0] if refine else ret
+            E, V = ret
+            if u is not None:
+                V = u.astype(np.result_type(V.dtype, np.complex64))[:, np.newaxis]*V
+            return tuple(E), util.formatEigenvectors(V, M.dims, contiguous=kwargs['contiguous'])
+        
+        if self.diagonalizer_config['warm_start'] is None:
+            return self.diagonalizer_config['func'](M, **kwargs)
+        
+        # Continue from the eigenvectors of the previous diagonalisation
+        E, V, iterations = util.diagSparseHWarm(M, eigvalues=kwargs['eigvalues'], sparsesolveropts=kwargs['sparsesolveropts'], guess=self.diag_guess, method=self.diagonalizer_config['warm_start'])
+        self.diag_guess = V
+        self.diag_iterations.append(iterations)
+        if kwargs['get_vectors']:
+            return tuple(E), util.formatEigenvectors(V, M.dims, contiguous=kwargs['contiguous'])
+        return E
     
     ###################################################################################################################
     #       Parameter Collection Wrapper Functions and Extended Functions
@@ -749,6 +1309,9 @@ class NumericalSystem(ds.TempData):
         self.SS.setParameterValue(name, value)
         self.substitute()
         self.prepareOperators()
+        
+        # The previous eigenvalues no longer indicate where the spectrum lies
+        self.diag_cache.pop("E", None)
     
     ## Get the value of a parameter.
     def getParameterValue(self, name):
@@ -759,6 +1322,9 @@ class NumericalSystem(ds.TempData):
         self.SS.setParameterValues(*name_value_pairs)
         self.substitute()
         self.prepareOperators()
+        
+        # The previous eigenvalues no longer indicate where the spectrum lies
+        self.diag_cache.pop("E", None)
     
     ## Get many parameter values.
     def getParameterValues(self, *names):
@@ -804,9 +1370,26 @@ class NumericalSystem(ds.TempData):
         if evaluable not in self.__eval_spec.keys():
             raise Exception("Evaluable '%s' not valid." % evaluable)
         key = self.__eval_spec[evaluable]['eval']
+        
+        # The results may be temporary files that are still being written
+        self.flushWrites()
         return self.SS.getSweepResult(ind_var, static_vars, data=data, key=key)
     
-    def paramSweep(self, timesweep=False):
+    def paramSweep(self, timesweep=False, batch_size=None, workers=None):
+        """ Evaluates the configured evaluables over the configured parameter sweep.
+        
+        :param timesweep: Print the timing of the sweep.
+        :type timesweep: bool, optional
+        
+        :param batch_size: When using the dense diagonaliser, the number of sweep points whose Hamiltonians are assembled into a single contiguous array and diagonalised with a single stacked solver call. This amortises the per-point overhead for small to medium Hilbert spaces.
+        :type batch_size: int, optional
+        
+        :param workers: The number of worker processes to distribute the sweep points over. The collapsed sweep grid is split into contiguous chunks that are evaluated by a copy of this instance in each process, and the results are merged in the original order.
+        :type workers: int, optional
+        
+        :return: The sweep results, or the :class:`pycqed.dataspec.SweepStore` they are stored in.
+        :rtype: numpy.ndarray, dict, list
+        """
         
         # Time initialisation
         if timesweep:
@@ -821,116 +1404,36 @@ class NumericalSystem(ds.TempData):
         # Generate sweep grid
         self.SS.ndSweep(self.sweep_specs)
         
-        # FIXME: Determine if we should be saving the data to temp files rather than in RAM:
-        # Use the diagonaliser configuration, the requested evaluation functions, and the total number of sweep setpoints that will be used.
-        self.__use_temp = True
-        if self.__use_temp:
-            tmp_results = []
+        # Keep the results in RAM if they fit within the memory budget
+        self.__use_temp = self._use_temp_storage(self.SS.sweep_grid_npts)
         
         # Do pre-substitutions to avoid repeating un-necessary substitutions in loops
         self._presub()
         
         # FIXME: Check that all symbolic variables have an associated value at this point
         
-        # Do the requested evaluations
-        if len(self.evaluations) > 1:
-            
-            # Prepare the results structure
-            results = {}
-            for entry in self.evaluations:
-                results[entry['eval']] = []
-            
-            # Time loop
-            if timesweep:
-                loop_time = time.time()
-            for i in range(self.SS.sweep_grid_npts):
-                # Do the post-substitutions
-                self._postsub({k: v[i] for k, v in self.SS.sweep_grid_c.items()})
-                
-                # Get requested evaluables
-                E = None
-                V = None
-                for entry in self.evaluations:
-                    
-                    # Check if this evaluable depends on another
-                    if entry['depends'] is not None:
-                        try:
-                            if self.__use_temp:
-                                dep = results[entry['depends']]
-                            else:
-                                dep = results[entry['depends']][i]
-                        except:
-                            raise Exception("eval spec with 'depends':'%s' entry should be specified after the one it depends on ('%s'), or Possibly invalid 'depends' value." % (entry['depends'], entry['eval'])) # FIXME
-                        
-                        # In almost every case the depends will be on the eigenvalues and eigenvectors of the independent eval spec
-                        try:
-                            E, V = dep
-                        except:
-                            raise Exception("need eigenvectors for 'depends'")
-                    
-                    # Check if evaluation depends on eigenvalues and eigenvectors and run it
-                    if V is not None:
-                        M = getattr(self, entry['eval'])(E, V, **entry['kwargs'])
-                    else:
-                        M = getattr(self, entry['eval'])(**entry['kwargs'])
-                    
-                    # Check if diagonalisation is required
-                    if self.__use_temp:
-                        if entry['diag']:
-                            results[entry['eval']] = self.diagonalize(M)
-                        else:
-                            results[entry['eval']] = M
-                    else:
-                        if entry['diag']:
-                            results[entry['eval']].append(self.diagonalize(M))
-                        else:
-                            results[entry['eval']].append(M)
-                    E = None
-                    V = None
-                
-                if self.__use_temp:
-                    # Write to temp file
-                    f = self.writePart(results)
-                    tmp_results.append(f)
-            
-            # Convert the result entries to ndarray
-            if not self.__use_temp:
-                for entry in self.evaluations:
-                    results[entry['eval']] = np.array(results[entry['eval']])
+        # Start the diagonaliser cold
+        self.resetDiagState()
         
-        # Do the single requested evaluation
-        else:
-            results = []
-            entry = self.evaluations[0]
-            
-            # Time loop
-            if timesweep:
-                loop_time = time.time()
-            for i in range(self.SS.sweep_grid_npts):
-                # Do the post-substitutions
-                self._postsub(dict([(k, v[i]) for k, v in self.SS.sweep_grid_c.items()]))
-                
-                # Get requested evaluable
-                M = getattr(self, entry['eval'])(**entry['kwargs'])
-                if self.__use_temp:
-                    if entry['diag']:
-                        results = self.diagonalize(M)
-                    else:
-                        results = M
-                else:
-                    if entry['diag']:
-                        results.append(self.diagonalize(M))
-                    else:
-                        results.append(M)
-                
-                if self.__use_temp:
-                    # Write to temp file
-                    f = self.writePart(results)
-                    tmp_results.append(f)
-            
-            # Convert results to ndarray
-            if not self.__use_temp:
-                results = np.array(results)
+        # Only the dense diagonaliser can be batched
+        if batch_size is None or self.diagonalizer_config['sparse'] or self.diagonalizer_config['banded'] or self.diagonalizer_config['precision'] != "double":
+            batch_size = 1
+        
+        # Time loop
+        if timesweep:
+            loop_time = time.time()
+        
+        # The Hamiltonians are consumed immediately, so the compiled Hamiltonian can be updated in place
+        self.H_inplace = True
+        try:
+            self._init_sweep_store()
+            points = []
+            for block in self._iterate_sweep(batch_size, workers):
+                for point in block:
+                    points.append(self._store_sweep_point(point))
+        finally:
+            self._end_sweep_assembly()
+        results = self._collect_sweep_results(points)
         
         # Reset the evaluables
         self._init_sweep_data()
@@ -942,10 +1445,141 @@ class NumericalSystem(ds.TempData):
             print ("  Initialization:\t%.3f s" % (loop_time-init_time))
             print ("  Loop duration:\t%.3f s" % (end_time-loop_time))
             print ("  Avg iteration:\t%.3f s" % ((end_time-loop_time)/self.SS.sweep_grid_npts))
-        if self.__use_temp:
-            return tmp_results
-        else:
-            return results
+        return results
+    
+    def paramSweepAdaptive(self, name=None, tol=1e-2, gap_tol=None, max_depth=6, levels=None, timesweep=False, batch_size=None, workers=None):
+        """ Evaluates the configured evaluables over an adaptively refined parameter sweep. The configured sweep of the parameter `name` is used as a coarse grid, and its intervals are recursively bisected where the eigenvalues deviate from a linear interpolation by more than `tol`, or where the gap between adjacent levels drops below `gap_tol`, which resolves avoided crossings and steep regions without oversampling the whole range. Only the new points are diagonalised in each refinement round.
+        
+        If more than one parameter is swept, the refinement is done along `name` for every combination of the other swept parameters, and the union of the added points is used such that the sweep grid remains rectangular.
+        
+        The refined sweep replaces the configured sweep of `name`, such that the returned results can be queried with :func:`getSweep` as usual, with :func:`getParameterSweep` returning the non-uniform sweep values.
+        
+        :param name: The swept parameter to refine. Defaults to the last configured sweep, i.e. the inner-most one.
+        :type name: str, optional
+        
+        :param tol: The maximum deviation of the eigenvalues at a sweep point from the linear interpolation between its neighbours, in the units of the Hamiltonian.
+        :type tol: float, optional
+        
+        :param gap_tol: The level spacing below which intervals are refined. Disabled by default.
+        :type gap_tol: float, optional
+        
+        :param max_depth: The maximum number of times an interval of the coarse grid can be bisected.
+        :type max_depth: int, optional
+        
+        :param levels: The indices of the eigenvalues used for the refinement criteria. Defaults to all computed eigenvalues.
+        :type levels: list of int, optional
+        
+        :param timesweep: Print the timing of the sweep.
+        :type timesweep: bool, optional
+        
+        :param batch_size: See :func:`paramSweep`.
+        :type batch_size: int, optional
+        
+        :param workers: See :func:`paramSweep`.
+        :type workers: int, optional
+        
+        :raises Exception: If the parameter is not swept, the coarse grid has less than three points, or no evaluable is diagonalised.
+        
+        :return: The sweep results, or the :class:`pycqed.dataspec.SweepStore` they are stored in.
+        :rtype: numpy.ndarray, dict, list
+        """
+        
+        # Time initialisation
+        if timesweep:
+            init_time = time.time()
+        
+        # Check if using default evaluables
+        if len(self.evaluations) == 0:
+            self.evaluations = [self.__eval_spec["Hamiltonian"]]
+        diag_entries = [entry for entry in self.evaluations if entry['diag']]
+        if len(diag_entries) == 0:
+            raise Exception("Adaptive sweeps require an evaluable that is diagonalised.")
+        diag_key = diag_entries[0]['eval']
+        
+        # Find the refined sweep
+        names = [spec["name"] for spec in self.sweep_specs]
+        if name is None:
+            name = names[-1]
+        if name not in names:
+            raise Exception("Parameter '%s' is not swept." % name)
+        axis = names.index(name)
+        
+        # Generate the coarse sweep grid
+        self.SS.ndSweep(self.sweep_specs)
+        x = self.SS.getParameterSweep(name).copy()
+        if len(x) < 3:
+            raise Exception("Adaptive sweeps require at least three coarse points.")
+        min_step = np.min(np.diff(x))/2**max_depth
+        
+        # Keep the results in RAM if the largest possible refined sweep fits within the memory budget
+        self.__use_temp = self._use_temp_storage(self.SS.sweep_grid_npts//len(x)*((len(x) - 1)*2**max_depth + 1))
+        
+        # Do pre-substitutions to avoid repeating un-necessary substitutions in loops
+        self._presub()
+        
+        # Start the diagonaliser cold
+        self.resetDiagState()
+        
+        # Only the dense diagonaliser can be batched
+        if batch_size is None or self.diagonalizer_config['sparse'] or self.diagonalizer_config['banded'] or self.diagonalizer_config['precision'] != "double":
+            batch_size = 1
+        
+        # Time loop
+        if timesweep:
+            loop_time = time.time()
+        self.H_inplace = True
+        try:
+            self._init_sweep_store()
+            stored = {}
+            energies = {}
+            niter = 0
+            while True:
+                
+                # Evaluate the points that were not evaluated in previous rounds
+                keys = [tuple(self.SS.sweep_grid_c[p][i] for p in self.SS.sweep_grid_params) for i in range(self.SS.sweep_grid_npts)]
+                indices = [i for i, key in enumerate(keys) if key not in stored]
+                niter += len(indices)
+                block_start = 0
+                for block in self._iterate_sweep(batch_size, workers, indices):
+                    for b, point in enumerate(block):
+                        key = keys[indices[block_start + b]]
+                        result = point[diag_key] if len(self.evaluations) > 1 else point
+                        E = np.array(result[0] if self.diagonalizer_config['kwargs']['get_vectors'] else result, dtype=np.float64)
+                        energies[key] = E if levels is None else E[levels]
+                        stored[key] = self._store_sweep_point(point)
+                    block_start += len(block)
+                
+                # Find the intervals to bisect, collecting them over the other swept parameters
+                E = np.array([energies[key] for key in keys])
+                E = np.moveaxis(E.reshape(*[len(self.SS.getParameterSweep(p)) for p in names], E.shape[-1]), axis, -2)
+                E = E.reshape(-1, len(x), E.shape[-1])
+                refine = self._get_refinement_intervals(x, E, tol, gap_tol) & (np.diff(x) > 1.5*min_step)
+                if not np.any(refine):
+                    break
+                
+                # Regenerate the sweep grid with the added points
+                x = np.sort(np.concatenate((x, 0.5*(x[:-1] + x[1:])[refine])))
+                self.sweep_specs[axis] = self.SS.paramSweepSpec(name, x)
+                self.SS.ndSweep(self.sweep_specs)
+                self.sweep_values = self._evaluate_sweep_expressions(self.SS.sweep_grid_c)
+        finally:
+            self._end_sweep_assembly()
+        
+        # Arrange the results in the order of the final collapsed grid
+        results = self._collect_sweep_results([stored[key] for key in keys])
+        
+        # Reset the evaluables
+        self._init_sweep_data()
+        
+        # Report timings
+        if timesweep:
+            end_time = time.time()
+            print ("Adaptive Parameter Sweep Duration:")
+            print ("  Initialization:\t%.3f s" % (loop_time-init_time))
+            print ("  Loop duration:\t%.3f s" % (end_time-loop_time))
+            print ("  Avg iteration:\t%.3f s" % ((end_time-loop_time)/niter))
+            print ("  Evaluated points:\t%i of %i" % (niter, self.SS.sweep_grid_npts))
+        return results
     
     def paramSweepFunc(self, sweep_spec, ufcn, ufcn_args={}, get_vectors=False, sparse=False, sparselevels=6, sparsesolveropts={"sigma":None, "mode":"normal", "maxiter":None, "tol":1e-3, "which":"SA"}):
         self.params.ndSweep(sweep_spec)
@@ -1012,6 +1646,228 @@ class NumericalSystem(ds.TempData):
         self.sweep_specs = []
         self.evaluations = []
     
+    # Gets the nodes and their signs that make up each branch in the possibly transformed representation
+    def _get_branch_nodes(self):
+        Pp = self.SS.Rnb*self.SS.Rinv*self.SS.node_vector
+        branch_nodes = []
+        for i, edge in enumerate(self.SS.edges):
+            if len(Pp[i].atoms()) > 2: # Case where there is sum of elements
+                args = Pp[i].args
+            else:
+                args = [Pp[i]]
+            branch_nodes.append([(self.SS.node_map_rev[arg.args[1]], float(arg.args[0])) for arg in args])
+        return branch_nodes
+    
+    # Gets the products of node displacement operators that displace the branch at index i in both directions
+    def _get_branch_displacements(self, i, key):
+        prod1 = 1
+        prod2 = 1
+        for node, sign in self.branch_nodes[i]:
+            if sign > 0:
+                prod1 *= self.circ_operators[node][key]
+                prod2 *= self.circ_operators[node][key + "_adj"]
+            else:
+                prod1 *= self.circ_operators[node][key + "_adj"]
+                prod2 *= self.circ_operators[node][key]
+        return prod1, prod2
+    
+    # Evaluates the sweep points (all of them by default) in blocks and yields the results of each block in the order of the collapsed sweep grid
+    def _iterate_sweep(self, batch_size, workers=None, indices=None):
+        if indices is None:
+            indices = range(self.SS.sweep_grid_npts)
+        npts = len(indices)
+        if workers is None or workers < 2:
+            for start in range(0, npts, batch_size):
+                yield self._evaluate_indices(indices[start:start + batch_size], batch_size)
+            return
+        
+        # Split the grid into contiguous chunks, a few per worker to balance the load
+        chunk_size = max(batch_size, int(np.ceil(npts/(4*workers))))
+        chunks = [indices[start:start + chunk_size] for start in range(0, npts, chunk_size)]
+        with cf.ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, initargs=(self,)) as pool:
+            futures = [pool.submit(_run_sweep_worker, chunk, batch_size) for chunk in chunks]
+            for future in futures:
+                block, iterations = future.result()
+                self.diag_iterations.extend(iterations)
+                yield block
+    
+    # Estimates the number of bytes the result of a sweep point occupies
+    def _estimate_point_size(self):
+        kwargs = self.diagonalizer_config['kwargs']
+        N = 1
+        for node in self.getNodeList():
+            trunc = self.operator_data[node]["truncation"]
+            N *= trunc if self.operator_data[node]["basis"] == "oscillator" else 2*trunc + 1
+        size = 0
+        for entry in self.evaluations:
+            if entry['diag']:
+                size += 8*kwargs['eigvalues']
+                
+                # Kets are stored as sparse Qobj instances, with a significant fixed overhead, unless they are contiguous
+                if kwargs['get_vectors'] and kwargs['contiguous']:
+                    single = self.diagonalizer_config['precision'] == "single" and not self.diagonalizer_config['refine']
+                    size += (8 if single else 16)*kwargs['eigvalues']*N
+                elif kwargs['get_vectors']:
+                    size += kwargs['eigvalues']*(28*N + 1024)
+            elif entry['eval'] == "getResonatorResponse":
+                size += 8*kwargs['eigvalues']*entry['kwargs'].get('nmax', 100)
+            else:
+                operators = entry['kwargs'].get('edge', entry['kwargs'].get('node'))
+                size += 16*len(entry['kwargs'].get('elements') or [None])*(len(operators) if type(operators) == list else 1) + 256
+        return size
+    
+    # Determines whether the results of a sweep are written to temp files
+    def _use_temp_storage(self, npts):
+        self.sweep_size = npts*self._estimate_point_size()
+        if self.storage_config['memory_budget'] is None:
+            return False
+        return self.sweep_size > self.storage_config['memory_budget']
+    
+    # Creates the result store of a sweep if the results are written to temp files
+    def _init_sweep_store(self):
+        self.sweep_store = None
+        if self.__use_temp:
+            self.sweep_store = self.newSweepStore(reserve=self.sweep_size)
+    
+    # Appends the result of a sweep point to the result store if required, returning its position there
+    def _store_sweep_point(self, point):
+        if self.__use_temp:
+            return self.sweep_store.appendPoint(point)
+        return point
+    
+    # Arranges the stored results of the sweep points into the structure returned by the sweep functions
+    def _collect_sweep_results(self, points):
+        if self.__use_temp:
+            store = self.sweep_store
+            self.sweep_store = None
+            if not np.array_equal(points, np.arange(len(points))):
+                store.setOrder(points)
+            store.setSweepSpec([{"name": spec["name"], "values": self.SS.getParameterSweep(spec["name"])} for spec in self.SS.sweep_spec])
+            store.close()
+            return store
+        if len(self.evaluations) > 1:
+            return {entry['eval']: self._stack_sweep_results(entry, [point[entry['eval']] for point in points]) for entry in self.evaluations}
+        return self._stack_sweep_results(self.evaluations[0], points)
+    
+    # Stacks the results of an evaluable over the sweep points, contiguous eigenvectors are returned as arrays of the eigenvalues and eigenvectors of shapes (points, levels) and (points, N, levels)
+    def _stack_sweep_results(self, entry, values):
+        kwargs = self.diagonalizer_config['kwargs']
+        if entry['diag'] and kwargs['get_vectors'] and kwargs['contiguous']:
+            return np.array([value[0] for value in values], dtype=np.float64), np.array([value[1] for value in values])
+        return np.array(values)
+    
+    # Restores the assembly of independent Hamiltonians from all the compiled terms after a sweep, including one that failed
+    def _end_sweep_assembly(self):
+        self.H_inplace = False
+        if self.H_template is not None:
+            self._set_static_terms()
+    
+    # Marks the intervals of a sweep to be bisected, given the energies of shape (slices, points, levels) along it
+    def _get_refinement_intervals(self, x, E, tol, gap_tol=None):
+        refine = np.zeros(len(x) - 1, dtype=bool)
+        
+        # Deviation of each interior point from the linear interpolation between its neighbours
+        t = ((x[1:-1] - x[:-2])/(x[2:] - x[:-2]))[None, :, None]
+        dev = np.max(np.abs(E[:, 1:-1] - (1 - t)*E[:, :-2] - t*E[:, 2:]), axis=(0, 2))
+        refine[:-1] |= dev > tol
+        refine[1:] |= dev > tol
+        
+        # Small level spacings at either end of an interval
+        if gap_tol is not None and E.shape[-1] > 1:
+            gap = np.min(np.diff(np.sort(E, axis=-1), axis=-1), axis=(0, 2))
+            refine |= (gap[:-1] < gap_tol) | (gap[1:] < gap_tol)
+        return refine
+    
+    # Evaluates a set of points of the collapsed sweep grid
+    def _evaluate_indices(self, indices, batch_size):
+        block = []
+        for start in range(0, len(indices), batch_size):
+            sub = indices[start:start + batch_size]
+            if batch_size > 1:
+                block.extend(self._evaluate_batch(sub))
+            else:
+                block.extend([self._evaluate_point(i) for i in sub])
+        return block
+    
+    # Evaluates the requested evaluables at a single point of the collapsed sweep grid
+    def _evaluate_point(self, i, precomputed=None, operators=None):
+        if precomputed is None:
+            precomputed = {}
+        
+        # Do the post-substitutions
+        self._postsub({k: v[i] for k, v in self.SS.sweep_grid_c.items()}, i, operators)
+        
+        # Get requested evaluables
+        results = {}
+        for entry in self.evaluations:
+            E = None
+            V = None
+            
+            # Check if this evaluable depends on another
+            if entry['depends'] is not None:
+                try:
+                    dep = results[entry['depends']]
+                except:
+                    raise Exception("eval spec with 'depends':'%s' entry should be specified after the one it depends on ('%s'), or Possibly invalid 'depends' value." % (entry['depends'], entry['eval'])) # FIXME
+                
+                # In almost every case the depends will be on the eigenvalues and eigenvectors of the independent eval spec
+                try:
+                    E, V = dep
+                except:
+                    raise Exception("need eigenvectors for 'depends'")
+            
+            # Use results that were already computed for this point
+            if entry['eval'] in precomputed:
+                results[entry['eval']] = precomputed[entry['eval']]
+                continue
+            
+            # Check if evaluation depends on eigenvalues and eigenvectors and run it
+            if V is not None:
+                M = getattr(self, entry['eval'])(E, V, **entry['kwargs'])
+            else:
+                M = getattr(self, entry['eval'])(**entry['kwargs'])
+            
+            # Check if diagonalisation is required
+            if entry['diag']:
+                results[entry['eval']] = self.diagonalize(M)
+            else:
+                results[entry['eval']] = M
+        
+        if len(self.evaluations) > 1:
+            return results
+        return results[self.evaluations[0]['eval']]
+    
+    # Evaluates a block of sweep points, diagonalising their Hamiltonians together with a stacked dense solver
+    def _evaluate_batch(self, indices):
+        diag_entries = [entry for entry in self.evaluations if entry['diag']]
+        if len(diag_entries) != 1:
+            return [self._evaluate_point(i) for i in indices]
+        entry = diag_entries[0]
+        
+        # Assemble the matrices into a contiguous array, keeping any regenerated operators for the remaining evaluables
+        dims = None
+        Ms = None
+        operators = [None]*len(indices)
+        for b, i in enumerate(indices):
+            self._postsub({k: v[i] for k, v in self.SS.sweep_grid_c.items()}, i)
+            if len(self.evaluations) > 1 and self.regen_nodes != []:
+                operators[b] = {node: self.circ_operators[node] for node in self.regen_nodes}
+            M = getattr(self, entry['eval'])(**entry['kwargs'])
+            if Ms is None:
+                dims = M.dims
+                Ms = np.empty((len(indices), M.shape[0], M.shape[1]), dtype=np.complex128)
+            M.data.toarray(out=Ms[b])
+        
+        # Diagonalise and split into the results of each point
+        kwargs = self.diagonalizer_config['kwargs']
+        ret = util.diagDenseHBatch(Ms, eigvalues=kwargs['eigvalues'], get_vectors=kwargs['get_vectors'])
+        diag_results = util.splitEigenBatch(ret, dims=dims, get_vectors=kwargs['get_vectors'], contiguous=kwargs['contiguous'])
+        
+        # Nothing else to evaluate
+        if len(self.evaluations) == 1:
+            return diag_results
+        return [self._evaluate_point(i, precomputed={entry['eval']: diag_results[b]}, operators=operators[b]) for b, i in enumerate(indices)]
+    
     # Replaces np asmatrix
     def _init_qobj_vector(self, obj_list, dtype=None):
         obj = np.empty((len(obj_list), 1) , dtype=dtype)
@@ -1031,73 +1887,44 @@ class NumericalSystem(ds.TempData):
         a = self.SS.cooper_disp[node]
         b = self.SS.fluxon_disp[node]
         
-        # Using oscillator basis
-        Q = 1j*np.sqrt(1/(2*osc_impedance))*(qt.create(trunc) - qt.destroy(trunc))*self.units.getPrefactor("ChgOsc")
-        P = np.sqrt(osc_impedance/2)*(qt.create(trunc) + qt.destroy(trunc))*self.units.getPrefactor("FlxOsc")
-        Pp = a*2*np.pi/pc.phi0*np.sqrt(pc.hbar)*P/self.units.getPrefactor("FlxOsc")
-        Qp = b*np.pi/pc.e*np.sqrt(pc.hbar)*Q/self.units.getPrefactor("ChgOsc")
-        
-        # Generate Josephson displacement operators by first diagonalising the flux operator
-        E, V = np.linalg.eigh(Pp.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
-        
-        # Exponentiate the diagonal matrix
-        D = U*qt.Qobj(np.diag(np.exp(1j*E)))*Uinv
+        # Get the impedance independent quadratures X = a^dag + a, Y = i(a^dag - a)
+        if trunc not in self.osc_quadratures:
+            X = qt.create(trunc) + qt.destroy(trunc)
+            Y = 1j*(qt.create(trunc) - qt.destroy(trunc))
+            self.osc_quadratures[trunc] = (X, Y)
+        X, Y = self.osc_quadratures[trunc]
+        
+        # Using oscillator basis, the operators only scale with the impedance
+        Q = np.sqrt(1/(2*osc_impedance))*Y*self.units.getPrefactor("ChgOsc")
+        P = np.sqrt(osc_impedance/2)*X*self.units.getPrefactor("FlxOsc")
+        
+        # Josephson displacement operators exp(i cp X) are displacements by i cp
+        band = self.hamiltonian_config['osc_band']
+        cp = a*2*np.pi/pc.phi0*np.sqrt(pc.hbar)*np.sqrt(osc_impedance/2)
+        D = qt.Qobj(util.displacementOperator(trunc, 1j*cp, band=band))
         Ddag = D.dag()
         
-        # Generate Phase Slip displacement operators by first diagonalising the charge operator
-        E, V = np.linalg.eigh(Qp.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
-        
-        # Exponentiate the diagonal matrix
-        S = U*qt.Qobj(np.diag(np.exp(1j*E)))*Uinv
+        # Phase slip displacement operators exp(i cq Y) are displacements by -cq
+        cq = b*np.pi/pc.e*np.sqrt(pc.hbar)*np.sqrt(1/(2*osc_impedance))
+        S = qt.Qobj(util.displacementOperator(trunc, -cq, band=band))
         Sdag = S.dag()
         return Q, P, D, Ddag, S, Sdag
     
     def _get_charge_basis(self, node):
         trunc = self.operator_data[node]["truncation"]
         
-        # For IJ modes the charge states are the eigenvectors of the following matrix
-        q, s = (-qt.num(2*trunc + 1, trunc)).eigenstates()
-        
-        # Construct the flux states
-        phik_list = []
-        phik = None
-        qm = [float(i)-trunc for i in range(2*trunc + 1)]
-        for k in qm:
-            phik = qt.basis(2*trunc + 1, 0) - 1
-            for j, qi in enumerate(qm):
-                phik += np.sqrt(1/(2*trunc + 1)) * np.exp(2j*np.pi*k*qi/(2*trunc + 1))*s[j]
-            phik_list.append(phik)
-        
-        # From this build the flux operator
-        phik_eigvals = [(float(i)-trunc)/(2*trunc + 1) for i in range(2*trunc + 1)]
-        P = qt.qeye(2*trunc + 1) - qt.qeye(2*trunc + 1)
-        for i, phik in enumerate(phik_list):
-            P += phik_eigvals[i]*phik*phik.dag()
-        
         # Get a simple charge number operator
         Q = -qt.num(2*trunc + 1)+float(trunc)
         
-        # Generate Josephson displacement operators by first diagonalising the flux operator
-        E, V = np.linalg.eigh(P.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
+        # The flux operator is diagonal in the Fourier transformed charge states
+        P = self._get_conjugate_operator(trunc)
         
-        # Exponentiate the diagonal matrix
-        D = U*qt.Qobj(np.diag(np.exp(-2j*np.pi*E)))*Uinv - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
+        # Josephson displacement operators shift the charge by one, without wrapping around the truncated space
+        D = qt.Qobj(sc.sparse.diags(np.ones(2*trunc), 1, format="csr"))
         Ddag = D.dag()
         
         # Generate Phase Slip displacement operators by just exponentiating the charge operator, which is diagonal already in this case
-        S = qt.Qobj(np.diag(np.exp(-2j*np.pi*q)))
+        S = qt.Qobj(sc.sparse.diags(np.exp(-2j*np.pi*Q.diag()), 0, format="csr"))
         Sdag = S.dag()
         return Q, P, D, Ddag, S, Sdag
     
@@ -1106,44 +1933,16 @@ class NumericalSystem(ds.TempData):
         
         # Flux operator counts the fluxon occupation
         P = -qt.num(2*trunc + 1)+float(trunc)
-        q, s = P.eigenstates()
-        
-        # Construct the flux states
-        phik_list = []
-        phik = None
-        qm = [float(i)-trunc for i in range(2*trunc + 1)]
-        for k in qm:
-            phik = qt.basis(2*trunc + 1, 0) - 1
-            for j, qi in enumerate(qm):
-                phik += np.sqrt(1/(2*trunc + 1)) * np.exp(2j*np.pi*k*qi/(2*trunc + 1))*s[j]
-            phik_list.append(phik)
-
-        # From this build the flux operator
-        phik_eigvals = [(float(i)-trunc)/(2*trunc + 1) for i in range(2*trunc + 1)]
-        Q = qt.qeye(2*trunc + 1) - qt.qeye(2*trunc + 1)
-        for i, phik in enumerate(phik_list):
-            Q += phik_eigvals[i]*phik*phik.dag()
         
-        # Generate Josephson displacement operators by first diagonalising the flux operator
-        E, V = np.linalg.eigh(P.data.todense())
+        # The charge operator is diagonal in the Fourier transformed flux states
+        Q = self._get_conjugate_operator(trunc)
         
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
-        
-        # Exponentiate the diagonal matrix
-        D = U*qt.Qobj(np.diag(np.exp(-2j*np.pi*E)))*Uinv - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
+        # Generate Josephson displacement operators by exponentiating the flux operator, which is diagonal already in this case
+        D = qt.Qobj(sc.sparse.diags(np.exp(-2j*np.pi*P.diag()), 0, format="csr")) - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
         Ddag = D.dag()
         
-        # Generate Phase displacement operators by first diagonalising the charge operator
-        E, V = np.linalg.eigh(Q.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
-        
-        # Exponentiate the diagonal matrix
-        S = U*qt.Qobj(np.diag(np.exp(-2j*np.pi*E)))*Uinv - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
+        # Phase displacement operators shift the fluxon number by one, without wrapping around the truncated space
+        S = qt.Qobj(sc.sparse.diags(np.ones(2*trunc), 1, format="csr"))
         Sdag = S.dag()
         return Q, P, D, Ddag, S, Sdag
     
@@ -1155,49 +1954,30 @@ class NumericalSystem(ds.TempData):
         grid = np.linspace(-pmax, pmax, 2*trunc+1)
         P = qt.Qobj(np.diag(grid))
         
-        q, s = P.eigenstates()
-        
-        # Construct the flux states
-        phik_list = []
-        phik = None
-        qm = [float(i)-trunc for i in range(2*trunc + 1)]
-        for k in qm:
-            phik = qt.basis(2*trunc + 1, 0) - 1
-            for j, qi in enumerate(qm):
-                phik += np.sqrt(1/(2*trunc + 1)) * np.exp(2j*np.pi*k*qi/(2*trunc + 1))*s[j]
-            phik_list.append(phik)
-
-        # From this build the flux operator
-        phik_eigvals = [(float(i)-trunc)/(2*trunc + 1) for i in range(2*trunc + 1)]
-        Q = qt.qeye(2*trunc + 1) - qt.qeye(2*trunc + 1)
-        for i, phik in enumerate(phik_list):
-            Q += phik_eigvals[i]*phik*phik.dag()
-        
-        Q = Q/(grid[1]-grid[0])
-        
-        # Generate Josephson displacement operators by first diagonalising the flux operator
-        E, V = np.linalg.eigh(P.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
+        # The charge operator is diagonal in the Fourier transformed flux grid states
+        Q = -self._get_conjugate_operator(trunc)/(grid[1]-grid[0])
         
-        # Exponentiate the diagonal matrix
-        D = U*qt.Qobj(np.diag(np.exp(-2j*np.pi*E)))*Uinv - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
+        # Generate Josephson displacement operators by exponentiating the flux operator, which is diagonal already in this case
+        D = qt.Qobj(sc.sparse.diags(np.exp(-2j*np.pi*grid), 0, format="csr")) - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
         Ddag = D.dag()
         
-        # Generate Phase displacement operators by first diagonalising the charge operator
-        E, V = np.linalg.eigh(Q.data.todense())
-        
-        # Create transformation matrices
-        U = qt.Qobj(V)
-        Uinv = qt.Qobj(np.linalg.inv(V))
-        
-        # Exponentiate the diagonal matrix
-        S = U*qt.Qobj(np.diag(np.exp(-2j*np.pi*E)))*Uinv - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
+        # Generate Phase displacement operators by exponentiating the charge operator in its eigenbasis
+        k = np.arange(2*trunc + 1) - trunc
+        V = np.exp(2j*np.pi*np.outer(k, k)/(2*trunc + 1))/np.sqrt(2*trunc + 1)
+        E = k/(2*trunc + 1)/(grid[1]-grid[0])
+        S = qt.Qobj((V*np.exp(-2j*np.pi*E))@V.conj().T) - qt.basis(2*trunc+1, 2*trunc)*qt.basis(2*trunc+1, 0).dag()
         Sdag = S.dag()
         return Q, P, D, Ddag, S, Sdag
     
+    # Gets the operator conjugate to the number operator -num(2*trunc + 1) + trunc, with matrix elements obtained by summing its spectral decomposition in the Fourier transformed basis analytically
+    def _get_conjugate_operator(self, trunc):
+        N = 2*trunc + 1
+        d = np.subtract.outer(np.arange(N), np.arange(N))
+        M = np.zeros((N, N), dtype=np.complex128)
+        off = d != 0
+        M[off] = 1j*(-1.0)**d[off]/(2*N*np.sin(np.pi*d[off]/N))
+        return qt.Qobj(M)
+    
     # FIXME: This causes issues when regenerating code
     def _set_parameter_units(self):
         
@@ -1217,14 +1997,49 @@ class NumericalSystem(ds.TempData):
                     self.SS.addParameterisationPrefactor(resonator["frl"], self.units.getPrefactor('Freq'))
                     self.SS.addParameterisationPrefactor(resonator["Zrl"], self.units.getPrefactor('Impe'))
 
+#
+# Lazily expanded node operators
+#
 
+class _ExpandedOperators(dict):
+    """ Dictionary of the operators of a single node expanded into the total Hilbert space, keyed by operator type. Each operator is only expanded when it is first accessed.
+    """
+    
+    __keys = ["charge", "flux", "disp", "disp_adj", "pdisp", "pdisp_adj"]
+    
+    def __init__(self, operators, dims, index, cache=None):
+        super().__init__()
+        self.operators = dict(zip(self.__keys, operators))
+        self.dims = list(dims)
+        self.index = index
+        self.cache = cache
+    
+    def __missing__(self, key):
+        if key not in self.operators:
+            raise KeyError(key)
+        left = int(np.prod(self.dims[:self.index]))
+        right = int(np.prod(self.dims[self.index + 1:]))
+        M = util.expandOperator(self.operators[key], left, right, cache=self.cache)
+        self[key] = qt.Qobj(M, dims=[self.dims, self.dims])
+        return self[key]
 
+#
+# Parallel sweep workers
+#
 
+# The copy of the numerical system used by a worker process
+_sweep_worker_system = None
 
+def _init_sweep_worker(system):
+    global _sweep_worker_system
+    
+    # Ensure the copy does not delete the session data of the original when destroyed
+    system.detachSession()
+    _sweep_worker_system = system
 
-
-
-
-
-
-
+def _run_sweep_worker(indices, batch_size):
+    
+    # Each chunk starts the diagonaliser cold
+    _sweep_worker_system.resetDiagState()
+    block = _sweep_worker_system._evaluate_indices(indices, batch_size)
+    return block, _sweep_worker_system.diag_iterations
@@ -14,6 +14,7 @@ if platform.system() == 'Windows':
     os.environ["PATH"] += os.pathsep + 'C:/Program Files/Graphviz/bin/'
 
 from . import text2latex as t2l
+from . import dataspec as ds
 from . import util
 
 class Param:
@@ -191,6 +192,31 @@ class Param:
         self.sweep = np.linspace(float(start), float(end), N)
         self.N = N
         return self.sweep
+    
+    def arraySweep(self, values):
+        """ Uses an arbitrary array of values as the sweep, for example a non-uniform sweep obtained by adaptive refinement. The values are sorted and bounds checked. The sweep is saved internally, and is overwritten by subsequent calls to this function.
+        
+        :param values: The values of the sweep.
+        :type values: list, numpy.ndarray
+        
+        :raises Exception: If the values are not one-dimensional, or if any of them are out of bounds.
+        
+        :return: The parameter sweep array.
+        :rtype: numpy.ndarray
+        """
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        if values.ndim != 1 or len(values) == 0:
+            raise Exception("'values' should be a non-empty one-dimensional array.")
+        
+        # Check bounds
+        if values[-1] > self.__upper_bound:
+            raise Exception("Param %s 'values' exceed specified upper bound." % (self.name))
+        if values[0] < self.__lower_bound:
+            raise Exception("Param %s 'values' exceed specified lower bound." % (self.name))
+        
+        self.sweep = values
+        self.N = len(values)
+        return self.sweep
 
 # FIXME: This class should technically inherit the unit system
 class ParamCollection:
@@ -777,8 +803,8 @@ class ParamCollection:
         :param name: The name of the parameter to sweep.
         :type name: str
         
-        :param \*sweep_params: The arguments of the sweep generating function.
-        :type \*sweep_params: float, int, variable
+        :param \*sweep_params: The arguments of the sweep generating function, either the start, end and number of points of a linear sweep, or a single array of (possibly non-uniformly spaced) sweep values.
+        :type \*sweep_params: float, int, numpy.ndarray, variable
         
         :raises Exception: If the argument types are incorrect, ill-formatted, not found, or out of bounds.
         
@@ -794,6 +820,15 @@ class ParamCollection:
             raise Exception("'%s' parameter was not found." % name)
         
         swp = list(sweep_params)
+        if len(swp) == 1:
+            values = np.sort(np.asarray(swp[0], dtype=np.float64))
+            return {
+                "name": name,
+                "start": values[0],
+                "end": values[-1],
+                "N": len(values),
+                "values": values
+            }
         return {
             "name": name,
             "start": swp[0],
@@ -804,7 +839,7 @@ class ParamCollection:
     def ndSweep(self, spec):
         """ Generates a single or multidimensional sweep of parameters in such a way that only a single for loop is required to apply the parameters.
         
-        :param spec: An array of parameter sweep specifications, optionally created by :func:`paramSweepSpec`.
+        :param spec: An array of parameter sweep specifications, optionally created by :func:`paramSweepSpec`. Specifications with a `values` entry use those values instead of a linear sweep.
         :type spec: list of dict
         
         :raises Exception: If the requested sweeps exceed the bounds of a parameter.
@@ -870,7 +905,11 @@ class ParamCollection:
         for param_spec in spec:
             k = param_spec["name"]
             keys.append(k)
-            sweeps.append(self.__collection[k].linearSweep(param_spec["start"], param_spec["end"], param_spec["N"]))
+            if "values" in param_spec.keys():
+                sweeps.append(self.__collection[k].arraySweep(param_spec["values"]))
+                param_spec["N"] = len(sweeps[-1])
+            else:
+                sweeps.append(self.__collection[k].linearSweep(param_spec["start"], param_spec["end"], param_spec["N"]))
             self.sweep_grid_npts *= param_spec["N"]
         self.sweep_grid_params = keys
         self.sweep_grid_ndims = len(sweeps)
@@ -1011,8 +1050,8 @@ class ParamCollection:
         :param static_vars: A dictionary of parameters and associated values for which to get the sweep result. The values need not correspond to the actual sweep values used. The closest value found will be used and returned.
         :type static_vars: dict
         
-        :param data: A data set obtained from sweeping parameters.
-        :type data: list, np.ndarray, dict, optional
+        :param data: A data set obtained from sweeping parameters. For diagonalised evaluables with contiguous eigenvectors, only the eigenvalues are arranged.
+        :type data: list, np.ndarray, dict, tuple, :class:`pycqed.dataspec.SweepStore`, optional
         
         :param key: A string corresponding to a key if the optional `data` parameter is a `dict`.
         :type key: str, optional
@@ -1026,9 +1065,20 @@ class ParamCollection:
         if data is None:
             data = self.sweep_grid_result
         
-        # Determine if the input data is actually a list of files
+        # Determine if the input data is actually a list of files or a sweep result store
         using_tmp_files = False
-        if type(data) in [list, np.ndarray]:
+        store = None
+        contiguous = False
+        if isinstance(data, ds.SweepStore):
+            store = data
+            if store.keyed and key is None:
+                raise Exception("'key' optional parameter should be specified for 'data' of type dict (in a sweep result store).")
+            if not store.keyed:
+                key = None
+            contiguous = store.hasContiguousVectors(key)
+            data = np.arange(len(store))
+        
+        elif type(data) in [list, np.ndarray]:
         
             if type(data[0]) in [str, bytes, os.PathLike]:
                 using_tmp_files = True
@@ -1047,9 +1097,28 @@ class ParamCollection:
                 raise Exception("'key' optional parameter should be specified for 'data' of type dict.")
             data = data[key]
             
-            if type(data[0]) in [str, bytes, os.PathLike]:
+            if type(data) == tuple:
+                data = data[0]
+            elif type(data[0]) in [str, bytes, os.PathLike]:
                 using_tmp_files = True
         
+        elif type(data) == tuple:
+            
+            # The eigenvalues of contiguous eigenvectors
+            data = data[0]
+        
+        # Reads the selected entries of the data
+        def read(entries):
+            if store is not None and contiguous:
+                return [value[0] for value in store.readPoints(entries, key=key)]
+            if store is not None:
+                return store.readPoints(entries, key=key)
+            if not using_tmp_files:
+                return entries
+            if key is None:
+                return [util.pickleRead(f) for f in entries]
+            return [util.pickleRead(f)[key] for f in entries]
+        
         if type(ind_var) is str:
             # Check the independent variable exists
             if ind_var not in self.getParameterNamesList():
@@ -1061,14 +1130,8 @@ class ParamCollection:
                     raise Exception("Static variable '%s' does not exist." % k)
             
             if len(self.sweep_spec) == 1:
-                if not using_tmp_files:
-                    # FIXME: getParameterSweep will return what is asked even if data is not actually associated with that parameter sweep.
-                    return self.getParameterSweep(ind_var), np.array(data).T, {}
-                else:
-                    if key is None:
-                        return self.getParameterSweep(ind_var), np.array([util.pickleRead(f) for f in data]).T, {}
-                    else:
-                        return self.getParameterSweep(ind_var), np.array([util.pickleRead(f)[key] for f in data]).T, {}
+                # FIXME: getParameterSweep will return what is asked even if data is not actually associated with that parameter sweep.
+                return self.getParameterSweep(ind_var), np.array(read(data)).T, {}
             
             # Get the indices of the parameters in the sweep specification
             # and the length of the data arrays
@@ -1098,14 +1161,8 @@ class ParamCollection:
             res = []
             for l in final:
                 res.append(data[self.collapsedIndices(*l[::-1])])
-                
-            if not using_tmp_files:
-                return self.getParameterSweep(ind_var), np.array(res).T, static_vals
-            else:
-                if key is None:
-                    return self.getParameterSweep(ind_var), np.array([util.pickleRead(f) for f in res]).T, static_vals
-                else:
-                    return self.getParameterSweep(ind_var), np.array([util.pickleRead(f)[key] for f in res]).T, static_vals
+            
+            return self.getParameterSweep(ind_var), np.array(read(res)).T, static_vals
             
         elif type(ind_var) in [list, np.ndarray]:
             # Check the independent variables exist
@@ -1153,18 +1210,11 @@ class ParamCollection:
             res = []
             for l in final:
                 res.append(data[self.collapsedIndices(*l)])
+            res = read(res)
             
             # Get the shape of an entry in the data
-            if not using_tmp_files:
-                shape = np.array(data[self.collapsedIndices(*l)]).shape
-                return [self.getParameterSweep(iv) for iv in ind_var], np.array(res).reshape(*[Ns[iv] for iv in ind_var],*shape).T, static_vals
-            else:
-                if key is None:
-                    shape = np.array(util.pickleRead(data[self.collapsedIndices(*l)])).shape
-                    return [self.getParameterSweep(iv) for iv in ind_var], np.array([util.pickleRead(f) for f in res]).reshape(*[Ns[iv] for iv in ind_var],*shape).T, static_vals
-                else:
-                    shape = np.array(util.pickleRead(data[self.collapsedIndices(*l)])[key]).shape
-                    return [self.getParameterSweep(iv) for iv in ind_var], np.array([util.pickleRead(f)[key] for f in res]).reshape(*[Ns[iv] for iv in ind_var],*shape).T, static_vals
+            shape = np.array(res[-1]).shape
+            return [self.getParameterSweep(iv) for iv in ind_var], np.array(res).reshape(*[Ns[iv] for iv in ind_var],*shape).T, static_vals
         else:
             raise Exception("Invalid independent variable specification. Found type '%s'" % repr(type(ind_var)))
     
@@ -1186,6 +1236,11 @@ class ParamCollection:
         self.__parameterisation = data[2]
         self.__parameterisation_graph = data[3]
     
+    # Sets values without updating the parameterisations, which is only valid if the values of the affected parametric parameters are also supplied
+    def _set_sweep_values(self, values):
+        for name, value in values.items():
+            self.__collection[name].setValue(value)
+    
     # Use this with care, probably many scenarios where it would break things
     def _update_pc_internal_data(self, data):
         # Update the collection
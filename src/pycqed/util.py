@@ -73,11 +73,11 @@ def sanFloat(f, tol=1e-10):
         temp += f.imag
     return temp
 
-def diagSparseH(M, eigvalues=5, get_vectors=False, sparsesolveropts={"sigma":None, "mode":"normal", "maxiter":None, "tol":0}):
+def diagSparseH(M, eigvalues=5, get_vectors=False, sparsesolveropts={"sigma":None, "mode":"normal", "maxiter":None, "tol":0}, contiguous=False):
     """ Sparse Hermitian matrix diagonalizer. Wraps `scipy.sparse.linalg.eigsh`.
     
-    :param M: The Hermitian matrix to diagonalize.
-    :type M: qutip.qobj.Qobj
+    :param M: The Hermitian matrix to diagonalize, or a matrix-free linear operator with a `dims` attribute such as that returned by :func:`kronLinearOperator`.
+    :type M: qutip.qobj.Qobj, scipy.sparse.linalg.LinearOperator
     
     :param eigvalues: The number of lowest eigenvalues (and vectors if `get_vectors` is `True`) to compute.
     :type eigvalues: int, optional
@@ -88,19 +88,21 @@ def diagSparseH(M, eigvalues=5, get_vectors=False, sparsesolveropts={"sigma":Non
     :param sparsesolveropts: A dictionary of keyword arguments to pass to the sparse solver, see the documentation of `scipy.sparse.linalg.eigsh` for details.
     :type sparsesolveropts: dict, optional
     
-    :raises Exception: If `M` is not a qutip.qobj.Qobj instance or is not Hermitian.
+    :param contiguous: Whether to return the eigenvectors as the columns of a single array, see :func:`formatEigenvectors`.
+    :type contiguous: bool, optional
+    
+    :raises Exception: If `M` is not a qutip.qobj.Qobj instance or linear operator, or is not Hermitian.
     
-    :return: A sorted list of eigenvalues or a tuple of eigenvalues and normalised eigenvectors (as qutip.qobj.Qobj types) if `get_vectors` is `True`.
+    :return: A sorted list of eigenvalues or a tuple of eigenvalues and normalised eigenvectors (as qutip.qobj.Qobj types, or an array with shape (N, eigvalues) if `contiguous` is `True`) if `get_vectors` is `True`.
     :rtype: (numpy.ndarray, numpy.ndarray)
     """
-    if type(M) != qt.qobj.Qobj:
-        raise Exception("not a qutip Qobj instance.")
-    if not M.isherm:
+    A = _get_sparse_operand(M)
+    if type(M) == qt.qobj.Qobj and not M.isherm:
         raise Exception("matrix object is not Hermitian.")
     
     # Diagonalize with sparse matrix (default Qobj storage)
     #ret = sc.sparse.linalg.eigsh(sc.sparse.csr_matrix(M.data.todense()),k=eigvalues,return_eigenvectors=get_vectors,**sparsesolveropts)
-    ret = sc.sparse.linalg.eigsh(M.data,k=eigvalues,return_eigenvectors=get_vectors,**sparsesolveropts)
+    ret = sc.sparse.linalg.eigsh(A,k=eigvalues,return_eigenvectors=get_vectors,**sparsesolveropts)
     
     # Sort the results
     if get_vectors:
@@ -110,6 +112,9 @@ def diagSparseH(M, eigvalues=5, get_vectors=False, sparsesolveropts={"sigma":Non
         _zipped = list(zip(E, range(eigvalues)))
         _zipped.sort()
         E, perm = list(zip(*_zipped))
+        if contiguous:
+            V = V[:, list(perm)]
+            return E, formatEigenvectors(V/np.linalg.norm(V, axis=0), M.dims, contiguous=True)
         
         # Convert the vectors to Qobj while sorting and set their dimensions based on that of the original operator
         Vt = np.empty(len(perm), dtype=qt.qobj.Qobj)
@@ -125,7 +130,221 @@ def diagSparseH(M, eigvalues=5, get_vectors=False, sparsesolveropts={"sigma":Non
         ret.sort()
         return ret
 
-def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None):
+def diagSparseHWarm(M, eigvalues=5, sparsesolveropts={}, guess=None, method="eigsh"):
+    """ Warm-started sparse Hermitian matrix diagonalizer, intended for sweeps where the eigenvectors of adjacent points are nearly identical. Either wraps `scipy.sparse.linalg.eigsh`, passing a random combination of the guess eigenvectors with a small random perturbation as the starting vector, or `scipy.sparse.linalg.lobpcg`, seeding it with the whole block of guess eigenvectors. The starting vector of `eigsh` must overlap all the sought eigenvectors, which the ground state alone does not do when the Hamiltonian has a symmetry. If the residuals of the `lobpcg` eigenpairs exceed the tolerance, the matrix is diagonalised again with a cold `eigsh`.
+    
+    :param M: The Hermitian matrix to diagonalize, or a matrix-free linear operator.
+    :type M: qutip.qobj.Qobj, scipy.sparse.linalg.LinearOperator
+    
+    :param eigvalues: The number of lowest eigenvalues and vectors to compute.
+    :type eigvalues: int, optional
+    
+    :param sparsesolveropts: A dictionary of keyword arguments to pass to the sparse solver. Only `tol` and `maxiter` are used by `lobpcg`, where `tol` bounds the residual norms and defaults to that of `lobpcg`.
+    :type sparsesolveropts: dict, optional
+    
+    :param guess: The eigenvectors of a nearby matrix with shape (N, eigvalues), for example those returned by a previous call. If `None` the solver is started cold.
+    :type guess: numpy.ndarray, optional
+    
+    :param method: The solver to use, either `eigsh` or `lobpcg`.
+    :type method: str, optional
+    
+    :raises Exception: If `M` is not a qutip.qobj.Qobj instance or linear operator, or the method is not recognised.
+    
+    :return: The sorted eigenvalues, the normalised eigenvectors as a contiguous array with shape (N, eigvalues), and the number of iterations used. For `eigsh`, and for `lobpcg` when it falls back to `eigsh`, the number of matrix-vector products is reported, which is `None` when using shift-invert mode.
+    :rtype: (numpy.ndarray, numpy.ndarray, int)
+    """
+    A = _get_sparse_operand(M)
+    N = M.shape[0]
+    if guess is not None and guess.shape != (N, eigvalues):
+        guess = None
+    
+    rng = np.random.default_rng(0)
+    if method == "eigsh":
+        v0 = None
+        if guess is not None:
+            v0 = guess.dot(rng.uniform(0.5, 1.0, eigvalues))
+            v0 = v0/np.linalg.norm(v0) + 1e-2*rng.standard_normal(N)/np.sqrt(N)
+        E, V, iterations = _eigsh_counted(A, eigvalues, sparsesolveropts, v0)
+    elif method == "lobpcg":
+        if guess is None:
+            guess = rng.standard_normal((N, eigvalues)) + 0j
+        tol = sparsesolveropts.get("tol")
+        if not tol:
+            tol = np.sqrt(np.finfo(np.float64).eps)*N
+        maxiter = sparsesolveropts.get("maxiter")
+        E, V, history = sc.sparse.linalg.lobpcg(A, guess, largest=False, tol=tol, maxiter=maxiter if maxiter is not None else 200, retResidualNormsHistory=True)
+        iterations = len(history)
+        
+        # lobpcg returns its last iterate when it does not converge, the iteration limit is not meant for eigsh
+        V = V/np.linalg.norm(V, axis=0)
+        if np.any(np.linalg.norm(A.dot(V) - V*E, axis=0) > tol):
+            opts = {k: v for k, v in sparsesolveropts.items() if k != "maxiter"}
+            E, V, iterations = _eigsh_counted(A, eigvalues, opts)
+    else:
+        raise Exception("unrecognised warm-start method '%s'." % method)
+    
+    # Sort the results and normalise the vectors
+    perm = np.argsort(E)
+    V = V[:, perm]
+    return E[perm], np.ascontiguousarray(V/np.linalg.norm(V, axis=0)), iterations
+
+# Runs eigsh, counting the operator applications as the measure of convergence
+def _eigsh_counted(A, eigvalues, sparsesolveropts, v0=None):
+    N = A.shape[0]
+    opts = dict(sparsesolveropts)
+    if v0 is not None:
+        opts["v0"] = v0
+    if opts.get("sigma") is not None:
+        E, V = sc.sparse.linalg.eigsh(A, k=eigvalues, return_eigenvectors=True, **opts)
+        return E, V, None
+    counter = [0]
+    def matvec(v):
+        counter[0] += 1
+        return A.dot(v)
+    B = sc.sparse.linalg.LinearOperator((N, N), matvec=matvec, dtype=A.dtype)
+    E, V = sc.sparse.linalg.eigsh(B, k=eigvalues, return_eigenvectors=True, **opts)
+    return E, V, counter[0]
+
+def spectralLowerBound(M, steps=20):
+    """ Estimates the lowest eigenvalue of a sparse Hermitian matrix from a few Lanczos steps. The smallest Ritz value is lowered by its residual norm, and the result is clipped from below by the Gershgorin bound, which is guaranteed to be lower than the spectrum.
+    
+    :param M: The Hermitian matrix.
+    :type M: qutip.qobj.Qobj, scipy.sparse.csr_matrix
+    
+    :param steps: The number of Lanczos steps to perform.
+    :type steps: int, optional
+    
+    :return: The estimated lower bound of the spectrum.
+    :rtype: float
+    """
+    A = M.data if type(M) == qt.qobj.Qobj else M
+    N = A.shape[0]
+    gershgorin = _gershgorin_lower_bound(A)
+    
+    # Lanczos iterations with full reorthogonalisation, which is cheap for a few steps
+    steps = min(steps, N)
+    Q = np.zeros((N, steps + 1), dtype=np.complex128)
+    alpha = np.zeros(steps)
+    beta = np.zeros(steps)
+    q = np.random.default_rng(0).standard_normal(N) + 0j
+    Q[:, 0] = q/np.linalg.norm(q)
+    for j in range(steps):
+        w = A.dot(Q[:, j])
+        alpha[j] = np.vdot(Q[:, j], w).real
+        w -= np.dot(Q[:, :j+1], np.dot(Q[:, :j+1].conj().T, w))
+        beta[j] = np.linalg.norm(w)
+        if beta[j] < 1e-12:
+            steps = j + 1
+            break
+        Q[:, j+1] = w/beta[j]
+    T = np.diag(alpha[:steps]) + np.diag(beta[:steps-1], 1) + np.diag(beta[:steps-1], -1)
+    theta, S = np.linalg.eigh(T)
+    residual = np.abs(beta[steps-1]*S[steps-1, 0])
+    return max(gershgorin, theta[0] - residual)
+
+def _gershgorin_lower_bound(A):
+    d = A.diagonal().real
+    r = np.asarray(abs(A).sum(axis=1)).ravel() - np.abs(d)
+    return np.min(d - r)
+
+def diagSparseHShiftInvert(M, eigvalues=5, sparsesolveropts={}, sigma=None, cache=None):
+    """ Sparse Hermitian matrix diagonalizer using the shift-invert mode of `scipy.sparse.linalg.eigsh`, with the lowest eigenvalues targeted by a shift below the spectrum. The sparse LU factorisation of the shifted matrix is done using `scipy.sparse.linalg.splu` with diagonal pivots in a symmetric fill-reducing ordering, which is cached and reused for subsequent matrices with the same sparsity pattern. The factorisation itself is reused if the shifted matrix is unchanged.
+    
+    With diagonal pivots, the number of negative pivots is the number of eigenvalues below the shift. If a shift chosen from the eigenvalues of the previous call lies inside the spectrum, for example because the parameters changed significantly, it is lowered to the bound of :func:`spectralLowerBound` and if needed to the Gershgorin bound, which is guaranteed to lie below the spectrum.
+    
+    :param M: The Hermitian matrix to diagonalize.
+    :type M: qutip.qobj.Qobj
+    
+    :param eigvalues: The number of lowest eigenvalues and vectors to compute.
+    :type eigvalues: int, optional
+    
+    :param sparsesolveropts: A dictionary of keyword arguments to pass to `eigsh`. The `sigma`, `which` and `mode` entries are ignored.
+    :type sparsesolveropts: dict, optional
+    
+    :param sigma: The shift. If `None` it is chosen from the eigenvalues of the previous call stored in `cache`, or otherwise from :func:`spectralLowerBound`, and is checked to lie below the spectrum.
+    :type sigma: float, optional
+    
+    :param cache: A dictionary that is updated with the data to reuse in subsequent calls.
+    :type cache: dict, optional
+    
+    :raises Exception: If `M` is not a qutip.qobj.Qobj instance.
+    
+    :return: The sorted eigenvalues and the normalised eigenvectors as a contiguous array with shape (N, eigvalues).
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    if type(M) != qt.qobj.Qobj:
+        raise Exception("not a qutip Qobj instance.")
+    if cache is None:
+        cache = {}
+    N = M.shape[0]
+    
+    # Shifts below the lowest eigenvalue, tried in order until one is verified to lie below the spectrum
+    def margin(lower):
+        return lower - 1e-6*max(1.0, abs(lower))
+    # Each shift is paired with whether it is accepted if the inertia of the factorisation is unknown
+    shifts = []
+    if sigma is not None:
+        shifts.append((lambda: sigma, True))
+    else:
+        if "E" in cache:
+            
+            # By the spread of the previous eigenvalues, which is not reliable if the spectrum moved
+            E = cache["E"]
+            previous = margin(E[0] - max(E[-1] - E[0], 1e-6*max(1.0, abs(E[0]))))
+            shifts.append((lambda: previous, False))
+            shifts.append((lambda: min(previous, margin(spectralLowerBound(M))), True))
+        else:
+            shifts.append((lambda: margin(spectralLowerBound(M)), True))
+        shifts.append((lambda: margin(_gershgorin_lower_bound(M.data)), True))
+    for shift, trusted in shifts:
+        sigma = shift()
+        lu, q, negative = _factorise_shifted(M, sigma, cache)
+        if negative == 0 or (negative is None and trusted):
+            break
+    
+    # The cached symmetric ordering is undone when solving
+    def solve(b):
+        b = np.asarray(b, dtype=np.complex128)
+        x = np.empty(N, dtype=np.complex128)
+        x[q] = lu.solve(b[q])
+        return x
+    OPinv = sc.sparse.linalg.LinearOperator((N, N), matvec=solve, dtype=np.complex128)
+    
+    opts = {k: v for k, v in sparsesolveropts.items() if k not in ["sigma", "which", "mode"]}
+    E, V = sc.sparse.linalg.eigsh(M.data, k=eigvalues, sigma=sigma, which="LM", OPinv=OPinv, return_eigenvectors=True, **opts)
+    
+    # Sort the results and normalise the vectors
+    perm = np.argsort(E)
+    E = E[perm]
+    V = V[:, perm]
+    cache["E"] = E
+    cache["sigma"] = sigma
+    return E, np.ascontiguousarray(V/np.linalg.norm(V, axis=0))
+
+# Factorises a shifted Hermitian matrix with diagonal pivots in a symmetric ordering, returning the factorisation, the ordering and the number of eigenvalues below the shift if the pivots were diagonal
+def _factorise_shifted(M, sigma, cache):
+    N = M.shape[0]
+    A = (M.data - sigma*sc.sparse.identity(N, dtype=M.data.dtype, format="csr")).tocsc()
+    A.sort_indices()
+    pattern = (A.shape, A.nnz, hash(A.indptr.tobytes()), hash(A.indices.tobytes()))
+    values = hash(A.data.tobytes())
+    if cache.get("values") == (pattern, values):
+        return cache["lu"]
+    if cache.get("pattern") != pattern:
+        cache["pattern"] = pattern
+        cache["order"] = np.argsort(sc.sparse.linalg.splu(A, permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0.0, options={"SymmetricMode": True}).perm_c)
+    q = cache["order"]
+    lu = sc.sparse.linalg.splu(A[q][:, q], permc_spec="NATURAL", diag_pivot_thresh=0.0, options={"SymmetricMode": True})
+    
+    # Sylvester's law of inertia applies to the pivots if no rows were exchanged
+    negative = None
+    if np.array_equal(lu.perm_r, np.arange(N)):
+        negative = np.count_nonzero(lu.U.diagonal().real < 0)
+    cache["values"] = (pattern, values)
+    cache["lu"] = (lu, q, negative)
+    return lu, q, negative
+
+def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None, contiguous=False):
     """ Dense Hermitian matrix diagonalizer. Wraps `scipy.linalg.eigh`.
     
     :param M: The Hermitian matrix to diagonalize.
@@ -140,9 +359,12 @@ def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None):
     :param sparsesolveropts: A dictionary of keyword arguments to pass to the sparse solver. These are not used here but are included to reduce if statements where the diagonalizer functions are used.
     :type sparsesolveropts: dict, optional
     
+    :param contiguous: Whether to return the eigenvectors as the columns of a single array, see :func:`formatEigenvectors`.
+    :type contiguous: bool, optional
+    
     :raises Exception: If `M` is not a qutip.qobj.Qobj instance or is not Hermitian.
     
-    :return: A sorted list of eigenvalues or a tuple of eigenvalues and normalised eigenvectors (as qutip.qobj.Qobj types) if `get_vectors` is `True`.
+    :return: A sorted list of eigenvalues or a tuple of eigenvalues and normalised eigenvectors (as qutip.qobj.Qobj types, or an array with shape (N, eigvalues) if `contiguous` is `True`) if `get_vectors` is `True`.
     :rtype: (numpy.ndarray, numpy.ndarray)
     """
     if type(M) != qt.qobj.Qobj:
@@ -151,7 +373,7 @@ def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None):
     #    raise Exception("matrix object is not Hermitian.")
     
     # Diagonalize with dense matrix.
-    ret = sc.linalg.eigh(M.data.todense(), eigvals_only=(not get_vectors), eigvals=(0, eigvalues-1))
+    ret = sc.linalg.eigh(M.data.todense(), eigvals_only=(not get_vectors), subset_by_index=[0, eigvalues-1])
     
     # Sort the results
     if get_vectors:
@@ -161,6 +383,9 @@ def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None):
         _zipped = list(zip(E, range(eigvalues)))
         _zipped.sort()
         E, perm = list(zip(*_zipped))
+        if contiguous:
+            V = V[:, list(perm)]
+            return E, formatEigenvectors(V/np.linalg.norm(V, axis=0), M.dims, contiguous=True)
         
         # Convert the vectors to Qobj while sorting and set their dimensions based on that of the original operator
         Vt = np.empty(len(perm), dtype=qt.qobj.Qobj)
@@ -176,6 +401,622 @@ def diagDenseH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None):
         ret.sort()
         return ret
 
+def getBandwidth(M):
+    """ Gets the bandwidth of a sparse matrix, which is the largest distance of a nonzero element from the diagonal.
+    
+    :param M: The matrix.
+    :type M: scipy.sparse.spmatrix
+    
+    :return: The bandwidth.
+    :rtype: int
+    """
+    M = sc.sparse.csr_matrix(M)
+    if M.nnz == 0:
+        return 0
+    rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+    return int(np.max(np.abs(rows - M.indices)))
+
+def bandedPermutation(M, cache=None):
+    """ Gets a reverse Cuthill-McKee permutation that reduces the bandwidth of a sparse symmetric matrix. The identity permutation is returned if the reordering does not reduce the bandwidth.
+    
+    :param M: The matrix.
+    :type M: scipy.sparse.spmatrix
+    
+    :param cache: A dictionary used to store the permutation, which is reused while the sparsity pattern of the matrix is unchanged.
+    :type cache: dict, optional
+    
+    :return: The permutation and the bandwidth of the permuted matrix.
+    :rtype: (numpy.ndarray, int)
+    """
+    M = sc.sparse.csr_matrix(M)
+    if cache is not None and "banded_pattern" in cache:
+        indptr, indices = cache["banded_pattern"]
+        if np.array_equal(indptr, M.indptr) and np.array_equal(indices, M.indices):
+            return cache["banded_perm"], cache["banded_bandwidth"]
+    
+    b = getBandwidth(M)
+    perm = np.arange(M.shape[0])
+    if b > 1:
+        rcm = sc.sparse.csgraph.reverse_cuthill_mckee(M, symmetric_mode=True)
+        brcm = getBandwidth(M[rcm][:, rcm])
+        if brcm < b:
+            perm, b = rcm, brcm
+    
+    if cache is not None:
+        cache["banded_pattern"] = (M.indptr.copy(), M.indices.copy())
+        cache["banded_perm"] = perm
+        cache["banded_bandwidth"] = b
+    return perm, b
+
+def diagBandedH(M, eigvalues=5, get_vectors=False, sparsesolveropts=None, reorder=True, max_bandwidth=None, cache=None, contiguous=False):
+    """ Banded Hermitian matrix diagonalizer. The matrix is optionally reordered with a reverse Cuthill-McKee permutation to reduce its bandwidth, and is then diagonalised with `scipy.linalg.eigh_tridiagonal` if it is tridiagonal, or `scipy.linalg.eig_banded` otherwise, computing only the lowest eigenvalues. Hermitian tridiagonal matrices are first made real symmetric with a diagonal unitary transformation. The eigenvectors are transformed back to the original ordering. Matrices whose bandwidth exceeds `max_bandwidth` are diagonalised with :func:`diagDenseH` instead.
+    
+    :param M: The Hermitian matrix to diagonalize.
+    :type M: qutip.qobj.Qobj
+    
+    :param eigvalues: The number of lowest eigenvalues (and vectors if `get_vectors` is `True`) to compute.
+    :type eigvalues: int, optional
+    
+    :param get_vectors: Whether to get the associated eigenvectors.
+    :type get_vectors: bool, optional
+    
+    :param sparsesolveropts: Not used, see :func:`diagDenseH`.
+    :type sparsesolveropts: dict, optional
+    
+    :param reorder: Whether to apply a bandwidth reducing reordering.
+    :type reorder: bool, optional
+    
+    :param max_bandwidth: The largest bandwidth for which the banded solvers are used, defaults to an eighth of the dimension of the matrix.
+    :type max_bandwidth: int, optional
+    
+    :param cache: A dictionary used to store the reordering permutation, see :func:`bandedPermutation`.
+    :type cache: dict, optional
+    
+    :param contiguous: Whether to return the eigenvectors as the columns of a single array, see :func:`formatEigenvectors`.
+    :type contiguous: bool, optional
+    
+    :raises Exception: If `M` is not a qutip.qobj.Qobj instance.
+    
+    :return: A sorted list of eigenvalues or a tuple of eigenvalues and normalised eigenvectors (as qutip.qobj.Qobj types, or an array with shape (N, eigvalues) if `contiguous` is `True`) if `get_vectors` is `True`.
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    if type(M) != qt.qobj.Qobj:
+        raise Exception("not a qutip Qobj instance.")
+    N = M.shape[0]
+    if max_bandwidth is None:
+        max_bandwidth = N//8
+    
+    A = sc.sparse.csr_matrix(M.data)
+    if reorder:
+        perm, b = bandedPermutation(A, cache=cache)
+    else:
+        perm, b = np.arange(N), getBandwidth(A)
+    if b > max_bandwidth:
+        return diagDenseH(M, eigvalues=eigvalues, get_vectors=get_vectors, contiguous=contiguous)
+    A = A[perm][:, perm].tocoo()
+    
+    # Lower band storage with the diagonal as the first row
+    lower = A.row >= A.col
+    band = np.zeros((b + 1, N), dtype=np.complex128)
+    band[A.row[lower] - A.col[lower], A.col[lower]] = A.data[lower]
+    
+    if b <= 1:
+        # Remove the phases of the off-diagonal elements, such that the matrix is real symmetric
+        e = band[1, :-1] if b == 1 else np.zeros(N - 1, dtype=np.complex128)
+        ph = np.ones(N, dtype=np.complex128)
+        nz = e != 0
+        ph[1:][nz] = e[nz]/np.abs(e[nz])
+        ph = np.cumprod(ph)
+        ret = sc.linalg.eigh_tridiagonal(band[0].real, np.abs(e), eigvals_only=(not get_vectors), select="i", select_range=(0, eigvalues-1))
+        if get_vectors:
+            ret = (ret[0], ph[:, np.newaxis]*ret[1])
+    else:
+        # Forming the eigenvectors in the banded solver scales as the square of the dimension, so they are instead obtained with inverse iteration
+        ret = sc.linalg.eig_banded(band, lower=True, eigvals_only=True, select="i", select_range=(0, eigvalues-1))
+        if get_vectors:
+            ret = _banded_eigenvectors(band, ret)
+    
+    # Eigenvalues are returned in ascending order
+    if not get_vectors:
+        return ret
+    E, V = ret
+    Vp = np.empty_like(V)
+    Vp[perm] = V
+    return tuple(E), formatEigenvectors(Vp, M.dims, contiguous=contiguous)
+
+class DenseEigenWorkspace:
+    """ Reusable workspace for repeatedly diagonalising dense Hermitian matrices of the same size, for example over a parameter sweep. The matrices are written into a preallocated Fortran ordered buffer that LAPACK can overwrite directly, and only the requested lowest eigenvalues (and vectors) are computed with a subset-by-index driver.
+    
+    :param N: The dimension of the matrices.
+    :type N: int
+    
+    :param eigvalues: The number of lowest eigenvalues (and vectors if `get_vectors` is `True`) to compute.
+    :type eigvalues: int, optional
+    
+    :param get_vectors: Whether to get the associated eigenvectors.
+    :type get_vectors: bool, optional
+    
+    :param driver: The LAPACK driver to use, either `evr` or `evx`.
+    :type driver: str, optional
+    
+    :param dtype: The data type of the buffer, `numpy.float64` for real symmetric matrices, which uses the faster real arithmetic drivers, or `numpy.complex64` and `numpy.float32` for single precision.
+    :type dtype: numpy.dtype, optional
+    
+    :return: A new instance of :class:`DenseEigenWorkspace`
+    :rtype: :class:`DenseEigenWorkspace`
+    """
+    
+    def __init__(self, N, eigvalues=5, get_vectors=False, driver="evr", dtype=np.complex128):
+        self.N = N
+        self.eigvalues = eigvalues
+        self.get_vectors = get_vectors
+        self.driver = driver
+        self.H = np.zeros((N, N), dtype=dtype, order="F")
+    
+    def load(self, M):
+        """ Writes a matrix into the buffer. Sparse matrices are written into the transposed view of the buffer, which is C ordered, such that no conversion is required. The buffer then holds the complex conjugate of the Hermitian matrix, which is accounted for in :func:`diagonalize`. Matrices of a different precision to the buffer are converted.
+        
+        :param M: The Hermitian matrix.
+        :type M: qutip.qobj.Qobj, scipy.sparse.csr_matrix, numpy.ndarray
+        
+        :return: Whether the buffer holds the complex conjugate of the matrix.
+        :rtype: bool
+        """
+        A = M.data if type(M) == qt.qobj.Qobj else M
+        if sc.sparse.issparse(A):
+            A = A.tocsr()
+            if A.dtype != self.H.dtype:
+                A = sc.sparse.csr_matrix((A.data.astype(self.H.dtype), A.indices, A.indptr), shape=A.shape)
+            A.toarray(out=self.H.T)
+            return True
+        np.copyto(self.H, A, casting="unsafe")
+        return False
+    
+    def diagonalize(self, M):
+        """ Diagonalises a Hermitian matrix using the workspace buffer.
+        
+        :param M: The Hermitian matrix to diagonalize.
+        :type M: qutip.qobj.Qobj, scipy.sparse.csr_matrix, numpy.ndarray
+        
+        :return: The sorted eigenvalues, or a tuple of these and the normalised eigenvectors as the columns of an array with shape (N, eigvalues) if `get_vectors` is `True`.
+        :rtype: numpy.ndarray, (numpy.ndarray, numpy.ndarray)
+        """
+        conj = self.load(M)
+        ret = sc.linalg.eigh(self.H, eigvals_only=(not self.get_vectors), subset_by_index=[0, self.eigvalues-1], overwrite_a=True, check_finite=False, driver=self.driver)
+        
+        # Eigenvalues are returned in ascending order
+        if not self.get_vectors:
+            return ret
+        E, V = ret
+        if conj:
+            np.conjugate(V, out=V)
+        return E, V
+
+def realGauge(M, tol=1e-12, cache=None):
+    r""" Determines whether a Hermitian matrix is real symmetric, or can be made real symmetric with a diagonal unitary transformation :math:`M_r = U^\dagger M U`, where :math:`U = \mathrm{diag}(u)`. The phases are found by fixing the elements along a breadth-first spanning tree of the sparsity graph of the matrix to be real and positive, after which all other elements are checked. The eigenvectors of :math:`M` are then those of :math:`M_r` multiplied elementwise by :math:`u`.
+    
+    :param M: The Hermitian matrix.
+    :type M: qutip.qobj.Qobj, scipy.sparse.spmatrix
+    
+    :param tol: The largest imaginary part of the transformed elements, relative to the largest element, that is considered to be zero.
+    :type tol: float, optional
+    
+    :param cache: A dictionary used to store the spanning tree, which is reused while the sparsity pattern of the matrix is unchanged.
+    :type cache: dict, optional
+    
+    :return: The real symmetric matrix and the diagonal of the transformation, which is `None` if the matrix is already real, or `None` if no such transformation exists.
+    :rtype: (scipy.sparse.csr_matrix, numpy.ndarray)
+    """
+    M = sc.sparse.csr_matrix(M.data if type(M) == qt.qobj.Qobj else M)
+    if not M.has_sorted_indices:
+        M = M.sorted_indices()
+    scale = tol*max(np.max(np.abs(M.data)) if M.nnz > 0 else 0.0, 1.0)
+    if np.all(np.abs(M.data.imag) <= scale):
+        return sc.sparse.csr_matrix((M.data.real, M.indices, M.indptr), shape=M.shape), None
+    
+    # Spanning tree of the sparsity graph, grouped by depth such that each level can be assigned at once
+    N = M.shape[0]
+    tree = None
+    if cache is not None and "gauge_pattern" in cache:
+        indptr, indices = cache["gauge_pattern"]
+        if np.array_equal(indptr, M.indptr) and np.array_equal(indices, M.indices):
+            tree = cache["gauge_tree"]
+    if tree is None:
+        rows = np.repeat(np.arange(N), np.diff(M.indptr))
+        ncomp, labels = sc.sparse.csgraph.connected_components(M, directed=False)
+        pred = np.full(N, -1)
+        depth = np.zeros(N, dtype=int)
+        for c in range(ncomp):
+            order, p = sc.sparse.csgraph.breadth_first_order(M, np.argmax(labels == c), directed=False, return_predecessors=True)
+            pred[order[1:]] = p[order[1:]]
+            for n in order[1:]:
+                depth[n] = depth[pred[n]] + 1
+        
+        # Positions of the tree elements in the data array
+        nodes = np.nonzero(pred >= 0)[0]
+        keys = rows.astype(np.int64)*N + M.indices
+        pos = np.searchsorted(keys, pred[nodes].astype(np.int64)*N + nodes)
+        levels = [(nodes[depth[nodes] == d], pred[nodes[depth[nodes] == d]], pos[depth[nodes] == d]) for d in range(1, np.max(depth) + 1)]
+        tree = (rows, levels)
+        if cache is not None:
+            cache["gauge_pattern"] = (M.indptr.copy(), M.indices.copy())
+            cache["gauge_tree"] = tree
+    rows, levels = tree
+    
+    theta = np.zeros(N)
+    for nodes, parents, pos in levels:
+        theta[nodes] = theta[parents] - np.angle(M.data[pos])
+    u = np.exp(1j*theta)
+    data = u[rows].conj()*M.data*u[M.indices]
+    if np.any(np.abs(data.imag) > scale):
+        return None
+    return sc.sparse.csr_matrix((data.real, M.indices, M.indptr), shape=M.shape), u
+
+def diagDenseHBatch(M, eigvalues=5, get_vectors=False):
+    """ Batched dense Hermitian matrix diagonalizer. Wraps `numpy.linalg.eigh`, which diagonalises a stack of matrices with a single call.
+    
+    :param M: The stack of Hermitian matrices to diagonalize, with shape (B, N, N).
+    :type M: numpy.ndarray
+    
+    :param eigvalues: The number of lowest eigenvalues (and vectors if `get_vectors` is `True`) to compute.
+    :type eigvalues: int, optional
+    
+    :param get_vectors: Whether to get the associated eigenvectors.
+    :type get_vectors: bool, optional
+    
+    :raises Exception: If `M` is not a stack of square matrices.
+    
+    :return: The sorted eigenvalues with shape (B, eigvalues), or a tuple of these and the normalised eigenvectors with shape (B, N, eigvalues) if `get_vectors` is `True`.
+    :rtype: numpy.ndarray, (numpy.ndarray, numpy.ndarray)
+    """
+    if M.ndim != 3 or M.shape[1] != M.shape[2]:
+        raise Exception("not a stack of square matrices.")
+    
+    # Eigenvalues are returned in ascending order
+    if get_vectors:
+        E, V = np.linalg.eigh(M)
+        return np.ascontiguousarray(E[:, :eigvalues]), np.ascontiguousarray(V[:, :, :eigvalues])
+    else:
+        E = np.linalg.eigvalsh(M)
+        return np.ascontiguousarray(E[:, :eigvalues])
+
+def splitEigenBatch(ret, dims=None, get_vectors=False, contiguous=False):
+    """ Splits the result of :func:`diagDenseHBatch` into a list of results in the format returned by :func:`diagDenseH` for each matrix.
+    
+    :param ret: The result returned by :func:`diagDenseHBatch`.
+    :type ret: numpy.ndarray, (numpy.ndarray, numpy.ndarray)
+    
+    :param dims: The qutip dimensions of the diagonalised operators.
+    :type dims: list, optional
+    
+    :param get_vectors: Whether `ret` includes the eigenvectors.
+    :type get_vectors: bool, optional
+    
+    :param contiguous: Whether to keep the eigenvectors of each matrix as the columns of a single array, see :func:`formatEigenvectors`.
+    :type contiguous: bool, optional
+    
+    :return: A list with one entry per diagonalised matrix.
+    :rtype: list
+    """
+    if not get_vectors:
+        return [E for E in ret]
+    
+    E, V = ret
+    return [(tuple(E[b]), formatEigenvectors(V[b], dims, contiguous=contiguous)) for b in range(E.shape[0])]
+
+def refineEigenpairs(M, V):
+    """ Refines approximate eigenvectors of a Hermitian matrix, for example those computed in single precision, with a Rayleigh-Ritz projection in double precision. The eigenvalue errors are then of the order of the square of the eigenvector errors.
+    
+    :param M: The Hermitian matrix.
+    :type M: qutip.qobj.Qobj, scipy.sparse.spmatrix, numpy.ndarray
+    
+    :param V: The approximate eigenvectors as the columns of an array with shape (N, levels).
+    :type V: numpy.ndarray
+    
+    :return: The refined eigenvalues in ascending order and the associated normalised eigenvectors.
+    :rtype: (numpy.ndarray, numpy.ndarray)
+    """
+    A = M.data if type(M) == qt.qobj.Qobj else M
+    dtype = np.float64 if np.isrealobj(V) and np.isrealobj(A.data if sc.sparse.issparse(A) else A) else np.complex128
+    V = np.linalg.qr(V.astype(dtype))[0]
+    E, U = np.linalg.eigh(V.conj().T.dot(A.dot(V)))
+    return E, V.dot(U)
+
+def toQobjKets(V, dims):
+    """ Converts a contiguous array of eigenvectors to the array of `Qobj` kets used by the diagonalizers.
+    
+    :param V: The eigenvectors as the columns of an array with shape (N, levels).
+    :type V: numpy.ndarray
+    
+    :param dims: The qutip dimensions of the diagonalised operator.
+    :type dims: list
+    
+    :return: An array of `Qobj` kets.
+    :rtype: numpy.ndarray
+    """
+    # The sparse data of the kets is constructed directly, which avoids the conversion of dense arrays by Qobj
+    N = V.shape[0]
+    Vt = np.empty(V.shape[1], dtype=qt.qobj.Qobj)
+    for k in range(V.shape[1]):
+        v = np.asarray(V[:, k], dtype=np.complex128)
+        nz = np.nonzero(v)[0]
+        indptr = np.zeros(N + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum(v != 0)
+        data = qt.fastsparse.fast_csr_matrix((v[nz], np.zeros(len(nz), dtype=np.int32), indptr), shape=(N, 1))
+        Vt[k] = qt.Qobj(data, dims=[dims[0], [1] * len(dims[0])], copy=False)
+    return Vt
+
+def formatEigenvectors(V, dims, contiguous=False):
+    """ Converts a contiguous array of eigenvectors to the format returned by the diagonalizers. The eigenvectors are either an array of `Qobj` kets, see :func:`toQobjKets`, or a single complex array with the eigenvectors as its columns, which avoids the overhead of a Python object per eigenvector when many are stored.
+    
+    :param V: The eigenvectors as the columns of an array with shape (N, levels).
+    :type V: numpy.ndarray
+    
+    :param dims: The qutip dimensions of the diagonalised operator.
+    :type dims: list
+    
+    :param contiguous: Whether to return a single complex array with shape (N, levels), which is single precision if `V` is.
+    :type contiguous: bool, optional
+    
+    :return: The eigenvectors.
+    :rtype: numpy.ndarray
+    """
+    if contiguous:
+        return np.ascontiguousarray(V, dtype=np.result_type(V.dtype, np.complex64))
+    return toQobjKets(V, dims)
+
+def matrixElement(op, V, i, j):
+    """ Computes the matrix element of an operator between two eigenvectors, in either of the formats returned by the diagonalizers, see :func:`formatEigenvectors`.
+    
+    :param op: The operator.
+    :type op: qutip.qobj.Qobj
+    
+    :param V: The eigenvectors, as an array of `Qobj` kets or as the columns of an array with shape (N, levels).
+    :type V: numpy.ndarray
+    
+    :param i: The index of the eigenvector on the left.
+    :type i: int
+    
+    :param j: The index of the eigenvector on the right.
+    :type j: int
+    
+    :return: The matrix element.
+    :rtype: complex
+    """
+    if V.dtype == object:
+        return op.matrix_element(V[i], V[j])
+    return _vector_matrix_element(op, V[:, i], V[:, j])
+
+def _vector_matrix_element(op, bra, ket):
+    A = op.data if type(op) == qt.qobj.Qobj else op
+    return np.vdot(bra, A.dot(ket))
+
+def eigenvectorArray(V):
+    """ Converts eigenvectors in either of the formats returned by the diagonalizers to a complex array with the eigenvectors as its columns, see :func:`formatEigenvectors`.
+    
+    :param V: The eigenvectors, as an array of `Qobj` kets or as the columns of an array with shape (N, levels) or (points, N, levels).
+    :type V: numpy.ndarray
+    
+    :return: The eigenvectors as the columns of an array.
+    :rtype: numpy.ndarray
+    """
+    if V.dtype != object:
+        return V
+    return np.column_stack([ket.full()[:, 0] for ket in V])
+
+def reducedOperator(op, V):
+    """ Computes the matrix of an operator in the basis of a set of eigenvectors, :math:`V^\dagger O V`. The eigenvectors are stacked into a matrix, such that all the matrix elements are obtained with one sparse-dense product and one dense product. The eigenvectors of several points, for example those of a sweep with contiguous eigenvectors, are transformed with a single sparse-dense product and a stacked dense product.
+    
+    :param op: The operator.
+    :type op: qutip.qobj.Qobj, scipy.sparse.spmatrix, numpy.ndarray
+    
+    :param V: The eigenvectors, as an array of `Qobj` kets or as the columns of an array with shape (N, levels) or (points, N, levels).
+    :type V: numpy.ndarray
+    
+    :return: The reduced operator with shape (levels, levels) or (points, levels, levels).
+    :rtype: numpy.ndarray
+    """
+    A = op.data if type(op) == qt.qobj.Qobj else op
+    V = eigenvectorArray(V)
+    if V.ndim == 2:
+        return V.conj().T.dot(A.dot(V))
+    
+    # Apply the operator to the eigenvectors of all points at once
+    P, N, L = V.shape
+    AV = np.asarray(A.dot(V.transpose(1, 0, 2).reshape(N, P*L))).reshape(N, P, L).transpose(1, 0, 2)
+    return np.matmul(V.conj().transpose(0, 2, 1), AV)
+
+def matrixElements(ops, V, elements=None):
+    """ Computes the matrix elements of one or more operators between a set of eigenvectors. The eigenvectors are stacked once and the reduced operator of each operator is computed with :func:`reducedOperator`, from which the requested elements are selected.
+    
+    :param ops: The operator or a list of operators.
+    :type ops: qutip.qobj.Qobj, list
+    
+    :param V: The eigenvectors, as an array of `Qobj` kets or as the columns of an array with shape (N, levels) or (points, N, levels).
+    :type V: numpy.ndarray
+    
+    :param elements: A list of the index pairs of the matrix elements, otherwise the reduced operators are returned.
+    :type elements: list, optional
+    
+    :return: The matrix elements with shape (..., len(elements)), or the reduced operators, preceded by an axis over the operators if `ops` is a list.
+    :rtype: numpy.ndarray
+    """
+    if elements is not None:
+        
+        # Only the eigenvectors of the requested levels are used
+        levels, indices = np.unique(np.asarray(elements, dtype=np.int64).reshape(-1, 2), return_inverse=True)
+        indices = indices.reshape(-1, 2)
+        V = V[levels] if V.dtype == object else V[..., levels]
+    V = eigenvectorArray(V)
+    R = np.array([reducedOperator(op, V) for op in ops]) if type(ops) == list else reducedOperator(ops, V)
+    if elements is None:
+        return R
+    return R[..., indices[:, 0], indices[:, 1]]
+
+def expandOperator(op, left, right, cache=None):
+    r""" Expands a single mode operator into a product space as :math:`I_{left} \otimes O \otimes I_{right}`. The CSR structure of the result is computed directly from that of the operator, by gathering its nonzero elements for each row of a diagonal block and repeating the block along the diagonal, without any Kronecker products.
+    
+    :param op: The operator to expand.
+    :type op: qutip.qobj.Qobj, scipy.sparse.spmatrix
+    
+    :param left: The dimension of the identity to the left.
+    :type left: int
+    
+    :param right: The dimension of the identity to the right.
+    :type right: int
+    
+    :param cache: A dictionary to store the gather indices in, keyed by the sparsity pattern of the operator and the right dimension, such that they are reused when operators with the same structure are expanded again.
+    :type cache: dict, optional
+    
+    :return: The expanded operator.
+    :rtype: scipy.sparse.csr_matrix
+    """
+    O = sc.sparse.csr_matrix(op.data if type(op) == qt.qobj.Qobj else op)
+    O.sort_indices()
+    d = O.shape[0]
+    
+    # Gather indices of a single diagonal block
+    key = (right, d, O.indptr.tobytes(), O.indices.tobytes())
+    if cache is not None and key in cache:
+        gather, indices, counts = cache[key]
+    else:
+        lens = np.diff(O.indptr)
+        rows = np.arange(d*right)
+        counts = lens[rows//right]
+        row_of_entry = np.repeat(rows, counts)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        offset = np.arange(len(row_of_entry)) - np.repeat(starts, counts)
+        gather = O.indptr[row_of_entry//right] + offset
+        indices = O.indices[gather]*right + row_of_entry % right
+        if cache is not None:
+            cache[key] = (gather, indices, counts)
+    
+    # Repeat the block along the diagonal
+    nnz = len(gather)
+    data = np.tile(O.data[gather], left)
+    indices = (indices[None, :] + (d*right*np.arange(left))[:, None]).ravel()
+    indptr = np.concatenate(([0], np.cumsum(np.tile(counts, left))))
+    return sc.sparse.csr_matrix((data, indices, indptr), shape=(d*right*left, d*right*left))
+
+def sparseDiagonal(M):
+    """ Gets the diagonal of a matrix if it has no nonzero off-diagonal elements.
+    
+    :param M: The matrix.
+    :type M: qutip.qobj.Qobj, scipy.sparse.spmatrix
+    
+    :return: The diagonal, or `None` if the matrix is not diagonal.
+    :rtype: numpy.ndarray
+    """
+    M = sc.sparse.csr_matrix(M.data if type(M) == qt.qobj.Qobj else M)
+    rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+    if np.any(M.data[rows != M.indices] != 0):
+        return None
+    return M.diagonal()
+
+def kronLinearOperator(dims, terms, coefs, dtype=np.complex128):
+    r""" Creates a matrix-free linear operator for a weighted sum of Kronecker products of small per-mode factors, :math:`\sum_k c_k \bigotimes_m F_{km}`, where the modes without a factor in a term are acted upon by the identity. A product is applied by contracting each of its factors with the corresponding axis of the vector reshaped to the mode dimensions, such that the full matrix is never constructed. Terms acting on a single mode are summed into one factor per mode beforehand.
+    
+    :param dims: The dimensions of the modes.
+    :type dims: list of int
+    
+    :param terms: For each term, a dictionary of the dense or sparse factors keyed by mode index.
+    :type terms: list of dict
+    
+    :param coefs: The coefficients of the terms.
+    :type coefs: list, numpy.ndarray
+    
+    :param dtype: The data type of the operator.
+    :type dtype: numpy.dtype, optional
+    
+    :return: The linear operator, with the qutip dimensions available as the `dims` attribute.
+    :rtype: scipy.sparse.linalg.LinearOperator
+    """
+    dims = [int(d) for d in dims]
+    N = int(np.prod(dims))
+    
+    # Merge the constant and single mode terms
+    scalar = 0.0
+    local = {}
+    products = []
+    for c, factors in zip(coefs, terms):
+        if c == 0.0:
+            continue
+        if len(factors) == 0:
+            scalar += c
+        elif len(factors) == 1:
+            m, F = list(factors.items())[0]
+            local[m] = c*F if m not in local else local[m] + c*F
+        else:
+            products.append((c, factors))
+    
+    def apply_factor(F, X, m):
+        Xm = np.moveaxis(X, m, 0)
+        shape = Xm.shape
+        Y = F @ Xm.reshape(shape[0], -1)
+        return np.moveaxis(np.asarray(Y).reshape(F.shape[0], *shape[1:]), 0, m)
+    
+    def matmat(X):
+        X = np.asarray(X)
+        k = X.shape[1]
+        X = X.reshape(*dims, k)
+        Y = scalar*X.astype(np.result_type(dtype, X.dtype))
+        for m, F in local.items():
+            Y += apply_factor(F, X, m)
+        for c, factors in products:
+            Z = X
+            for m, F in factors.items():
+                Z = apply_factor(F, Z, m)
+            Y += c*Z
+        return Y.reshape(N, k)
+    
+    def matvec(v):
+        return matmat(np.asarray(v).reshape(N, 1)).reshape(np.shape(v))
+    
+    op = sc.sparse.linalg.LinearOperator((N, N), matvec=matvec, rmatvec=matvec, matmat=matmat, dtype=dtype)
+    op.dims = [dims, dims]
+    return op
+
+def displacementOperator(trunc, alpha, band=None):
+    r""" Gets the matrix of the displacement operator :math:`D(\alpha) = e^{\alpha a^\dagger - \alpha^* a}` in a truncated Fock basis. The matrix elements are those of the untruncated operator, evaluated in closed form using associated Laguerre polynomials
+    
+    .. math:: \langle m|D(\alpha)|n\rangle = \sqrt{\frac{n!}{m!}}\alpha^{m-n}e^{-|\alpha|^2/2}L_n^{(m-n)}(|\alpha|^2)
+    
+    for :math:`m \geq n`, and :math:`\langle m|D(\alpha)|n\rangle = \langle n|D(-\alpha)|m\rangle^*` otherwise.
+    
+    :param trunc: The number of Fock states.
+    :type trunc: int
+    
+    :param alpha: The displacement.
+    :type alpha: complex
+    
+    :param band: If specified, only the elements with :math:`|m-n| \leq` `band` are computed and a sparse matrix is returned.
+    :type band: int, optional
+    
+    :return: The displacement operator matrix.
+    :rtype: numpy.ndarray, scipy.sparse.csr_matrix
+    """
+    if band is None:
+        m, n = np.indices((trunc, trunc))
+    else:
+        offsets = np.arange(-min(band, trunc-1), min(band, trunc-1)+1)
+        m = np.concatenate([np.arange(max(0, -d), min(trunc, trunc-d)) for d in offsets])
+        n = np.concatenate([np.arange(max(d, 0), min(trunc, trunc+d)) for d in offsets])
+    lo = np.minimum(m, n)
+    k = np.abs(m - n)
+    
+    # Evaluate the magnitude of the prefactor in log space to avoid overflowing factorials
+    x = np.abs(alpha)**2
+    if x == 0.0:
+        vals = (k == 0).astype(np.complex128)
+    else:
+        logpre = 0.5*(sc.special.gammaln(lo + 1) - sc.special.gammaln(lo + k + 1)) + k*np.log(np.abs(alpha)) - 0.5*x
+        unit = np.where(m >= n, alpha, -np.conj(alpha))/np.abs(alpha)
+        vals = np.exp(logpre)*unit**k*sc.special.eval_genlaguerre(lo, k, x)
+    
+    if band is None:
+        return vals
+    return sc.sparse.csr_matrix((vals, (m, n)), shape=(trunc, trunc))
+
 def getACStarkShift(Erwa):
     """ Returns the circuit AC stark shift as a function of the average photon number in a linear resonator.
     
@@ -304,7 +1145,7 @@ def pauliCoefficients(E, V, basis_op):
     :param E: A two-dimensional list of eigenvalues, the first index corresponding to the state number, and the second corresponding to the value of a swept variable, usually an external charge or flux depending on the qubit type.
     :type E: numpy.ndarray
     
-    :param V: The eigenvectors corresponding to the supplied eigenvalues. The eigenvectors themselves should be `Qobj` instances.
+    :param V: The eigenvectors corresponding to the supplied eigenvalues. The eigenvectors themselves should be `Qobj` instances indexed in the same way as `E`, or the columns of a complex array with shape (points, N, levels) as returned by sweeps with contiguous eigenvectors.
     :type V: numpy.ndarray
     
     :param basis_op: A list or a single operator that defines the computational basis. Usually the persistent current for a flux qubit or the charge number for a charge qubit.
@@ -317,13 +1158,16 @@ def pauliCoefficients(E, V, basis_op):
     """
     
     def get_subspace_operator(V0, V1, Oq, i):
-        Op = np.asmatrix(np.eye(2), dtype=np.complex64)
+        Op = np.asmatrix(np.eye(2), dtype=np.complex128)
         Op[0, 0] = Oq.matrix_element(V0, V0)
         Op[0, 1] = Oq.matrix_element(V0, V1)
         Op[1, 0] = Oq.matrix_element(V1, V0)
         Op[1, 1] = Oq.matrix_element(V1, V1)
         return Op
     
+    def get_vector_subspace_operator(V0, V1, Oq, i):
+        return np.asmatrix(Oq[i], dtype=np.complex128)
+    
     def ret_subspace_operator(V0, V1, Oq, i):
         return Oq[i]
     
@@ -338,15 +1182,24 @@ def pauliCoefficients(E, V, basis_op):
         raise Exception("incompatible input types for E (%s), V (%s) and basis_op (%s)." % (type(E), type(V), type(basis_op)))
     
     # Get Paulis
-    ox = np.asmatrix(qt.sigmax().data.todense(), dtype=np.complex64)
-    oy = np.asmatrix(qt.sigmay().data.todense(), dtype=np.complex64)
-    oz = np.asmatrix(qt.sigmaz().data.todense(), dtype=np.complex64)
+    ox = np.asmatrix(qt.sigmax().data.todense(), dtype=np.complex128)
+    oy = np.asmatrix(qt.sigmay().data.todense(), dtype=np.complex128)
+    oz = np.asmatrix(qt.sigmaz().data.todense(), dtype=np.complex128)
     
     # Get ground and first excited states
     E0 = E[0, :]
     E1 = E[1, :]
-    V0 = V[0, :]
-    V1 = V[1, :]
+    if type(V) == np.ndarray and V.dtype != object:
+        V0 = V[:, :, 0]
+        V1 = V[:, :, 1]
+        
+        # The subspace operators of all points are computed together
+        if op_func == get_subspace_operator:
+            basis_op = reducedOperator(basis_op, V[:, :, :2])
+            op_func = get_vector_subspace_operator
+    else:
+        V0 = V[0, :]
+        V1 = V[1, :]
     
     # Get the Pauli prefactors
     hx = []
@@ -363,7 +1216,7 @@ def pauliCoefficients(E, V, basis_op):
         
         # Create computational basis subspace operator
         Op = op_func(V0[i], V1[i], basis_op, i)
-        #Op = np.asmatrix(np.eye(2), dtype=np.complex64)
+        #Op = np.asmatrix(np.eye(2), dtype=np.complex128)
         #Op[0,0] = (V0[i].dag()*Oq[i]*V0[i])[0][0][0]
         #Op[0,1] = (V0[i].dag()*Oq[i]*V1[i])[0][0][0]
         #Op[1,0] = (V1[i].dag()*Oq[i]*V0[i])[0][0][0]
@@ -376,11 +1229,11 @@ def pauliCoefficients(E, V, basis_op):
         Vl = np.array([np.abs(Vl[0, k])/Vl[0, k] * Vl[:, k] for k in (0, 1)])
         
         # Create the unitary
-        U = np.asmatrix(Vl.T, dtype=np.complex64)
+        U = np.asmatrix(Vl.T, dtype=np.complex128)
         Udag = U.conjugate().T
         
         # Create Hq prime
-        Hqp = np.asmatrix(np.diag([E0[i], E1[i]]), dtype=np.complex64)
+        Hqp = np.asmatrix(np.diag([E0[i], E1[i]]), dtype=np.complex128)
         
         # Apply the transformation
         Hq = mdot(Udag, Hqp, U)
@@ -394,12 +1247,14 @@ def pauliCoefficients(E, V, basis_op):
 def getEigenValuesAndVectors(sweep):
     """ Convenience function to separate the eigenvalues from the eigenvectors of a parameter sweep returned by :func:`pycqed.src.HamilSpec.getSweep`. When the diagonaliser is configured to return both eigenvalues and vectors, the dtype of the `numpy.ndarray` will be `object`, which results in conversion issues for example in `matplotlib`. This function performs the conversion of the `numpy.ndarray` dtype.
     
-    :param sweep: The sweep structure returned by :func:`pycqed.src.HamilSpec.getSweep`.
-    :type sweep: numpy.ndarray
+    :param sweep: The sweep structure returned by :func:`pycqed.src.HamilSpec.getSweep`. Sweeps with contiguous eigenvectors already separate them and are returned as is.
+    :type sweep: numpy.ndarray, tuple
     
-    :return: The eigenvalues as `numpy.float64` types and eigenvectors as `object` types contained in `sweep`.
+    :return: The eigenvalues as `numpy.float64` types and eigenvectors as `object` types contained in `sweep`, or as a complex array with shape (points, N, levels) for contiguous eigenvectors.
     :rtype: (numpy.ndarray, numpy.ndarray)
     """
+    if type(sweep) == tuple:
+        return sweep
     return (sweep[:,0].astype(np.float64), sweep[:,1])
 
 def getExpectationValues(sweep):
@@ -494,6 +1349,40 @@ def stateFromBitstring(bitstring):
 #
 # Internal
 #
+def _banded_eigenvectors(band, E, iterations=2):
+    # Inverse iteration from random vectors with the shifted banded matrix, followed by a Rayleigh-Ritz projection to orthogonalise the vectors of close eigenvalues
+    b = band.shape[0] - 1
+    N = band.shape[1]
+    full = np.zeros((2*b + 1, N), dtype=np.complex128)
+    full[b:] = band
+    for k in range(1, b + 1):
+        full[b - k, k:] = band[k, :N - k].conj()
+    
+    rng = np.random.default_rng(0)
+    V = rng.standard_normal((N, len(E))) + 0j
+    for k, e in enumerate(E):
+        shifted = full.copy()
+        shifted[b] -= e + 1e-10*max(1.0, abs(e))
+        for it in range(iterations):
+            V[:, k] = sc.linalg.solve_banded((b, b), shifted, V[:, k], check_finite=False)
+            V[:, k] /= np.linalg.norm(V[:, k])
+    V = np.linalg.qr(V)[0]
+    
+    # Product of the Hermitian banded matrix with the vectors
+    AV = band[0][:, np.newaxis]*V
+    for k in range(1, b + 1):
+        AV[k:] += band[k, :N - k, np.newaxis]*V[:N - k]
+        AV[:N - k] += band[k, :N - k, np.newaxis].conj()*V[k:]
+    Er, U = np.linalg.eigh(V.conj().T.dot(AV))
+    return Er, V.dot(U)
+
+def _get_sparse_operand(M):
+    if type(M) == qt.qobj.Qobj:
+        return M.data
+    if isinstance(M, sc.sparse.linalg.LinearOperator):
+        return M
+    raise Exception("not a qutip Qobj instance or linear operator.")
+
 def _get_permutation_matrices(M):
     a = np.arange(M)
     perm_mat = []
@@ -0,0 +1,256 @@
+import os
+import numpy as np
+import pytest
+import qutip as qt
+
+from pycqed import dataspec as ds
+from pycqed import util
+from pycqed import CircuitGraph, SymbolicSystem, NumericalSystem
+
+@pytest.fixture
+def temp():
+    data = ds.TempData()
+    data.newSession(id(data))
+    yield data
+    data.clearSessionData()
+
+def fluxonium(trunc=30):
+    graph = CircuitGraph()
+    graph.addBranch(0, 1, "C")
+    graph.addBranch(0, 1, "L")
+    graph.addBranch(0, 1, "I")
+    hamil = NumericalSystem(SymbolicSystem(graph))
+    hamil.configureOperator(1, trunc, "oscillator")
+    hamil.setParameterValues('C', 60.0*0.24, 'I', 3.0*0.24, 'L', 570.0, 'phi10-2e', 0.5)
+    hamil.setDiagConfig(eigvalues=5)
+    return hamil
+
+def eigen_point(k, N=6, levels=3, contiguous=True):
+    E = np.arange(levels, dtype=np.float64) + k
+    V = np.linalg.qr(np.random.default_rng(k).normal(size=(N, levels)) + 1j)[0]
+    if contiguous:
+        return E, V
+    kets = np.empty(levels, dtype=object)
+    for l in range(levels):
+        kets[l] = qt.Qobj(V[:, l:l+1], dims=[[N], [1]])
+    return E, kets
+
+################################################################################
+#       Temporary Files
+################################################################################
+
+def test_write_part_round_trip(temp):
+    data = [{"E": np.arange(5.0)*i} for i in range(100)]
+    files = [temp.writePart(value) for value in data]
+    for f, value in zip(files, data):
+        assert np.array_equal(temp.readPart(f)["E"], value["E"])
+    
+    # Files read without readPart must be flushed first
+    temp.flushWrites()
+    assert np.array_equal(util.pickleRead(files[-1])["E"], data[-1]["E"])
+
+def test_sweep_of_part_files():
+    hamil = fluxonium()
+    hamil.setStorageConfig(memory_budget=None)
+    hamil.addSweep('L', 400.0, 600.0, 5)
+    sweep = hamil.paramSweep()
+    x, E, v = hamil.getSweep(sweep, 'L', {})
+    
+    # getSweep waits for the files to be written
+    files = [hamil.writePart(point) for point in sweep]
+    x_files, E_files, v = hamil.getSweep(files, 'L', {})
+    assert np.array_equal(x, x_files)
+    assert np.array_equal(E, E_files)
+
+def test_clear_session_reports_write_errors(temp, capsys):
+    def fail():
+        raise IOError("disk full")
+    temp.getWriter().submit(fail)
+    temp.clearSessionData()
+    assert "disk full" in capsys.readouterr().out
+    assert temp.writer is None
+
+def test_disk_quota_evicts_least_recently_used(temp):
+    stores = []
+    for s in range(3):
+        store = temp.newSweepStore(chunk_size=4)
+        for k in range(8):
+            store.appendPoint(np.full(128, s + k, dtype=np.float64))
+        store.close()
+        stores.append(store)
+    
+    # Reading the first store makes the second the least recently used
+    for f in os.listdir(stores[1].path):
+        os.utime(stores[1].path + f, (0, 0))
+    stores[0].readPoints([0])
+    size = 8*128*8
+    temp.setDiskQuota(4*size)
+    temp.enforceDiskQuota(reserve=size)
+    
+    assert not os.path.isdir(stores[1].path)
+    assert np.array_equal(stores[0].readPoints([3])[0], np.full(128, 3.0))
+    assert np.array_equal(stores[2].readPoints([3])[0], np.full(128, 5.0))
+    with pytest.raises(Exception):
+        stores[1].readPoints([0])
+
+################################################################################
+#       Asynchronous Writer
+################################################################################
+
+def test_async_writer_propagates_errors():
+    def fail():
+        raise IOError("disk full")
+    done = []
+    writer = ds.AsyncWriter(maxsize=2)
+    writer.submit(done.append, 1)
+    writer.submit(fail)
+    writer.submit(done.append, 2)
+    with pytest.raises(Exception, match="disk full"):
+        writer.flush()
+    
+    # The operations queued after the failure are discarded, later ones run
+    assert done == [1]
+    writer.submit(done.append, 3)
+    writer.close()
+    assert done == [1, 3]
+
+def test_store_close_raises_write_errors(tmp_path):
+    writer = ds.AsyncWriter()
+    store = ds.SweepStore(str(tmp_path / "store") + os.sep, chunk_size=2, writer=writer)
+    for k in range(4):
+        store.appendPoint(np.arange(3.0) + k)
+    writer.flush()
+    
+    # Remove the directory such that the next chunk cannot be written
+    for f in os.listdir(store.path):
+        os.remove(store.path + f)
+    os.rmdir(store.path)
+    store.appendPoint(np.arange(3.0))
+    with pytest.raises(Exception, match="Asynchronous write failed"):
+        store.close()
+    writer.close()
+
+################################################################################
+#       Sweep Store
+################################################################################
+
+@pytest.mark.parametrize("writer", [False, True])
+def test_store_round_trip(tmp_path, writer):
+    writer = ds.AsyncWriter() if writer else None
+    path = str(tmp_path / "store") + os.sep
+    store = ds.SweepStore(path, chunk_size=3, writer=writer)
+    store.setSweepSpec([{"name": "x", "values": np.linspace(0, 1, 10)}])
+    points = [{"a": np.arange(4.0)*k, "b": {"k": k}, "c": k + 0.5} for k in range(10)]
+    for k, point in enumerate(points):
+        assert store.appendPoint(point) == k
+    store.close()
+    
+    # Reopening the directory reads the same results
+    for s in [store, ds.SweepStore(path)]:
+        assert len(s) == 10
+        assert np.array_equal(s.readPoints(range(10), key="a"), [p["a"] for p in points])
+        assert s.readPoints([2, 7], key="b") == [{"k": 2}, {"k": 7}]
+        assert np.array_equal(s.readPoints([9, 0], key="c"), [9.5, 0.5])
+        assert s.sweep[0]["values"] == np.linspace(0, 1, 10).tolist()
+    if writer is not None:
+        writer.close()
+
+def test_store_order(tmp_path):
+    store = ds.SweepStore(str(tmp_path / "store") + os.sep, chunk_size=2)
+    order = [3, 0, 4, 1, 2]
+    for k in order:
+        store.appendPoint(np.array([k], dtype=np.float64))
+    
+    # Position of the result of each grid point in the store
+    store.setOrder(np.argsort(order))
+    store.close()
+    assert np.array_equal(store.readPoints(range(5))[:, 0], np.arange(5.0))
+    assert np.array_equal(ds.SweepStore(store.path).readPoints([4, 1])[:, 0], [4.0, 1.0])
+
+def test_store_keyed_and_unkeyed(tmp_path):
+    unkeyed = ds.SweepStore(str(tmp_path / "unkeyed") + os.sep)
+    keyed = ds.SweepStore(str(tmp_path / "keyed") + os.sep)
+    for k in range(4):
+        unkeyed.appendPoint(np.arange(2.0) + k)
+        keyed.appendPoint({"x": np.arange(2.0) + k, "y": -k})
+    
+    # Unkeyed results are read directly, keyed ones by evaluable or as dictionaries
+    assert np.array_equal(unkeyed.readPoints([1]), [[1.0, 2.0]])
+    assert np.array_equal(keyed.readPoints([1], key="x"), [[1.0, 2.0]])
+    points = keyed.readPoints([1, 3])
+    assert [p["y"] for p in points] == [-1, -3]
+    assert np.array_equal(points[1]["x"], [3.0, 4.0])
+    with pytest.raises(Exception):
+        keyed.readPoints([0], key="z")
+    with pytest.raises(Exception):
+        keyed.appendPoint({"x": np.arange(2.0)})
+
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_store_eigenvectors(tmp_path, contiguous):
+    store = ds.SweepStore(str(tmp_path / "store") + os.sep, chunk_size=2)
+    points = [eigen_point(k, contiguous=contiguous) for k in range(5)]
+    for point in points:
+        store.appendPoint({"getHamiltonian": point})
+    store.close()
+    
+    assert store.hasContiguousVectors("getHamiltonian") == contiguous
+    for (E, V), (E_ref, V_ref) in zip(store.readPoints(range(5), key="getHamiltonian"), points):
+        assert np.array_equal(E, E_ref)
+        if contiguous:
+            assert np.array_equal(V, V_ref)
+        else:
+            assert all(ket.dims == ket_ref.dims for ket, ket_ref in zip(V, V_ref))
+            assert np.allclose(np.column_stack([ket.full()[:, 0] for ket in V]), np.column_stack([ket.full()[:, 0] for ket in V_ref]))
+
+################################################################################
+#       Sweep Results on Disk
+################################################################################
+
+def sweep_on(hamil, memory_budget, configure, adaptive=False):
+    hamil.setStorageConfig(memory_budget=memory_budget)
+    configure(hamil)
+    if adaptive:
+        return hamil.paramSweepAdaptive(tol=1.0, max_depth=2)
+    return hamil.paramSweep()
+
+@pytest.mark.parametrize("case", ["1d", "2d", "adaptive"])
+def test_disk_and_ram_sweeps_agree(case):
+    def configure(hamil):
+        if case == "2d":
+            hamil.addSweep('phi10-2e', 0.4, 0.5, 3)
+        hamil.addSweep('L', 400.0, 600.0, 5)
+    
+    results = []
+    for memory_budget in [None, 0]:
+        hamil = fluxonium()
+        sweep = sweep_on(hamil, memory_budget, configure, adaptive=(case == "adaptive"))
+        assert isinstance(sweep, ds.SweepStore) == (memory_budget == 0)
+        static = {'phi10-2e': 0.5} if case == "2d" else {}
+        x, E, v = hamil.getSweep(sweep, 'L', static)
+        results.append((np.asarray(x, dtype=np.float64), np.asarray(E, dtype=np.float64)))
+    
+    assert np.array_equal(results[0][0], results[1][0])
+    if case == "adaptive":
+        assert len(results[0][0]) > 5
+    assert np.allclose(results[0][1], results[1][1])
+
+@pytest.mark.parametrize("get_vectors", [False, True])
+def test_memory_budget_selects_storage(get_vectors):
+    # The eigenvalues fit in the budget, the eigenvectors do not
+    results = []
+    for memory_budget in [4096, None]:
+        hamil = fluxonium()
+        hamil.setDiagConfig(eigvalues=5, get_vectors=get_vectors, contiguous=True)
+        hamil.setStorageConfig(memory_budget=memory_budget)
+        hamil.addSweep('L', 400.0, 600.0, 5)
+        sweep = hamil.paramSweep()
+        assert isinstance(sweep, ds.SweepStore) == (get_vectors and memory_budget is not None)
+        if isinstance(sweep, ds.SweepStore):
+            results.append((np.array(sweep.getColumn("/E")), np.array(sweep.getColumn("/V"))))
+        else:
+            results.append(util.getEigenValuesAndVectors(sweep) if get_vectors else (np.asarray(sweep, dtype=np.float64), None))
+    
+    (E, V), (E_ref, V_ref) = results
+    assert np.allclose(E, E_ref)
+    if get_vectors:
+        assert np.allclose(V, V_ref)
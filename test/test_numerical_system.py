@@ -0,0 +1,649 @@
+import numpy as np
+import pytest
+import qutip as qt
+
+from pycqed import CircuitGraph, SymbolicSystem, NumericalSystem
+from pycqed import util
+
+def fluxonium(trunc=50):
+    graph = CircuitGraph()
+    graph.addBranch(0, 1, "C")
+    graph.addBranch(0, 1, "L")
+    graph.addBranch(0, 1, "I")
+    hamil = NumericalSystem(SymbolicSystem(graph))
+    hamil.configureOperator(1, trunc, "oscillator")
+    hamil.setParameterValues('C', 60.0*0.24, 'I', 3.0*0.24, 'L', 570.0, 'phi10-2e', 0.5)
+    return hamil
+
+def split_transmon(trunc=30):
+    graph = CircuitGraph()
+    graph.addBranch(0, 1, "C")
+    graph.addBranch(0, 1, "I1")
+    graph.addBranch(0, 1, "I2")
+    graph.addChargeBias(1, "Cg1")
+    hamil = NumericalSystem(SymbolicSystem(graph))
+    hamil.configureOperator(1, trunc, "charge")
+    hamil.setParameterValues('C', 50.0, 'I1', 0.002, 'I2', 0.002, 'Cg1', 1.0, 'Q1e', 0.5, 'phi10-2e', 0.0)
+    return hamil
+
+def coupled_qubits(trunc_osc=15, trunc_chg=5):
+    # A fluxonium capacitively coupled to a charge biased transmon, in mixed bases
+    graph = CircuitGraph()
+    graph.addBranch(0, 1, "C1")
+    graph.addBranch(0, 1, "L1")
+    graph.addBranch(0, 1, "I1")
+    graph.addBranch(0, 2, "C2")
+    graph.addBranch(0, 2, "I2")
+    graph.addBranch(1, 2, "Cc")
+    graph.addChargeBias(2, "Cg2")
+    hamil = NumericalSystem(SymbolicSystem(graph))
+    hamil.configureOperator(1, trunc_osc, "oscillator")
+    hamil.configureOperator(2, trunc_chg, "charge")
+    hamil.setParameterValues('C1', 14.4, 'L1', 570.0, 'I1', 0.72, 'C2', 50.0, 'I2', 0.02, 'Cc', 1.0, 'Cg2', 1.0, 'Q2e', 0.3, 'phi10-2e', 0.5)
+    return hamil
+
+def coupled_transmons(trunc=4):
+    # Two capacitively coupled charge biased transmons, both in the charge basis
+    graph = CircuitGraph()
+    graph.addBranch(0, 1, "C1")
+    graph.addBranch(0, 1, "I1")
+    graph.addBranch(0, 2, "C2")
+    graph.addBranch(0, 2, "I2")
+    graph.addBranch(1, 2, "Cc")
+    graph.addChargeBias(1, "Cg1")
+    graph.addChargeBias(2, "Cg2")
+    hamil = NumericalSystem(SymbolicSystem(graph))
+    hamil.configureOperator(1, trunc, "charge")
+    hamil.configureOperator(2, trunc, "charge")
+    hamil.setParameterValues('C1', 50.0, 'I1', 0.02, 'C2', 60.0, 'I2', 0.03, 'Cc', 2.0, 'Cg1', 1.0, 'Cg2', 1.0, 'Q1e', 0.2, 'Q2e', 0.4)
+    return hamil
+
+def sweep_energies(hamil, name, start, end, npts, **kwargs):
+    hamil.addSweep(name, start, end, npts)
+    sweep = hamil.paramSweep(**kwargs)
+    x, E, v = hamil.getSweep(sweep, name, {})
+    return np.asarray(E, dtype=np.float64).T
+
+def direct_energies(hamil, name, values, levels=5):
+    E = []
+    for value in values:
+        hamil.setParameterValues(name, value)
+        E.append(hamil.getHamiltonian().eigenenergies()[:levels])
+    return np.array(E)
+
+################################################################################
+#       Oscillator Impedance Sweeps
+################################################################################
+
+@pytest.mark.parametrize("name, values", [
+    ("L", [200.0, 400.0, 600.0]),
+    ("C", [10.0, 15.0, 20.0])
+])
+def test_impedance_sweep_matches_direct(name, values):
+    # The oscillator operators are regenerated at every point of these sweeps
+    hamil = fluxonium()
+    hamil.addSweep(name, values[0], values[-1], len(values))
+    sweep = hamil.paramSweep()
+    x, E, v = hamil.getSweep(sweep, name, {})
+    assert np.allclose(x, values)
+    
+    ref = direct_energies(fluxonium(), name, values)
+    assert np.allclose(np.asarray(E, dtype=np.float64).T, ref, rtol=1e-9, atol=1e-9)
+
+@pytest.mark.parametrize("osc_cache_size", [0, 1, 16])
+def test_cached_impedance_sweep_matches_direct(osc_cache_size):
+    # The impedances repeat in the inner sweep, so the cached operators are reused
+    hamil = fluxonium(trunc=30)
+    hamil.setHamiltonianConfig(osc_cache_size=osc_cache_size)
+    hamil.addSweep('phi10-2e', 0.3, 0.5, 2)
+    hamil.addSweep('L', 400.0, 600.0, 3)
+    sweep = hamil.paramSweep()
+    assert len(hamil.osc_cache) == min(osc_cache_size, 3)
+    
+    for phi in [0.3, 0.5]:
+        x, E, v = hamil.getSweep(sweep, 'L', {'phi10-2e': phi})
+        reference = fluxonium(trunc=30)
+        reference.setParameterValues('phi10-2e', phi)
+        E_ref = direct_energies(reference, 'L', [400.0, 500.0, 600.0])
+        assert np.allclose(np.asarray(E, dtype=np.float64).T, E_ref, rtol=1e-9, atol=1e-9)
+
+def test_banded_oscillator_operators_match_dense():
+    hamil = fluxonium()
+    E = hamil.getHamiltonian().eigenenergies()[:5]
+    hamil.setHamiltonianConfig(osc_band=40)
+    hamil.prepareOperators()
+    assert hamil.getOperatorList(1)[2].data.nnz < 50*50
+    assert np.allclose(hamil.getHamiltonian().eigenenergies()[:5], E, rtol=1e-9, atol=1e-9)
+
+################################################################################
+#       Node Operators
+################################################################################
+
+def reference_conjugate(labels):
+    # Sum over the Fourier transformed number states, as the operators were built before
+    N = len(labels)
+    k = np.arange(N) - (N - 1)//2
+    phik = np.exp(2j*np.pi*np.outer(labels, k)/N)/np.sqrt(N)
+    return (phik*(k/N))@phik.conj().T
+
+def reference_exponential(M):
+    # Exponentiate through the eigendecomposition, removing the wrap around term
+    E, V = np.linalg.eigh(M)
+    D = (V*np.exp(-2j*np.pi*E))@np.linalg.inv(V)
+    D[-1, 0] -= 1.0
+    return D
+
+@pytest.mark.parametrize("basis, trunc", [
+    ("charge", 3),
+    ("charge", 10),
+    ("flux", 3),
+    ("flux", 10),
+    ("discretized_flux", 10)
+])
+def test_node_operators_match_reference(basis, trunc):
+    hamil = split_transmon(trunc=trunc)
+    hamil.configureOperator(1, trunc, basis)
+    Q, P, D, Ddag, S, Sdag = [op.full() for op in hamil.getOperatorList(1)]
+    labels = float(trunc) - np.arange(2*trunc + 1)
+    
+    if basis == "charge":
+        Q_ref = np.diag(labels)
+        P_ref = reference_conjugate(labels)
+        D_ref = reference_exponential(P_ref)
+        S_ref = np.diag(np.exp(-2j*np.pi*labels))
+    elif basis == "flux":
+        P_ref = np.diag(labels)
+        Q_ref = reference_conjugate(labels)
+        D_ref = reference_exponential(P_ref)
+        S_ref = reference_exponential(Q_ref)
+    else:
+        grid = np.linspace(-4.0, 4.0, 2*trunc + 1)
+        P_ref = np.diag(grid)
+        Q_ref = reference_conjugate(labels[::-1])/(grid[1] - grid[0])
+        D_ref = reference_exponential(P_ref)
+        S_ref = reference_exponential(Q_ref)
+    
+    for op, ref in [(Q, Q_ref), (P, P_ref), (D, D_ref), (S, S_ref)]:
+        assert np.allclose(op, ref, atol=1e-12)
+    assert np.allclose(Ddag, D_ref.conj().T, atol=1e-12)
+    assert np.allclose(Sdag, S_ref.conj().T, atol=1e-12)
+
+################################################################################
+#       Expanded Operators
+################################################################################
+
+def test_expanded_operators_match_tensor_products():
+    hamil = coupled_qubits()
+    hamil.getHamiltonian()
+    
+    # Operators that the Hamiltonian does not use are not expanded
+    for node in [1, 2]:
+        assert "pdisp" not in hamil.circ_operators[node]
+    
+    local = [hamil.getOperatorList(node) for node in [1, 2]]
+    identities = [qt.qeye(15), qt.qeye(11)]
+    for i, node in enumerate([1, 2]):
+        for j, key in enumerate(["charge", "flux", "disp", "disp_adj", "pdisp", "pdisp_adj"]):
+            ops = list(identities)
+            ops[i] = local[i][j]
+            ref = qt.tensor(*ops)
+            op = hamil.circ_operators[node][key]
+            assert op.dims == ref.dims
+            assert np.allclose(op.full(), ref.full(), atol=1e-12)
+
+################################################################################
+#       Matrix-Free Hamiltonian
+################################################################################
+
+@pytest.mark.parametrize("system", [fluxonium, split_transmon, coupled_qubits])
+def test_hamiltonian_operator_matches_hamiltonian(system):
+    hamil = system()
+    H = hamil.getHamiltonian()
+    A = hamil.getHamiltonianOperator()
+    assert A.shape == H.shape
+    
+    rng = np.random.default_rng(3)
+    X = rng.standard_normal((H.shape[0], 3)) + 1j*rng.standard_normal((H.shape[0], 3))
+    assert np.allclose(A.dot(X[:, 0]), H.data.dot(X[:, 0]), rtol=1e-12, atol=1e-9)
+    assert np.allclose(A.matmat(X), H.data.dot(X), rtol=1e-12, atol=1e-9)
+
+@pytest.mark.parametrize("system, name, start, end", [
+    (fluxonium, 'phi10-2e', 0.0, 1.0),
+    (coupled_qubits, 'Q2e', 0.0, 0.5)
+])
+def test_matrix_free_sweep_matches_dense(system, name, start, end):
+    hamil = system()
+    hamil.setHamiltonianConfig(matrix_free=True)
+    opts = {"sigma": None, "mode": "normal", "maxiter": None, "tol": 1e-9, "which": "SA"}
+    hamil.setDiagConfig(sparse=True, sparsesolveropts=opts)
+    E = sweep_energies(hamil, name, start, end, 4)
+    
+    E_ref = sweep_energies(system(), name, start, end, 4)
+    assert np.allclose(E, E_ref, rtol=1e-8, atol=1e-8)
+
+################################################################################
+#       Shift-Invert Diagonalisation
+################################################################################
+
+def test_shift_invert_after_parameter_change():
+    # The spectrum moves by much more than the spread of the previous eigenvalues
+    hamil = split_transmon()
+    hamil.setDiagConfig(sparse=True, shift_invert=True, eigvalues=3)
+    hamil.diagonalize(hamil.getHamiltonian())
+    hamil.setParameterValues('I1', 0.05, 'I2', 0.05)
+    E = hamil.diagonalize(hamil.getHamiltonian())
+    assert np.allclose(E, hamil.getHamiltonian().eigenenergies()[:3])
+
+def test_shift_invert_sweep_matches_direct():
+    # The shift chosen from the previous point lies inside the spectrum of the next
+    values = np.linspace(0.002, 0.08, 3)
+    hamil = split_transmon()
+    hamil.setDiagConfig(sparse=True, shift_invert=True, eigvalues=3)
+    hamil.addSweep('I1', 0.002, 0.08, 3)
+    sweep = hamil.paramSweep()
+    x, E, v = hamil.getSweep(sweep, 'I1', {})
+    
+    ref = direct_energies(split_transmon(), 'I1', values, levels=3)
+    assert np.allclose(np.asarray(E, dtype=np.float64).T, ref)
+
+################################################################################
+#       Sweep State
+################################################################################
+
+def test_failed_sweep_restores_hamiltonian():
+    # The current evaluation needs eigenvectors, so the sweep raises at the first point
+    hamil = fluxonium()
+    hamil.setDiagConfig(get_vectors=False)
+    hamil.addSweep('phi10-2e', 0.4, 0.5, 2)
+    hamil.addEvaluation('Current')
+    with pytest.raises(Exception):
+        hamil.paramSweep()
+    
+    # Hamiltonians are independent again and the unswept terms are no longer fixed
+    assert hamil.getHamiltonian() is not hamil.getHamiltonian()
+    hamil.setParameterValues('L', 400.0, 'phi10-2e', 0.5)
+    E = hamil.getHamiltonian().eigenenergies()[:5]
+    assert np.allclose(E, direct_energies(fluxonium(), 'L', [400.0])[0])
+
+def test_batched_sweep_regenerates_operators_once(monkeypatch):
+    # The remaining evaluables of a batch reuse the operators expanded when the Hamiltonians were assembled
+    from pycqed import numerical_system
+    count = []
+    init = numerical_system._ExpandedOperators.__init__
+    def counted(self, *args, **kwargs):
+        count.append(1)
+        init(self, *args, **kwargs)
+    monkeypatch.setattr(numerical_system._ExpandedOperators, "__init__", counted)
+    
+    results = []
+    for batch_size in [None, 4]:
+        hamil = fluxonium()
+        hamil.setHamiltonianConfig(osc_cache_size=0)
+        hamil.setDiagConfig(get_vectors=True, eigvalues=5)
+        hamil.addSweep('L', 400.0, 600.0, 8)
+        hamil.addEvaluation('Hamiltonian')
+        hamil.addEvaluation('Voltage', node=1, elements=[(0, 1), (1, 2)])
+        count.clear()
+        sweep = hamil.paramSweep(batch_size=batch_size)
+        assert len(count) == 8
+        results.append(np.abs(hamil.getSweep(sweep, 'L', {}, evaluable='Voltage')[1]))
+    assert np.allclose(results[0], results[1])
+
+################################################################################
+#       Warm-Started Diagonalisation
+################################################################################
+
+@pytest.mark.parametrize("method, maxiter", [("eigsh", None), ("lobpcg", None), ("lobpcg", 5)])
+@pytest.mark.parametrize("name, start, end", [
+    ("L", 400.0, 600.0),
+    ("phi10-2e", 0.3, 0.7)
+])
+def test_warm_sweep_matches_direct(method, maxiter, name, start, end):
+    # phi10-2e = 0.5 is a point of symmetry, where the ground state only spans one parity sector
+    values = np.linspace(start, end, 5)
+    hamil = fluxonium()
+    opts = {"sigma": None, "mode": "normal", "maxiter": maxiter, "tol": 1e-9, "which": "SA"}
+    hamil.setDiagConfig(eigvalues=4, sparse=True, warm_start=method, sparsesolveropts=opts)
+    hamil.addSweep(name, start, end, 5)
+    sweep = hamil.paramSweep()
+    x, E, v = hamil.getSweep(sweep, name, {})
+    
+    ref = direct_energies(fluxonium(), name, values, levels=4)
+    assert np.allclose(np.asarray(E, dtype=np.float64).T, ref, rtol=1e-7, atol=1e-6)
+
+################################################################################
+#       Single Precision
+################################################################################
+
+@pytest.mark.parametrize("refine", [True, False])
+@pytest.mark.parametrize("memory_budget", [None, 0])
+def test_single_precision_sweep(refine, memory_budget):
+    values = np.linspace(400.0, 600.0, 3)
+    hamil = fluxonium()
+    hamil.setStorageConfig(memory_budget=memory_budget)
+    hamil.setDiagConfig(eigvalues=4, get_vectors=True, contiguous=True, precision="single", refine=refine)
+    hamil.addSweep('L', 400.0, 600.0, 3)
+    sweep = hamil.paramSweep()
+    x, E, v = hamil.getSweep(sweep, 'L', {})
+    
+    # Unrefined eigenvectors are kept in single precision
+    V = sweep.getColumn("/V") if memory_budget == 0 else sweep[1]
+    assert V.dtype == (np.complex128 if refine else np.complex64)
+    ref = direct_energies(fluxonium(), 'L', values, levels=4)
+    assert np.allclose(np.asarray(E, dtype=np.float64).T, ref, rtol=1e-8 if refine else 1e-5)
+
+################################################################################
+#       Compiled Hamiltonian
+################################################################################
+
+@pytest.mark.parametrize("system, name, start, end", [
+    (fluxonium, "phi10-2e", 0.3, 0.7),
+    (fluxonium, "I", 0.5, 1.0),
+    (split_transmon, "Q1e", 0.0, 1.0),
+    (split_transmon, "I1", 0.002, 0.01),
+    (coupled_qubits, "Q2e", 0.0, 0.5),
+    (coupled_qubits, "I2", 0.01, 0.03)
+])
+def test_compiled_sweep_matches_uncompiled(system, name, start, end):
+    hamil = system()
+    E = sweep_energies(hamil, name, start, end, 4)
+    assert hamil.H_template is not None
+    
+    reference = system()
+    reference.setHamiltonianConfig(compiled=False)
+    E_ref = sweep_energies(reference, name, start, end, 4)
+    assert reference.H_template is None
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+
+def test_compiled_hamiltonian_matches_uncompiled():
+    hamil = coupled_qubits()
+    hamil.addSweep('Q2e', 0.1, 0.2, 2)
+    hamil.paramSweep()
+    H = hamil.getHamiltonian()
+    
+    # The last sweep point, assembled from the operators
+    reference = coupled_qubits()
+    reference.setParameterValues('Q2e', 0.2)
+    assert np.allclose(H.full(), reference.getHamiltonian().full(), atol=1e-9)
+
+@pytest.mark.parametrize("system", [split_transmon, coupled_transmons, coupled_qubits])
+def test_diagonal_terms_match_operator_products(system, monkeypatch):
+    hamil = system()
+    hamil.setHamiltonianConfig(compiled=False)
+    H = hamil.getHamiltonian()
+    
+    # Without any diagonal operators every term is a product of the expanded operators
+    monkeypatch.setattr(util, "sparseDiagonal", lambda M: None)
+    H_ref = hamil.getHamiltonian()
+    assert np.allclose(H.full(), H_ref.full(), atol=1e-9)
+
+def test_compiled_charge_basis_sweep_matches_uncompiled():
+    hamil = coupled_transmons()
+    hamil.addSweep('Q1e', 0.0, 0.5, 2)
+    hamil.addSweep('Q2e', 0.0, 0.5, 3)
+    hamil.paramSweep()
+    assert hamil.H_template is not None
+    
+    # The last sweep point
+    reference = coupled_transmons()
+    reference.setHamiltonianConfig(compiled=False)
+    reference.setParameterValues('Q1e', 0.5, 'Q2e', 0.5)
+    assert np.allclose(hamil.getHamiltonian().full(), reference.getHamiltonian().full(), atol=1e-9)
+    
+    E = sweep_energies(coupled_transmons(), 'Cc', 1.0, 3.0, 3)
+    reference = coupled_transmons()
+    reference.setHamiltonianConfig(compiled=False)
+    assert np.allclose(E, sweep_energies(reference, 'Cc', 1.0, 3.0, 3), rtol=1e-10, atol=1e-9)
+
+################################################################################
+#       Banded Diagonalisation
+################################################################################
+
+@pytest.mark.parametrize("system, name, reorder", [
+    (split_transmon, 'Q1e', True),
+    (split_transmon, 'Q1e', False),
+    (coupled_transmons, 'Q2e', True),
+    (coupled_transmons, 'Q2e', False)
+])
+def test_banded_sweep_matches_dense(system, name, reorder):
+    hamil = system()
+    hamil.setDiagConfig(banded=True, reorder=reorder)
+    E = sweep_energies(hamil, name, 0.0, 1.0, 4)
+    
+    E_ref = sweep_energies(system(), name, 0.0, 1.0, 4)
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+
+################################################################################
+#       Real Gauge
+################################################################################
+
+@pytest.mark.parametrize("system, name, start, end", [
+    (split_transmon, 'phi10-2e', 0.0, 0.4),
+    (coupled_transmons, 'Q1e', 0.0, 0.5),
+    (fluxonium, 'phi10-2e', 0.3, 0.7)
+])
+def test_real_gauge_sweep_matches_complex(system, name, start, end):
+    results = []
+    for real in [True, False]:
+        hamil = system()
+        hamil.setDiagConfig(eigvalues=4, get_vectors=True, real=real, contiguous=True)
+        hamil.addSweep(name, start, end, 3)
+        results.append(util.getEigenValuesAndVectors(hamil.paramSweep()))
+    
+    # The eigenvectors agree up to a phase
+    (E, V), (E_ref, V_ref) = results
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+    for i in range(len(V)):
+        assert np.allclose(np.abs(V[i].conj().T.dot(V_ref[i])), np.eye(4), atol=1e-8)
+
+################################################################################
+#       Varying Hamiltonian Terms
+################################################################################
+
+@pytest.mark.parametrize("system, outer, inner", [
+    (split_transmon, ('I1', 0.002, 0.004), ('phi10-2e', 0.0, 1.0)),
+    (coupled_transmons, ('Cc', 1.0, 3.0), ('Q2e', 0.0, 0.5)),
+    (coupled_qubits, ('Q2e', 0.0, 0.5), ('phi10-2e', 0.3, 0.7))
+])
+def test_varying_terms_sweep_matches_uncompiled(system, outer, inner, monkeypatch):
+    hamil = system()
+    masks = []
+    set_static_terms = hamil._set_static_terms
+    def record(varying=None):
+        masks.append(varying)
+        set_static_terms(varying)
+    monkeypatch.setattr(hamil, "_set_static_terms", record)
+    
+    hamil.addSweep(*outer, 2)
+    hamil.addSweep(*inner, 3)
+    sweep = hamil.paramSweep()
+    
+    # Only some of the terms vary, and the split is cleared after the sweep
+    varying = [mask for mask in masks if mask is not None]
+    assert len(varying) == 1 and not np.all(varying[0])
+    assert masks[-1] is None
+    
+    for value in np.linspace(outer[1], outer[2], 2):
+        x, E, v = hamil.getSweep(sweep, inner[0], {outer[0]: value})
+        reference = system()
+        reference.setHamiltonianConfig(compiled=False)
+        reference.setParameterValues(outer[0], value)
+        E_ref = direct_energies(reference, inner[0], [float(xi) for xi in x])
+        assert np.allclose(np.asarray(E, dtype=np.float64).T, E_ref, rtol=1e-10, atol=1e-9)
+
+################################################################################
+#       Sweep Expressions
+################################################################################
+
+def test_two_dimensional_sweep_matches_direct():
+    # The coupling capacitance enters the inverse capacitance matrix and the oscillator impedance
+    hamil = coupled_qubits()
+    hamil.addSweep('Cc', 0.5, 2.0, 3)
+    hamil.addSweep('Q2e', 0.0, 0.5, 3)
+    sweep = hamil.paramSweep()
+    
+    reference = coupled_qubits()
+    for Cc in [0.5, 1.25, 2.0]:
+        x, E, v = hamil.getSweep(sweep, 'Q2e', {'Cc': Cc})
+        reference.setParameterValues('Cc', Cc)
+        E_ref = direct_energies(reference, 'Q2e', [0.0, 0.25, 0.5])
+        assert np.allclose(np.asarray(E, dtype=np.float64).T, E_ref, rtol=1e-10, atol=1e-9)
+
+def test_parameterised_sweep_matches_direct():
+    # The second junction follows the first, such that the swept parameter also sets a parametric one
+    def symmetric_transmon():
+        hamil = split_transmon()
+        hamil.SS.addParameterisation('I2', 2*hamil.SS.getSymbol('I1'))
+        return hamil
+    hamil = symmetric_transmon()
+    E = sweep_energies(hamil, 'I1', 0.002, 0.006, 3)
+    E_ref = direct_energies(symmetric_transmon(), 'I1', [0.002, 0.004, 0.006])
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+    
+    # The parametric parameter is set at the last point
+    assert np.isclose(hamil.getParameterValue('I2'), 0.012)
+
+################################################################################
+#       Batched Diagonalisation
+################################################################################
+
+@pytest.mark.parametrize("system, name, start, end", [
+    (fluxonium, "phi10-2e", 0.3, 0.7),
+    (fluxonium, "L", 400.0, 600.0),
+    (coupled_qubits, "Q2e", 0.0, 0.5)
+])
+def test_batched_sweep_matches_unbatched(system, name, start, end):
+    E = sweep_energies(system(), name, start, end, 7, batch_size=3)
+    E_ref = sweep_energies(system(), name, start, end, 7)
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_batched_eigenvectors_match_unbatched(contiguous):
+    results = []
+    for batch_size in [None, 4]:
+        hamil = coupled_qubits()
+        hamil.setDiagConfig(eigvalues=3, get_vectors=True, contiguous=contiguous)
+        hamil.addSweep('Q2e', 0.0, 0.5, 5)
+        E, V = util.getEigenValuesAndVectors(hamil.paramSweep(batch_size=batch_size))
+        if not contiguous:
+            E = np.array([list(e) for e in E])
+            V = np.array([util.eigenvectorArray(v) for v in V])
+        results.append((np.asarray(E, dtype=np.float64), V))
+    
+    # The eigenvectors agree up to a phase
+    (E, V), (E_ref, V_ref) = results
+    assert np.allclose(E, E_ref, rtol=1e-10)
+    for i in range(len(V)):
+        assert np.allclose(np.abs(V[i].conj().T.dot(V_ref[i])), np.eye(3), atol=1e-8)
+
+################################################################################
+#       Contiguous Eigenvectors
+################################################################################
+
+@pytest.mark.parametrize("config, batch_size", [
+    ({}, None),
+    ({}, 3),
+    ({'banded': True}, None),
+    ({'sparse': True, 'sparsesolveropts': {"sigma": None, "mode": "normal", "maxiter": None, "tol": 1e-10, "which": "SA"}}, None),
+    ({'sparse': True, 'shift_invert': True}, None),
+    ({'sparse': True, 'warm_start': "eigsh", 'sparsesolveropts': {"sigma": None, "mode": "normal", "maxiter": None, "tol": 1e-10, "which": "SA"}}, None)
+])
+def test_contiguous_eigenvectors_match_kets(config, batch_size):
+    results = []
+    for contiguous in [True, False]:
+        hamil = split_transmon(trunc=10)
+        hamil.setDiagConfig(eigvalues=3, get_vectors=True, contiguous=contiguous, **config)
+        hamil.addSweep('Q1e', 0.1, 0.4, 4)
+        E, V = util.getEigenValuesAndVectors(hamil.paramSweep(batch_size=batch_size))
+        if contiguous:
+            assert V.shape == (4, 21, 3)
+        else:
+            assert all(ket.dims == [[21], [1]] for v in V for ket in v)
+            E = np.array([list(e) for e in E])
+            V = np.array([util.eigenvectorArray(v) for v in V])
+        results.append((np.asarray(E, dtype=np.float64), V))
+    
+    # The eigenvectors agree up to a phase
+    (E, V), (E_ref, V_ref) = results
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+    for i in range(len(V)):
+        assert np.allclose(np.abs(V[i].conj().T.dot(V_ref[i])), np.eye(3), atol=1e-6)
+
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_matrix_element_sweep_matches_qutip(contiguous):
+    hamil = coupled_qubits()
+    hamil.setDiagConfig(eigvalues=3, get_vectors=True, contiguous=contiguous)
+    hamil.addSweep('Q2e', 0.1, 0.4, 3)
+    hamil.addEvaluation('Hamiltonian')
+    hamil.addEvaluation('Voltage', node=[1, 2], elements=[(0, 1), (1, 2)])
+    hamil.addEvaluation('Current', edge=(0, 2, 1), elements=[(0, 1), (2, 2)])
+    sweep = hamil.paramSweep()
+    
+    # Matrix elements from the stored eigenvectors of each point
+    E, V = util.getEigenValuesAndVectors(sweep['getHamiltonian'])
+    reference = coupled_qubits()
+    for p, Q2e in enumerate([0.1, 0.25, 0.4]):
+        reference.setParameterValues('Q2e', Q2e)
+        kets = V[p] if not contiguous else [qt.Qobj(V[p][:, l:l+1], dims=[[15, 11], [1, 1]]) for l in range(3)]
+        voltages = [[reference.getVoltageOperator(node=n).matrix_element(kets[i].dag(), kets[j]).real for i, j in [(0, 1), (1, 2)]] for n in [1, 2]]
+        currents = [reference.getCurrentOperator(edge=(0, 2, 1)).matrix_element(kets[i].dag(), kets[j]).real for i, j in [(0, 1), (2, 2)]]
+        assert np.allclose(sweep['getVoltageMatrixElement'][p], voltages, rtol=1e-10, atol=1e-12)
+        assert np.allclose(sweep['getCurrentMatrixElement'][p], currents, rtol=1e-10, atol=1e-12)
+
+################################################################################
+#       Parallel Sweeps
+################################################################################
+
+@pytest.mark.parametrize("name, start, end", [
+    ("phi10-2e", 0.3, 0.7),
+    ("L", 400.0, 600.0)
+])
+def test_parallel_sweep_matches_serial(name, start, end):
+    E = sweep_energies(fluxonium(), name, start, end, 7, workers=2)
+    E_ref = sweep_energies(fluxonium(), name, start, end, 7)
+    assert np.allclose(E, E_ref, rtol=1e-10, atol=1e-9)
+
+def test_parallel_sweep_keeps_order():
+    results = []
+    for workers in [None, 3]:
+        hamil = coupled_qubits()
+        hamil.setDiagConfig(eigvalues=3, get_vectors=True, contiguous=True)
+        hamil.addSweep('Cc', 0.5, 2.0, 3)
+        hamil.addSweep('Q2e', 0.0, 0.5, 4)
+        hamil.addEvaluation('Hamiltonian')
+        hamil.addEvaluation('Voltage', node=2, elements=[(0, 1)])
+        sweep = hamil.paramSweep(workers=workers)
+        results.append([np.abs(hamil.getSweep(sweep, 'Q2e', {'Cc': Cc}, evaluable='Voltage')[1]) for Cc in [0.5, 1.25, 2.0]])
+    assert np.allclose(results[0], results[1], rtol=1e-8)
+
+################################################################################
+#       Adaptive Sweeps
+################################################################################
+
+def test_adaptive_sweep_matches_direct():
+    hamil = fluxonium()
+    hamil.addSweep('phi10-2e', 0.0, 1.0, 5)
+    sweep = hamil.paramSweepAdaptive(tol=1.0, max_depth=3)
+    x, E, v = hamil.getSweep(sweep, 'phi10-2e', {})
+    
+    # The coarse grid is kept, and the intervals are bisected at most max_depth times
+    assert np.all(np.isin(np.linspace(0.0, 1.0, 5), x))
+    assert np.all(np.diff(x) > 0)
+    assert len(x) > 5
+    assert np.min(np.diff(x)) >= 0.25/2**3 - 1e-12
+    
+    E_ref = direct_energies(fluxonium(), 'phi10-2e', [float(xi) for xi in x])
+    assert np.allclose(np.asarray(E, dtype=np.float64).T, E_ref, rtol=1e-10, atol=1e-9)
+
+def test_adaptive_sweep_refines_every_slice():
+    hamil = coupled_qubits()
+    hamil.addSweep('Q2e', 0.0, 0.5, 2)
+    hamil.addSweep('phi10-2e', 0.3, 0.7, 3)
+    sweep = hamil.paramSweepAdaptive(tol=0.5, max_depth=2)
+    for Q2e in [0.0, 0.5]:
+        x, E, v = hamil.getSweep(sweep, 'phi10-2e', {'Q2e': Q2e})
+        assert len(x) > 3
+        reference = coupled_qubits()
+        reference.setParameterValues('Q2e', Q2e)
+        E_ref = direct_energies(reference, 'phi10-2e', [float(xi) for xi in x])
+        assert np.allclose(np.asarray(E, dtype=np.float64).T, E_ref, rtol=1e-10, atol=1e-9)
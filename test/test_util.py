@@ -0,0 +1,237 @@
+import numpy as np
+import pytest
+import qutip as qt
+import scipy as sc
+import scipy.sparse
+
+from pycqed import util
+from test_numerical_system import split_transmon
+
+################################################################################
+#       Qubit Reduction
+################################################################################
+
+def reference_pauli_coefficients(E, V, O):
+    h = []
+    for i in range(E.shape[1]):
+        Op = V[i][:, :2].conj().T.dot(O).dot(V[i][:, :2])
+        El, Vl = np.linalg.eigh(Op)
+        Vl = np.array([np.abs(Vl[0, k])/Vl[0, k]*Vl[:, k] for k in (0, 1)])
+        Hq = Vl.conj().dot(np.diag(E[:2, i])).dot(Vl.T)
+        h.append([Hq[0, 1].real, -Hq[0, 1].imag, 0.5*(Hq[0, 0] - Hq[1, 1]).real])
+    return np.array(h).T
+
+@pytest.mark.parametrize("contiguous", [True, False])
+def test_pauli_coefficients_double_precision(contiguous):
+    hamil = split_transmon()
+    hamil.setDiagConfig(eigvalues=2, get_vectors=True, contiguous=True)
+    hamil.addSweep('Q1e', 0.3, 0.7, 5)
+    E, V = util.getEigenValuesAndVectors(hamil.paramSweep())
+    E = E.T
+    O = hamil.getVoltageOperator(node=1)
+    ref = reference_pauli_coefficients(E, V, O.full())
+    
+    # The eigenvectors as the columns of an array or as kets
+    if not contiguous:
+        kets = np.empty((2, len(V)), dtype=object)
+        for l in range(2):
+            for i in range(len(V)):
+                kets[l, i] = qt.Qobj(V[i][:, l:l+1], dims=[O.dims[0], [1]*len(O.dims[0])])
+        V = kets
+    hx, hy, hz = util.pauliCoefficients(E, V, O)
+    assert np.allclose(np.array([hx, hy, hz]), ref, rtol=1e-12, atol=1e-9)
+
+################################################################################
+#       Dense Diagonalisation
+################################################################################
+
+def random_hermitian(N, seed):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(N, N)) + 1j*rng.normal(size=(N, N))
+    return A + A.conj().T
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_dense_workspace_matches_eigh(sparse):
+    ws = util.DenseEigenWorkspace(20, eigvalues=4, get_vectors=True)
+    for seed in range(3):
+        A = random_hermitian(20, seed)
+        E, V = ws.diagonalize(sc.sparse.csr_matrix(A) if sparse else A)
+        E_ref, V_ref = np.linalg.eigh(A)
+        assert np.allclose(E, E_ref[:4])
+        assert np.allclose(np.abs(V.conj().T.dot(V_ref[:, :4])), np.eye(4))
+
+def test_batched_diagonaliser_matches_dense():
+    M = np.array([random_hermitian(12, seed) for seed in range(4)])
+    E, V = util.diagDenseHBatch(M, eigvalues=3, get_vectors=True)
+    for b in range(len(M)):
+        E_ref, V_ref = util.diagDenseH(qt.Qobj(M[b]), eigvalues=3, get_vectors=True, contiguous=True)
+        assert np.allclose(E[b], E_ref)
+        assert np.allclose(np.abs(V[b].conj().T.dot(V_ref)), np.eye(3))
+    assert np.allclose(util.diagDenseHBatch(M, eigvalues=3), E)
+    with pytest.raises(Exception):
+        util.diagDenseHBatch(M[0])
+
+################################################################################
+#       Banded Diagonalisation
+################################################################################
+
+def random_banded_hermitian(N, b, seed):
+    m, n = np.indices((N, N))
+    return np.where(np.abs(m - n) <= b, random_hermitian(N, seed), 0.0)
+
+def test_banded_permutation_recovers_bandwidth():
+    A = random_banded_hermitian(40, 2, 0)
+    assert util.getBandwidth(sc.sparse.csr_matrix(A)) == 2
+    
+    # A shuffled banded matrix is reordered back to a small bandwidth
+    shuffle = np.random.default_rng(1).permutation(40)
+    B = sc.sparse.csr_matrix(A[shuffle][:, shuffle])
+    cache = {}
+    perm, b = util.bandedPermutation(B, cache=cache)
+    assert b <= 4
+    assert util.getBandwidth(B[perm][:, perm]) == b
+    assert util.bandedPermutation(B, cache=cache)[0] is perm
+
+@pytest.mark.parametrize("b, shuffled, reorder", [
+    (1, False, False),
+    (1, True, True),
+    (3, False, False),
+    (3, True, True),
+    (3, True, False)
+])
+def test_banded_diagonaliser_matches_dense(b, shuffled, reorder):
+    A = random_banded_hermitian(60, b, b)
+    if shuffled:
+        shuffle = np.random.default_rng(2).permutation(60)
+        A = A[shuffle][:, shuffle]
+    M = qt.Qobj(A)
+    E, V = util.diagBandedH(M, eigvalues=4, get_vectors=True, reorder=reorder, max_bandwidth=60, contiguous=True)
+    E_ref, V_ref = util.diagDenseH(M, eigvalues=4, get_vectors=True, contiguous=True)
+    assert np.allclose(E, E_ref, rtol=1e-12, atol=1e-10)
+    assert np.allclose(np.abs(V.conj().T.dot(V_ref)), np.eye(4), atol=1e-8)
+    assert np.allclose(util.diagBandedH(M, eigvalues=4, reorder=reorder, max_bandwidth=60), E_ref, rtol=1e-12, atol=1e-10)
+
+################################################################################
+#       Real Gauge
+################################################################################
+
+def test_real_gauge_of_real_matrix():
+    A = sc.sparse.csr_matrix(random_hermitian(10, 0).real.astype(np.complex128))
+    Mr, u = util.realGauge(A)
+    assert u is None
+    assert Mr.dtype == np.float64
+    assert np.allclose(Mr.toarray(), A.toarray().real)
+
+def test_real_gauge_removes_phases():
+    # A real symmetric matrix with random phases applied in a diagonal gauge
+    A = random_banded_hermitian(30, 2, 4).real
+    u_ref = np.exp(2j*np.pi*np.random.default_rng(5).uniform(size=30))
+    M = qt.Qobj(u_ref[:, np.newaxis]*A*u_ref.conj())
+    cache = {}
+    Mr, u = util.realGauge(M, cache=cache)
+    assert Mr.dtype == np.float64
+    assert np.allclose(Mr.toarray(), u.conj()[:, np.newaxis]*M.full()*u, atol=1e-12)
+    assert "gauge_tree" in cache
+    
+    # The eigenvectors of the original matrix are those of the real matrix transformed by the gauge
+    E, V = np.linalg.eigh(Mr.toarray())
+    E_ref = np.linalg.eigvalsh(M.full())
+    assert np.allclose(E, E_ref)
+    assert np.allclose(M.full().dot(u[:, np.newaxis]*V), (u[:, np.newaxis]*V)*E, atol=1e-10)
+
+def test_real_gauge_of_frustrated_matrix():
+    # The phases around a loop cannot be removed
+    M = sc.sparse.csr_matrix(np.array([
+        [0.0, 1.0, 1.0],
+        [1.0, 0.0, 1j],
+        [1.0, -1j, 0.0]
+    ]))
+    assert util.realGauge(M) is None
+
+################################################################################
+#       Displacement Operators
+################################################################################
+
+@pytest.mark.parametrize("alpha", [0.0, 0.3, 0.8j, 1.1*np.exp(0.7j)])
+def test_displacement_operator_matches_expm(alpha):
+    # The elements of the untruncated operator, approximated in a much larger space
+    trunc = 20
+    a = qt.destroy(6*trunc).full()
+    ref = sc.linalg.expm(alpha*a.conj().T - np.conj(alpha)*a)[:trunc, :trunc]
+    D = util.displacementOperator(trunc, alpha)
+    assert np.allclose(D, ref, atol=1e-13)
+
+@pytest.mark.parametrize("band", [0, 3, 50])
+def test_banded_displacement_operator_matches_dense(band):
+    trunc = 30
+    D = util.displacementOperator(trunc, 0.4 - 0.2j)
+    D_band = util.displacementOperator(trunc, 0.4 - 0.2j, band=band)
+    assert sc.sparse.issparse(D_band)
+    m, n = np.indices((trunc, trunc))
+    assert np.allclose(D_band.toarray(), np.where(np.abs(m - n) <= band, D, 0.0), atol=1e-15)
+
+def test_displacement_operator_large_truncation():
+    D = util.displacementOperator(400, 0.6)
+    assert np.all(np.isfinite(D))
+    
+    # The low Fock states of the untruncated operator are preserved to high accuracy
+    assert np.allclose((D.conj().T@D)[:100, :100], np.eye(100), atol=1e-12)
+
+################################################################################
+#       Operator Expansion
+################################################################################
+
+@pytest.mark.parametrize("left, right", [(1, 1), (1, 5), (4, 1), (3, 7)])
+def test_expanded_operator_matches_kron(left, right):
+    O = sc.sparse.random(6, 6, density=0.3, random_state=5) + 1j*sc.sparse.random(6, 6, density=0.3, random_state=6)
+    ref = sc.sparse.kron(sc.sparse.kron(sc.sparse.identity(left), O), sc.sparse.identity(right))
+    M = util.expandOperator(O, left, right)
+    assert sc.sparse.isspmatrix_csr(M)
+    M.check_format(full_check=True)
+    assert np.allclose(M.toarray(), ref.toarray(), atol=1e-15)
+
+def test_expanded_operator_reuses_structure():
+    # Operators with the same sparsity pattern share the gather indices
+    cache = {}
+    O = qt.displace(8, 0.3)
+    util.expandOperator(O, 2, 3, cache=cache)
+    M = util.expandOperator(qt.displace(8, 0.5), 2, 3, cache=cache)
+    assert len(cache) == 1
+    ref = qt.tensor(qt.qeye(2), qt.displace(8, 0.5), qt.qeye(3))
+    assert np.allclose(M.toarray(), ref.full(), atol=1e-15)
+
+################################################################################
+#       Matrix Elements
+################################################################################
+
+def reference_matrix_elements(op, kets, elements):
+    return np.array([op.matrix_element(kets[i].dag(), kets[j]) for i, j in elements])
+
+def test_matrix_elements_match_qutip():
+    hamil = split_transmon(trunc=8)
+    E, kets = util.diagDenseH(hamil.getHamiltonian(), eigvalues=4, get_vectors=True)
+    V = util.eigenvectorArray(kets)
+    ops = [hamil.getVoltageOperator(node=1), qt.Qobj(random_hermitian(17, 1), dims=kets[0].dims[:1]*2)]
+    elements = [(0, 1), (1, 2), (3, 0), (2, 2)]
+    
+    for op in ops:
+        ref = reference_matrix_elements(op, kets, elements)
+        assert np.allclose(util.matrixElements(op, kets, elements=elements), ref, atol=1e-12)
+        assert np.allclose(util.matrixElements(op, V, elements=elements), ref, atol=1e-12)
+        assert np.allclose(util.reducedOperator(op, V), V.conj().T.dot(op.full()).dot(V), atol=1e-12)
+    
+    # Several operators share the eigenvectors
+    R = util.matrixElements(ops, V, elements=elements)
+    assert R.shape == (2, 4)
+    assert np.allclose(R[1], reference_matrix_elements(ops[1], kets, elements), atol=1e-12)
+
+def test_stacked_matrix_elements_match_qutip():
+    # The eigenvectors of several points are transformed at once
+    op = qt.Qobj(random_hermitian(10, 2))
+    V = np.array([np.linalg.eigh(random_hermitian(10, seed))[1][:, :3] for seed in range(4)])
+    elements = [(0, 1), (2, 1)]
+    R = util.matrixElements(op, V, elements=elements)
+    assert R.shape == (4, 2)
+    for p in range(4):
+        kets = [qt.Qobj(V[p][:, l:l+1]) for l in range(3)]
+        assert np.allclose(R[p], reference_matrix_elements(op, kets, elements), atol=1e-12)